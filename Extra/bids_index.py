@@ -0,0 +1,248 @@
+import os
+import json
+import fnmatch
+from nipype.interfaces.base import (TraitedSpec, File, traits, BaseInterface, BaseInterfaceInputSpec)
+
+try :
+    from os import scandir
+except ImportError :
+    try :
+        from scandir import scandir
+    except ImportError :
+        scandir = None
+
+"""
+.. module:: bids_index
+    :platform: Unix
+    :synopsis: Module to index the files of a BIDS source directory in a single walk.
+"""
+
+entity_keys = ['sub', 'ses', 'task', 'acq', 'rec', 'run']
+
+def parse_bids_filename(fn):
+    '''
+    Split a BIDS file name into its key-value entities, its suffix (e.g., "pet", "T1w") and its
+    extension (e.g., "mnc", "mnc.gz").
+    '''
+    base = os.path.basename(fn)
+    stem, ext = os.path.splitext(base)
+    if ext == '.gz' :
+        stem, ext0 = os.path.splitext(stem)
+        ext = ext0 + ext
+    entities={}
+    suffix=''
+    for part in stem.split('_') :
+        if '-' in part :
+            key, value = part.split('-', 1)
+            if not key in entities :
+                entities[key] = value
+        else :
+            suffix = part
+    return entities, suffix, ext.lstrip('.')
+
+def scan_key(sid, ses, task=None, run=None):
+    '''Key used to look up the files of a scan (sid, ses, task, run) or of an anatomical session (sid, ses)'''
+    if task == None and run == None :
+        return '|'.join([sid, ses])
+    return '|'.join([sid, ses, task, run])
+
+def save_scan_files(scan_files, filename):
+    '''Write the files of each scan (indexed by scan_key) to <filename>, which is read by IndexedDataSourceRunning'''
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname) :
+        os.makedirs(dirname)
+    tmp_file = filename + '.tmp' + str(os.getpid())
+    json.dump(scan_files, open(tmp_file, 'w'))
+    os.rename(tmp_file, filename)
+    return filename
+
+def _list_dir(dirname, mtime):
+    files=[]
+    subdirs=[]
+    if scandir != None :
+        for entry in scandir(dirname) :
+            if entry.is_dir() :
+                subdirs.append(entry.name)
+            else :
+                files.append(entry.name)
+    else :
+        for name in os.listdir(dirname) :
+            if os.path.isdir(dirname + os.sep + name) :
+                subdirs.append(name)
+            else :
+                files.append(name)
+    return { "mtime":mtime, "files":sorted(files), "subdirs":sorted(subdirs) }
+
+class BIDSIndex():
+    '''
+    In-memory index of the files in a BIDS source directory, grouped by subject.
+
+    The directory tree is walked once. The listing of every directory is stored in <cache_file> together
+    with the mtime of the directory, so that subsequent runs only list the directories that have changed
+    (i.e., where files were added, removed or renamed) since the last run.
+    '''
+    def __init__(self, source_dir, cache_file=None, verbose=1):
+        self.source_dir = os.path.normpath(source_dir)
+        self.cache_file = cache_file
+        self.verbose = verbose
+        self.dirs = {}
+        self.n_listed = 0
+        self._load_cache()
+        self._scan()
+        self._save_cache()
+        self._build()
+
+    def _load_cache(self):
+        if self.cache_file == None or not os.path.exists(self.cache_file) : return
+        try :
+            cache = json.load(open(self.cache_file, 'r'))
+        except ValueError :
+            print("Warning: could not read BIDS index cache", self.cache_file)
+            return
+        if cache.get("source_dir") == self.source_dir :
+            self.dirs = cache["dirs"]
+
+    def _save_cache(self):
+        if self.cache_file == None or self.n_listed == 0 : return
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir != '' and not os.path.exists(cache_dir) :
+            os.makedirs(cache_dir)
+        tmp_file = self.cache_file + '.tmp' + str(os.getpid())
+        json.dump({"source_dir":self.source_dir, "dirs":self.dirs}, open(tmp_file, 'w'))
+        os.rename(tmp_file, self.cache_file)
+
+    def _scan(self):
+        dirs={}
+        stack=[self.source_dir]
+        while stack != [] :
+            dirname = stack.pop()
+            try :
+                mtime = os.stat(dirname).st_mtime
+            except OSError :
+                continue
+            listing = self.dirs.get(dirname)
+            if listing == None or listing["mtime"] != mtime :
+                listing = _list_dir(dirname, mtime)
+                self.n_listed += 1
+            dirs[dirname] = listing
+            stack += [ dirname + os.sep + d for d in listing["subdirs"] ]
+        self.dirs = dirs
+        if self.verbose >= 1 :
+            print("BIDS index: listed "+str(self.n_listed)+" of "+str(len(dirs))+" directories in "+self.source_dir)
+
+    def _build(self):
+        self.records={}
+        for dirname, listing in self.dirs.items() :
+            datatype = os.path.basename(dirname)
+            for fn in listing["files"] :
+                if not fn.startswith('sub-') : continue
+                entities, suffix, ext = parse_bids_filename(fn)
+                record = { "path":dirname+os.sep+fn, "name":fn, "datatype":datatype, "suffix":suffix, "ext":ext }
+                for key in entity_keys :
+                    record[key] = entities.get(key, '')
+                self.records.setdefault(record["sub"], []).append(record)
+        for records in self.records.values() :
+            records.sort(key=lambda r : r["path"])
+
+    def subjects(self):
+        return sorted(self.records.keys())
+
+    def query(self, sub, datatype=None, suffix=None, ext=None, pattern=None, **entities):
+        '''
+        Return the records for subject <sub> that match <datatype>, <suffix>, <ext> (string or list of strings)
+        and the file name <pattern> (fnmatch-style). Entities that are None or '' are not used to filter files.
+        '''
+        if type(ext) == str : ext = [ext]
+        out=[]
+        for record in self.records.get(sub, []) :
+            if datatype != None and record["datatype"] != datatype : continue
+            if suffix != None and record["suffix"] != suffix : continue
+            if ext != None and not record["ext"] in ext : continue
+            if pattern != None and not fnmatch.fnmatch(record["name"], pattern) : continue
+            skip=False
+            for key, value in entities.items():
+                if value != None and value != '' and record[key] != value :
+                    skip=True
+                    break
+            if not skip :
+                out.append(record)
+        return out
+
+    def unique(self, sub, datatype=None, suffix=None, ext=None, pattern=None, **entities):
+        '''
+        Same as <query>, but returns the path of the only matching file. Returns '' if no file matches and
+        exits if the file is not uniquely specified.
+        '''
+        records = self.query(sub, datatype, suffix, ext, pattern, **entities)
+        if records == [] : return ''
+        if len(records) > 1 :
+            print("Error: files are not uniquely specified. Multiple files found for ", sub, entities)
+            print("You can used --acq and --rec to specify the acquisition and receptor")
+            print([ r["path"] for r in records ])
+            exit(1)
+        return records[0]["path"]
+
+    def sibling(self, path, ext):
+        '''Return the file with the same name as <path> but with extension <ext>, if it is in the index'''
+        entities, suffix, path_ext = parse_bids_filename(path)
+        fn = path[ 0 : len(path) - len(path_ext) ] + ext
+        dirname, name = os.path.split(fn)
+        if name in self.dirs.get(dirname, {"files":[]})["files"] :
+            return fn
+        return ''
+
+
+class IndexedDataSourceOutput(TraitedSpec):
+    pet = File(desc="PET image")
+    json_header = File(desc="PET json header")
+    arterial_file = File(desc="Arterial input file")
+    nativeT1 = File(desc="T1 MRI")
+    xfmT1MNI = File(desc="Transformation from T1 to MNI space")
+    brain_mask_mni = File(desc="Brain mask in MNI space")
+    pvc_label_img = File(desc="Label image for PVC")
+    tka_label_img = File(desc="Label image for TKA")
+    results_label_img = File(desc="Label image for results")
+    pvc_label_template = File(desc="Template for PVC label image")
+    tka_label_template = File(desc="Template for TKA label image")
+    results_label_template = File(desc="Template for results label image")
+
+class IndexedDataSourceInput(BaseInterfaceInputSpec):
+    sid = traits.Str(mandatory=True, desc="Subject ID")
+    ses = traits.Str(mandatory=True, desc="Session ID")
+    task = traits.Str(desc="Task ID")
+    run = traits.Str(desc="Run ID")
+    ses_sub_only = traits.Bool(default_value=False, usedefault=True)
+    files_json = traits.Str(mandatory=True, desc="JSON file with the files of each scan, indexed by scan_key (see save_scan_files)")
+    fields = traits.List(mandatory=True, desc="Output fields that must be found")
+
+class IndexedDataSourceRunning(BaseInterface):
+    '''
+    Replacement for DataGrabber that looks up the files of a scan in the dictionary produced from the BIDS index
+    when the workflow is created, instead of globbing the source directory. The dictionary is read from a file
+    given as a string, so that the hash of each node only depends on its own scan and not on the whole dataset.
+    '''
+    input_spec = IndexedDataSourceInput
+    output_spec = IndexedDataSourceOutput
+
+    def _get_key(self):
+        if self.inputs.ses_sub_only :
+            return scan_key(self.inputs.sid, self.inputs.ses)
+        return scan_key(self.inputs.sid, self.inputs.ses, self.inputs.task, self.inputs.run)
+
+    def _get_files(self):
+        return json.load(open(self.inputs.files_json, 'r')).get(self._get_key(), {})
+
+    def _run_interface(self, runtime):
+        files = self._get_files()
+        for field in self.inputs.fields :
+            if files.get(field, '') == '' :
+                raise IOError("Could not find "+field+" for "+self._get_key())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        files = self._get_files()
+        for field in self.inputs.fields :
+            outputs[field] = files[field]
+        return outputs
+
@@ -1,9 +1,16 @@
 import os
+import re
 import numpy as np
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
 
-from nipype.interfaces.base import CommandLine, CommandLineInputSpec
+from nipype.interfaces.base import CommandLine, CommandLineInputSpec, BaseInterface, BaseInterfaceInputSpec
 from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,isdefined)
 
+try :
+    import numexpr
+except ImportError :
+    numexpr = None
+
 
 
 
@@ -43,3 +50,228 @@ class CalcCommand(CommandLine):
         return None
 
 
+#Functions of minccalc expressions that are supported by both numpy and numexpr
+calc_functions = { 'abs':np.abs, 'sqrt':np.sqrt, 'exp':np.exp, 'log':np.log, 'sin':np.sin, 'cos':np.cos, 'tan':np.tan }
+
+_token_re = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|(A\s*\[\s*\d+\s*\])|([a-zA-Z_]\w*)|(\|\||&&|<=|>=|==|!=|[-+*/^()<>!?:]))')
+
+def _tokenize(expression):
+    tokens=[]
+    pos = 0
+    expression = expression.strip().rstrip(';')
+    while pos < len(expression) :
+        match = _token_re.match(expression, pos)
+        if match == None or match.end() == pos :
+            if expression[pos:].strip() == '' :
+                break
+            print("Error: could not parse expression at: "+expression[pos:])
+            exit(1)
+        tokens.append([ t for t in match.groups() if t != None ][0])
+        pos = match.end()
+    return tokens
+
+class _ExpressionParser():
+    '''
+    Recursive descent parser for the minccalc expressions used in APPIAN (A[i], numbers, arithmetic, ^,
+    comparisons, !, &&, ||, ?: and the functions in calc_functions). The expression is translated into a
+    vectorized expression that is valid for both numpy and numexpr, where each A[i] is the variable A<i>.
+    Like minccalc, logical operators and comparisons return 1 or 0 and any non-zero value is true.
+    '''
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.inputs = set()
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token == None or (expected != None and token != expected) :
+            print("Error: expected "+str(expected)+" but found "+str(token)+" in expression "+' '.join(self.tokens))
+            exit(1)
+        self.pos += 1
+        return token
+
+    def parse(self):
+        out = self.ternary()
+        if self.peek() != None :
+            print("Error: unexpected "+self.peek()+" in expression "+' '.join(self.tokens))
+            exit(1)
+        return out
+
+    def ternary(self):
+        condition = self.logical_or()
+        if self.peek() == '?' :
+            self.take('?')
+            a = self.ternary()
+            self.take(':')
+            b = self.ternary()
+            return 'where((%s) != 0, %s, %s)' % (condition, a, b)
+        return condition
+
+    def logical_or(self):
+        out = self.logical_and()
+        while self.peek() == '||' :
+            self.take()
+            out = 'where(((%s) != 0) | ((%s) != 0), 1., 0.)' % (out, self.logical_and())
+        return out
+
+    def logical_and(self):
+        out = self.comparison()
+        while self.peek() == '&&' :
+            self.take()
+            out = 'where(((%s) != 0) & ((%s) != 0), 1., 0.)' % (out, self.comparison())
+        return out
+
+    def comparison(self):
+        out = self.additive()
+        while self.peek() in ['<', '<=', '>', '>=', '==', '!='] :
+            op = self.take()
+            out = 'where((%s) %s (%s), 1., 0.)' % (out, op, self.additive())
+        return out
+
+    def additive(self):
+        out = self.multiplicative()
+        while self.peek() in ['+', '-'] :
+            op = self.take()
+            out = '(%s) %s (%s)' % (out, op, self.multiplicative())
+        return out
+
+    def multiplicative(self):
+        out = self.unary()
+        while self.peek() in ['*', '/'] :
+            op = self.take()
+            out = '(%s) %s (%s)' % (out, op, self.unary())
+        return out
+
+    def unary(self):
+        if self.peek() == '-' :
+            self.take()
+            return '-(%s)' % self.unary()
+        if self.peek() == '+' :
+            self.take()
+            return self.unary()
+        if self.peek() == '!' :
+            self.take()
+            return 'where((%s) == 0, 1., 0.)' % self.unary()
+        return self.power()
+
+    def power(self):
+        out = self.primary()
+        if self.peek() == '^' :
+            self.take()
+            out = '(%s) ** (%s)' % (out, self.unary())
+        return out
+
+    def primary(self):
+        token = self.take()
+        if token == '(' :
+            out = self.ternary()
+            self.take(')')
+            return '(%s)' % out
+        if token.startswith('A') and '[' in token :
+            i = int(re.sub(r'[^0-9]', '', token))
+            self.inputs.add(i)
+            return 'A%d' % i
+        if token in calc_functions :
+            self.take('(')
+            out = self.ternary()
+            self.take(')')
+            return '%s(%s)' % (token, out)
+        try :
+            return repr(float(token))
+        except ValueError :
+            print("Error: unsupported token "+token+" in expression "+' '.join(self.tokens))
+            exit(1)
+
+def compile_expression(expression):
+    '''Return the vectorized translation of a minccalc <expression> and the indices of the inputs it uses'''
+    parser = _ExpressionParser(expression)
+    code = parser.parse()
+    return code, sorted(parser.inputs)
+
+def evaluate_expression(code, arrays, use_numexpr=True):
+    '''Evaluate the translated expression <code> for the input arrays <arrays> (A[i] = arrays[i])'''
+    variables = dict([ ('A%d' % i, a) for i, a in enumerate(arrays) ])
+    if use_numexpr and numexpr != None :
+        return numexpr.evaluate(code, local_dict=variables)
+    namespace = dict(calc_functions)
+    namespace['where'] = np.where
+    namespace.update(variables)
+    return eval(code, {'__builtins__':{}}, namespace)
+
+def calc(input_files, output_file, expression, slab_size=16, use_numexpr=True):
+    '''
+    In-process equivalent of minccalc: evaluate <expression> over the images <input_files>, which must have the
+    same dimensions, and write the result to <output_file>. The inputs used by the expression are read and
+    evaluated in slabs of <slab_size> slices along the first dimension, so that only one slab of each input is
+    in memory at a time. The output is written once, when every slab has been evaluated.
+    '''
+    code, used = compile_expression(expression)
+    for i in used :
+        if i >= len(input_files) :
+            print("Error: expression "+expression+" uses A["+str(i)+"] but only "+str(len(input_files))+" input files were given")
+            exit(1)
+    like = volumeFromFile(input_files[0])
+    sizes = list(like.sizes)
+    like.closeVolume()
+    volumes = [ volumeFromFile(fn) if i in used else None for i, fn in enumerate(input_files) ]
+    for i in used :
+        if list(volumes[i].sizes) != sizes :
+            print("Error: input files of minccalc expression do not have the same dimensions: "+' '.join(input_files))
+            exit(1)
+
+    out = np.zeros(sizes, dtype=np.float64)
+    for first in range(0, sizes[0], slab_size) :
+        start = [first] + [0] * (len(sizes) - 1)
+        count = [min(slab_size, sizes[0] - first)] + sizes[1:]
+        slab = [ None if vol is None else np.array(vol.getHyperslab(start, count), dtype=np.float64).reshape(count) for vol in volumes ]
+        out[first:first+count[0]] = evaluate_expression(code, slab, use_numexpr)
+    for vol in volumes :
+        if not vol is None :
+            vol.closeVolume()
+
+    #Written as float, like minccalc, so that continuous intensities are not quantized (pyminc's default is ubyte)
+    out_vol = volumeLikeFile(input_files[0], output_file, dtype='float', volumeType='float')
+    out_vol.data = out
+    out_vol.writeFile()
+    out_vol.closeVolume()
+    return output_file
+
+class CalcRunningInput(BaseInterfaceInputSpec):
+    input_files = InputMultiPath(File(exists=True), mandatory=True, desc="input images (A[0], A[1], ...)")
+    output_file = File(desc="output image")
+    expression = traits.Str(mandatory=True, desc="minccalc expression")
+    slab_size = traits.Int(usedefault=True, default_value=16, desc="Number of slices evaluated at once")
+    use_numexpr = traits.Bool(usedefault=True, default_value=True, desc="Use numexpr, if it is installed")
+    clobber = traits.Bool(usedefault=True, default_value=True, desc="Overwrite output file")
+
+class CalcRunningOutput(TraitedSpec):
+    output_file = File(exists=True, desc="output image")
+
+class CalcRunning(BaseInterface):
+    '''
+    Drop-in, in-process replacement for nipype.interfaces.minc.Calc (same input_files, output_file and
+    expression inputs), which evaluates the expression with numpy (or numexpr) instead of running minccalc.
+    '''
+    input_spec = CalcRunningInput
+    output_spec = CalcRunningOutput
+    _suffix = "_calc"
+
+    def _gen_output(self):
+        base, ext = os.path.splitext(os.path.basename(self.inputs.input_files[0]))
+        return os.getcwd() + os.sep + base + self._suffix + ext
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.output_file) :
+            self.inputs.output_file = self._gen_output()
+        calc(self.inputs.input_files, self.inputs.output_file, self.inputs.expression, self.inputs.slab_size, self.inputs.use_numexpr)
+        return runtime
+
+    def _list_outputs(self):
+        if not isdefined(self.inputs.output_file) :
+            self.inputs.output_file = self._gen_output()
+        outputs = self.output_spec().get()
+        outputs["output_file"] = self.inputs.output_file
+        return outputs
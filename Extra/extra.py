@@ -12,6 +12,7 @@ import os
 import shutil
 from pyminc.volumes.factory import *
 import numpy as np 
+from Extra.labels import label_index, write_one_hot
 
 
 class copyOutput(TraitedSpec):
@@ -105,37 +106,38 @@ class subject_parameterCommand(BaseInterface ):
 
 
 class separate_mask_labelsOutput(TraitedSpec):
-	out_file=traits.File(argstr="%s", desc="4D label image")
+	out_file=traits.File(argstr="%s", desc="4D label image, or compact label index (.npz)")
 
 class separate_mask_labelsInput(TraitedSpec):
 	in_file=traits.File(argstr="%s", desc="3D label image")
-	out_file=traits.File(argstr="%s", desc="4D label image")
+	out_file=traits.File(argstr="%s", desc="4D label image, or compact label index (.npz)")
+	one_hot=traits.Bool(usedefault=True, default_value=True, desc="Write a 4D volume with one binary frame per label. Otherwise, write the compact label index (see Extra.labels.LabelIndex)")
 
 class separate_mask_labelsCommand(BaseInterface ):
+    '''
+    Separate the labels of a 3D label image, either as a 4D volume with one binary frame per label (for external
+    tools that require it) or as a compact label index, i.e. the voxels of each label, that can be read with
+    Extra.labels.LabelIndex.load and is orders of magnitude smaller than the 4D volume.
+    '''
     input_spec = separate_mask_labelsInput  
     output_spec = separate_mask_labelsOutput
    
     def _run_interface(self, runtime):
-        vol = volumeFromFile(self.inputs.in_file)
-        
-        #-1 because 0 doesn't need to be included
-        n = len(np.unique(vol.data))-1
-        sizes = [n] + list(vol.data.shape)
-        starts = [0] + list(vol.starts)
-        steps = [1] + list(vol.separations)         
+        index = label_index(self.inputs.in_file)
         
         if not isdefined(self.inputs.out_file) :
             self.inputs.out_file = self._gen_outputs(self.inputs.in_file)
-        out = volumeFromDescription(self.inputs.out_file, ["time","zspace","yspace","xspace"], sizes , starts, steps)        
-        for t,i in zip( range(n), np.unique( vol.data )) :
-            out.data[t, vol.data == i ] = 1 
-        
-        out.writeFile()
-        out.closeVolume()
+
+        if self.inputs.one_hot :
+            write_one_hot(index, self.inputs.in_file, self.inputs.out_file)
+        else :
+            index.save(self.inputs.out_file)
 	return(runtime)
 
     def _gen_outputs(self, fn) :
         fn_split = os.path.splitext(fn)
+        if not self.inputs.one_hot :
+            return os.getcwd() + os.sep +  os.path.basename( fn_split[0] ) + "_labels.npz"
         return os.getcwd() + os.sep +  os.path.basename( fn_split[0] ) + "_4d" + fn_split[1]
 
     def _list_outputs(self):
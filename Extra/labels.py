@@ -0,0 +1,235 @@
+import os
+import numpy as np
+import nipype.interfaces.minc as minc
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile, volumeFromDescription
+from Extra.xfm import read_xfm
+from Extra.morphomat import erode_labels
+from Extra.resample import nearest_neighbour_resample, _grid
+
+"""
+.. module:: labels
+    :platform: Unix
+    :synopsis: Module to select, merge and binarize the labels of label images with a lookup table, to prepare
+        label images in the analysis space in a single in-memory pass, and to index the voxels of each label.
+"""
+
+#Voxels whose value is further than this from an integer label are set to 0 (as with the minccalc
+#expressions previously used by Masking.Labels)
+label_tolerance = 0.1
+
+def label_values(data):
+    '''Non-zero integer labels of the label image <data>'''
+    values = np.unique(np.rint(data).astype(int))
+    return [ v for v in values if v != 0 ]
+
+def make_lut(labels, max_label, ones_only=False, merge=None):
+    '''
+    Lookup table (array of size max_label+1) that maps each label value to its output value: the label itself
+    for the selected <labels>, 1 if <ones_only>, merge[label] for labels in the dictionary <merge>, and 0 for
+    all other labels.
+    '''
+    lut = np.zeros(max_label + 1, dtype=np.float32)
+    for label in labels :
+        label = int(round(float(label)))
+        if label < 0 or label > max_label :
+            continue
+        lut[label] = label
+        if merge != None and label in merge :
+            lut[label] = merge[label]
+        if ones_only :
+            lut[label] = 1
+    return lut
+
+def apply_lut(data, lut):
+    '''Map every voxel of <data> through <lut> with a single np.take. Non-integer and out of range values map to 0'''
+    index = np.rint(data).astype(np.int64)
+    valid = (np.abs(data - index) < label_tolerance) & (index >= 0) & (index < lut.shape[0])
+    index[~valid] = 0
+    out = np.take(lut, index)
+    out[~valid] = 0
+    return out
+
+def _read(filename):
+    vol = volumeFromFile(filename)
+    data = np.array(vol.data)
+    shape, affine = _grid(vol, filename)
+    vol.closeVolume()
+    return data, shape, affine
+
+def _write(like_file, out_file, data):
+    #Integer volume type, so that every label value is stored exactly (pyminc's default is ubyte)
+    out = volumeLikeFile(like_file, out_file, dtype='int', volumeType='int', labels=True)
+    out.data = np.rint(data).astype(np.int32)
+    out.writeFile()
+    out.closeVolume()
+    return out_file
+
+def prepare_labels(label_img, out_file, like_file, xfm, labels=[], erode_times=0, ones_only=False, brain_mask=None, tmp_dir=None):
+    '''
+    Fused label preparation: the label image is read once, its <labels> are selected with a lookup table,
+    eroded (label-preserving) <erode_times> times, resampled with nearest neighbour interpolation into the
+    grid of <like_file> with the transformation <xfm>, masked by <brain_mask> and binarized (<ones_only>) in
+    memory. Only <out_file> is written, except for nonlinear transformations, which are applied by
+    mincresample to a temporary image written in <tmp_dir>.
+    '''
+    data, shape, affine = _read(label_img)
+    if labels == [] :
+        labels = label_values(data)
+    max_label = max([ int(round(float(label))) for label in labels ] + [0])
+    data = apply_lut(data, make_lut(labels, max_label)).astype(np.int32)
+    data = erode_labels(data, int(erode_times))
+
+    matrix = read_xfm(xfm)
+    if matrix is not None :
+        like_vol = volumeFromFile(like_file)
+        target_shape, target_affine = _grid(like_vol, like_file)
+        like_vol.closeVolume()
+        out = nearest_neighbour_resample(data, matrix, affine, target_shape, target_affine)
+    else :
+        if tmp_dir == None :
+            tmp_dir = os.path.dirname(os.path.abspath(out_file))
+        selected = _write(label_img, tmp_dir + os.sep + 'labels_selected.mnc', data)
+        run_resample = minc.Resample()
+        run_resample.inputs.input_file = selected
+        run_resample.inputs.output_file = tmp_dir + os.sep + 'labels_resampled.mnc'
+        run_resample.inputs.like = like_file
+        run_resample.inputs.transformation = xfm
+        run_resample.inputs.nearest_neighbour_interpolation = True
+        run_resample.run()
+        out = np.rint(_read(run_resample.inputs.output_file)[0]).astype(np.int32)
+
+    if brain_mask != None :
+        out[ _read(brain_mask)[0] != 1 ] = 0
+    if ones_only :
+        out = (out > 0).astype(np.int32)
+    return _write(like_file, out_file, out)
+
+class LabelIndex():
+    '''
+    Flat voxel indices of each non-zero label of a label image: <indices> holds the voxels sorted by label (and
+    by position within each label) and the voxels of labels[i] are indices[offsets[i]:offsets[i+1]]. Once the
+    index is built, the voxels of a ROI are gathered in O(size of the ROI) instead of scanning the whole volume.
+    '''
+    def __init__(self, labels, offsets, indices, shape):
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.indices = np.asarray(indices)
+        self.shape = tuple([ int(i) for i in shape ])
+
+    @classmethod
+    def build(cls, data):
+        '''Index the label image <data>. Voxels that are not within label_tolerance of an integer are ignored'''
+        data = np.asarray(data)
+        flat = np.rint(data).astype(np.int64).ravel()
+        flat[ np.abs(data.ravel() - flat) >= label_tolerance ] = 0
+        voxels = np.flatnonzero(flat)
+        #Stable sort, so that the voxels of each label stay in increasing order
+        order = voxels[ np.argsort(flat[voxels], kind='mergesort') ]
+        labels, starts = np.unique(flat[order], return_index=True)
+        offsets = np.append(starts, order.shape[0])
+        dtype = np.int32 if flat.shape[0] < np.iinfo(np.int32).max else np.int64
+        return cls(labels, offsets, order.astype(dtype), data.shape)
+
+    def voxels(self, label):
+        '''Flat indices of the voxels of <label> (empty if the label is not in the image)'''
+        i = np.searchsorted(self.labels, int(round(float(label))))
+        if i >= self.labels.shape[0] or self.labels[i] != int(round(float(label))) :
+            return self.indices[0:0]
+        return self.indices[self.offsets[i]:self.offsets[i+1]]
+
+    def mask_voxels(self):
+        '''Flat indices of the voxels of all positive labels, i.e., of the voxels of the image seen as a mask'''
+        i = np.searchsorted(self.labels, 1)
+        return self.indices[self.offsets[i]:]
+
+    def gather(self, data, label=None):
+        '''Values of <data> (same shape as the label image) in <label>, or in the mask if <label> is None'''
+        voxels = self.mask_voxels() if label == None else self.voxels(label)
+        return np.asarray(data).reshape(-1)[voxels]
+
+    def save(self, filename, stamp=None):
+        np.savez(filename, labels=self.labels, offsets=self.offsets, indices=self.indices, shape=np.array(self.shape), stamp=np.array(stamp if stamp != None else []))
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        f = np.load(filename)
+        index = cls(f['labels'], f['offsets'], f['indices'], f['shape'])
+        index.stamp = list(f['stamp'])
+        f.close()
+        return index
+
+#Label indices already built or loaded by this process, by label image
+_label_index_cache={}
+
+def label_index_file(filename):
+    '''File in which the index of the label image <filename> is saved, next to the image'''
+    return os.path.splitext(os.path.abspath(filename))[0] + '_label_index.npz'
+
+def label_index(filename):
+    '''
+    LabelIndex of the label image <filename>. The index is built once per label image and saved next to it, so
+    that every stage that uses the same label image reuses it. A saved index is only used if the size and the
+    modification time of the image have not changed since it was built.
+    '''
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    stamp = [float(stat.st_size), float(stat.st_mtime)]
+    key = (filename, stamp[0], stamp[1])
+    if key in _label_index_cache :
+        return _label_index_cache[key]
+
+    index_file = label_index_file(filename)
+    index = None
+    if os.path.exists(index_file) :
+        try :
+            index = LabelIndex.load(index_file)
+            if index.stamp != stamp :
+                index = None
+        except (IOError, KeyError, ValueError) :
+            index = None
+
+    if index is None :
+        vol = volumeFromFile(filename)
+        index = LabelIndex.build(np.array(vol.data))
+        vol.closeVolume()
+        try :
+            #Written under a temporary name and renamed, so that concurrent stages never read a partial index
+            tmp_file = index_file[:-len('.npz')] + '_' + str(os.getpid()) + '.npz'
+            index.save(tmp_file, stamp)
+            os.rename(tmp_file, index_file)
+        except (IOError, OSError) :
+            #e.g., read-only input directory: the index is only kept in memory
+            pass
+    _label_index_cache[key] = index
+    return index
+
+def one_hot_frames(index):
+    '''Binary frame of each label of the LabelIndex <index>, built and yielded one label at a time'''
+    for label in index.labels :
+        frame = np.zeros(int(np.prod(index.shape)), dtype=np.uint8)
+        frame[index.voxels(label)] = 1
+        yield label, frame.reshape(index.shape)
+
+def write_one_hot(index, like_file, out_file):
+    '''
+    Expand the LabelIndex <index> into a 4D volume with one binary frame per label, in the grid of the label image
+    <like_file>. Only needed for external tools that require one-hot masks (e.g., 4D masks of PETPVC).
+    The whole 4D volume is held in memory (as uint8) before it is written; consumers that only need the
+    frames should iterate over one_hot_frames instead.
+    '''
+    like = volumeFromFile(like_file)
+    sizes = [index.labels.shape[0]] + list(index.shape)
+    starts = [0] + list(like.starts)
+    steps = [1] + list(like.separations)
+    dimnames = ["time"] + list(like.dimnames)
+    like.closeVolume()
+
+    data = np.zeros(sizes, dtype=np.uint8)
+    for t, (label, frame) in enumerate(one_hot_frames(index)) :
+        data[t] = frame
+    out = volumeFromDescription(out_file, dimnames, sizes, starts, steps)
+    out.data = data
+    out.writeFile()
+    out.closeVolume()
+    return out_file
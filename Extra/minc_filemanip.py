@@ -35,3 +35,14 @@ def update_minchd_json(filename, data_in, var, attr):
     fp = file(filename, 'w')
     json.dump(data, fp, sort_keys=True, indent=4)
     fp.close()
+
+def file_md5(filename, block_size=2**20):
+    '''Return the md5 hex digest of the contents of <filename>'''
+    h = md5()
+    fp = open(filename, 'rb')
+    block = fp.read(block_size)
+    while block :
+        h.update(block)
+        block = fp.read(block_size)
+    fp.close()
+    return h.hexdigest()
@@ -1,11 +1,13 @@
 from glob import glob
-from Extra.nii2mnc_batch import find
+from Extra.nii2mnc_batch import find_files, run_jobs, Manifest
 from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath, 
         BaseInterface, OutputMultiPath, BaseInterfaceInputSpec, isdefined)
 import os
 from re import sub
 from Extra.info import  mincinfoCommand
 import json
+import h5py
+import numpy as np
 
 def stdout_to_list( stdout ):
     time_list=[]
@@ -25,6 +27,72 @@ def stdout_to_list( stdout ):
     time_list += [time_value]
     return time_list
 
+def _to_python(value):
+    '''Convert HDF5 attribute values to types that can be written to json'''
+    if isinstance(value, np.ndarray) :
+        value = value.tolist()
+        if type(value) == list :
+            value = [ _to_python(v) for v in value ]
+            if len(value) == 1 : value = value[0]
+        else :
+            value = _to_python(value)
+    elif isinstance(value, np.generic) :
+        value = _to_python(value.item())
+    if isinstance(value, bytes) :
+        value = value.decode('latin-1')
+    if isinstance(value, type(u'')) :
+        value = value.rstrip(u'\x00')
+    return value
+
+def read_minc2_header(filename):
+    '''
+    Read the header of a MINC2 (HDF5) file in a single pass.
+
+    Returns a dictionary {variable : {attribute : value}} with the attributes of the dimensions 
+    (e.g., xspace, time), of the info variables (e.g., acquisition, patient) and of the image. 
+    For the time dimension, the start time ("values") and duration ("widths") of each frame are 
+    also added. Returns None if the file is not a MINC2 file (e.g., MINC1).
+    '''
+    if not h5py.is_hdf5(filename) :
+        return None
+
+    header={}
+    f = h5py.File(filename, 'r')
+    root = f['minc-2.0']
+    for group in ['dimensions', 'info'] :
+        if not group in root : continue
+        for name, obj in root[group].items() :
+            header[str(name)] = dict([ (str(k), _to_python(v)) for k, v in obj.attrs.items() ])
+    if 'image/0/image' in root :
+        header['image'] = dict([ (str(k), _to_python(v)) for k, v in root['image/0/image'].attrs.items() ])
+
+    if 'time' in header :
+        time = header['time']
+        n = int(time.get('length', root['dimensions/time'].size))
+        if time.get('spacing', 'regular__') == 'irregular' and root['dimensions/time'].size == n :
+            values = np.array(root['dimensions/time'][...], dtype=float).reshape(-1)
+        else :
+            values = float(time.get('start', 0)) + float(time.get('step', 1)) * np.arange(n)
+        if 'time-width' in root['dimensions'] and root['dimensions/time-width'].size == n :
+            widths = np.array(root['dimensions/time-width'][...], dtype=float).reshape(-1)
+        else :
+            widths = np.repeat(abs(float(time.get('width', time.get('step', 1)))), n)
+        time['values'] = values.tolist()
+        time['widths'] = widths.tolist()
+    f.close()
+    return header
+
+def minc2_header_to_json(header):
+    '''Create the BIDS-style header (Info, Time:FrameTimes) from the output of read_minc2_header'''
+    out_dict={}
+    acquisition = header.get('acquisition', {})
+    out_dict["Info"]={"Isotope":acquisition.get('radionuclide','unknown'),"Halflife":acquisition.get('radionuclide_halflife','unknown')}
+    out_dict["Time"]={"FrameTimes":{}}
+    unit = header['time'].get('units', 'unknown')
+    out_dict["Time"]["FrameTimes"]["Units"]=[unit, unit]
+    out_dict["Time"]["FrameTimes"]["Values"]=[ [t0, t0+w] for t0, w in zip(header['time']['values'], header['time']['widths']) ]
+    return out_dict
+
 class CreateHeaderOutput(TraitedSpec):
     output_file = traits.Str(desc="Ouput .json file")
 
@@ -43,11 +111,28 @@ class CreateHeaderRunning(BaseInterface):
     def _run_interface(self, runtime):
         pet=self.inputs.input_file
         self.inputs.output_file = self._gen_output(self.inputs.input_file)
-        exit_flag=False
+        #Errors are raised rather than exiting, since headers are created in the workers of a process pool
         if not os.path.exists(pet) :
-            print("Error: Could not find file $pet")
-            exit(1)
-        
+            raise RuntimeError("Error: Could not find file "+pet)
+
+        header = read_minc2_header(pet)
+        if header != None and 'time' in header :
+            for var in ['radionuclide', 'radionuclide_halflife'] :
+                if not var in header.get('acquisition', {}) :
+                    print("Warning: could not find variable <acquisition:"+var+'> in '+ pet )
+            out_dict = minc2_header_to_json(header)
+        elif header != None :
+            raise RuntimeError("Error: Could not find requisite variables from MINC file "+self.inputs.input_file)
+        else :
+            #MINC1 files can only be read with mincinfo
+            out_dict = self._mincinfo_header()
+
+        with open(self.inputs.output_file, 'w') as fp:
+            json.dump(out_dict, fp)
+        return runtime
+
+    def _mincinfo_header(self):
+        exit_flag=False
         options=[
                 ('acquisition','radionuclide', '-attvalue', False),
                 ('acquisition','radionuclide_halflife', '-attvalue ', False),
@@ -88,12 +173,9 @@ class CreateHeaderRunning(BaseInterface):
             time_list.append( [t0,t1] )
              
         out_dict["Time"]["FrameTimes"]["Values"]=time_list
-        with open(self.inputs.output_file, 'w') as fp:
-            json.dump(out_dict, fp)
         if exit_flag : 
-            print("Error: Could not find requisite variables from MINC file "+self.inputs.input_file)
-            exit(1)
-        return runtime
+            raise RuntimeError("Error: Could not find requisite variables from MINC file "+self.inputs.input_file)
+        return out_dict
    
     def _gen_output(self, input_file):
         split = os.path.splitext(input_file)
@@ -107,15 +189,26 @@ class CreateHeaderRunning(BaseInterface):
         outputs["output_file"]= self.inputs.output_file
         return outputs
 
-def create_minc_headers(source_dir, clobber=False):
-    pet_list = find(source_dir, "*_pet.mnc" )
+def create_header(job):
+    pet, out_fn = job
+    create_json = CreateHeaderRunning()
+    create_json.inputs.input_file = pet
+    create_json.inputs.output_file = out_fn
+    create_json.run()
+    return pet, out_fn
+
+def create_minc_headers(source_dir, clobber=False, num_threads=1, manifest_file=None):
+    manifest = Manifest(manifest_file)
+    pet_list = find_files(source_dir, ["*_pet.mnc"])["*_pet.mnc"]
    
+    jobs=[]
     for pet in pet_list :
         out_fn=sub('.nii', '', sub('.gz', '', sub('.mnc','',pet))) + '.json'
-        if not os.path.exists(out_fn) or clobber :
-            create_json = CreateHeaderRunning()
-            create_json.inputs.input_file = pet
-            create_json.inputs.output_file = out_fn
-            create_json.run()
-    
-    
+        if clobber or not manifest.unchanged(pet, out_fn) :
+            jobs.append( (pet, out_fn) )
+
+    try :
+        for pet, out_fn in run_jobs(create_header, jobs, num_threads) :
+            manifest.update(pet, out_fn)
+    finally :
+        manifest.save()
@@ -1,9 +1,70 @@
 import os
 import numpy as np
+from scipy.ndimage.morphology import generate_binary_structure, iterate_structure, grey_dilation
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
 
 from nipype.interfaces.base import CommandLine, CommandLineInputSpec
 from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,isdefined)
 
+#Connectivity of the structuring elements, as with the -3D06 (default) and -3D26 kernels of mincmorph
+connectivity_rank = { 6:1, 18:2, 26:3 }
+
+def structuring_element(iterations=1, connectivity=6):
+    '''Structuring element equivalent to <iterations> successive operations with the 3D <connectivity> kernel'''
+    element = generate_binary_structure(3, connectivity_rank[connectivity])
+    if iterations > 1 :
+        element = iterate_structure(element, iterations)
+    return element
+
+def _offsets(element):
+    center = np.array(element.shape) // 2
+    return [ tuple(o) for o in np.argwhere(element) - center if np.any(o != 0) ]
+
+def _shifted(data, offset, fill=0):
+    '''<data> shifted by <offset> voxels (out[i] = data[i+offset]), with <fill> outside of the volume'''
+    out = np.empty_like(data)
+    out[...] = fill
+    src = tuple([ slice(max(o, 0), data.shape[d] + min(o, 0)) for d, o in enumerate(offset) ])
+    dst = tuple([ slice(max(-o, 0), data.shape[d] + min(-o, 0)) for d, o in enumerate(offset) ])
+    out[dst] = data[src]
+    return out
+
+def erode_labels(data, iterations=1, connectivity=6):
+    '''
+    Label-preserving erosion: every label is eroded independently, in a single pass, with the structuring
+    element of <iterations> successive erosions. A voxel keeps its label only if all the voxels of the
+    structuring element around it have the same label. Binary masks are eroded as usual.
+    '''
+    if iterations <= 0 :
+        return data
+    keep = data != 0
+    for offset in _offsets(structuring_element(iterations, connectivity)) :
+        keep &= _shifted(data, offset) == data
+    return np.where(keep, data, 0).astype(data.dtype)
+
+def dilate_labels(data, iterations=1, connectivity=6):
+    '''Dilate the labels of <data> into the background (voxels equal to 0); labelled voxels are unchanged'''
+    if iterations <= 0 :
+        return data
+    dilated = grey_dilation(data, footprint=structuring_element(iterations, connectivity), mode='constant', cval=0)
+    return np.where(data == 0, dilated, data).astype(data.dtype)
+
+def morph_file(in_file, out_file, operation='erode', iterations=1, connectivity=6):
+    '''In-process replacement of mincmorph -successive with <iterations> erosions ("erode") or dilations ("dilate")'''
+    vol = volumeFromFile(in_file)
+    data = np.array(vol.data)
+    vol.closeVolume()
+    if operation == 'erode' :
+        data = erode_labels(data, iterations, connectivity)
+    else :
+        data = dilate_labels(data, iterations, connectivity)
+    #Integer volume type, so that every label value is stored exactly (pyminc's default is ubyte)
+    out = volumeLikeFile(in_file, out_file, dtype='int', volumeType='int', labels=True)
+    out.data = np.rint(data).astype(np.int32)
+    out.writeFile()
+    out.closeVolume()
+    return out_file
+
 
 
 
@@ -10,6 +10,9 @@ import fnmatch
 import re
 import gzip
 import shutil
+import json
+import numpy as np
+from multiprocessing import Pool
 
 
 def find(src, match):
@@ -19,30 +22,124 @@ def find(src, match):
             matches.append(os.path.join(root, filename))
     return(matches)
 
-def nii2mnc_batch(opts, clobber=False):
-    for sub in opts.args :
-        for ses in opts.sessionList :
-            sub_ses_dir = opts.sourceDir + os.sep + 'sub-' + sub + os.sep + '*ses-'+ses
-            t1_files = find(sub_ses_dir, "*_T1w.nii*") 
-            derived_files = [ f for f in find(sub_ses_dir, "*nii*") if f not in t1_files and 'anat/' in f ]
-            pet_files = find(sub_ses_dir, "*_pet.nii*")
-            nii_files = t1_files + derived_files + pet_files
-
-            for f in nii_files :
-                f_out_mnc = re.sub('.gz', '', re.sub( '.nii', '.mnc', f) )
-                if not os.path.exists(f_out_mnc) or clobber :
-                    nii2mnc = nii2mnc2Command()
-                    nii2mnc.inputs.in_file = f
-                    
-                    #For t1 and pet files, set data type to float
-                    #otherwise int for label images
-                    if f in t1_files + pet_files :
-                        nii2mnc.inputs.dfloat = True
-                    else :
-                        nii2mnc.inputs.dint = True
-
-                    nii2mnc.inputs.out_file=f_out_mnc
-                    nii2mnc.run()
+def find_files(src, matches):
+    '''
+    Walk <src> once and return a dictionary with the list of files that match each pattern in <matches>
+    '''
+    out = dict([ (match, []) for match in matches ])
+    for root, dirnames, filenames in os.walk(src):
+        for match in matches :
+            out[match] += [ os.path.join(root, filename) for filename in fnmatch.filter(filenames, match) ]
+    return out
+
+class Manifest():
+    '''
+    Record of the source files that have already been converted, with their size, mtime and output file.
+    A source file is skipped on later runs if it has not changed and its output still exists.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        if filename != None and os.path.exists(filename) :
+            try :
+                self.entries = json.load(open(filename, 'r'))
+            except ValueError :
+                print("Warning: could not read manifest", filename)
+
+    def _stat(self, src):
+        st = os.stat(src)
+        return { "size":st.st_size, "mtime":st.st_mtime }
+
+    def unchanged(self, src, out):
+        if not os.path.exists(out) : return False
+        entry = self.entries.get(src)
+        if entry == None :
+            #Outputs created before the manifest existed are kept if they are newer than their source
+            if os.stat(out).st_mtime >= os.stat(src).st_mtime :
+                self.update(src, out)
+                return True
+            return False
+        return entry["output"] == out and entry["size"] == os.stat(src).st_size and entry["mtime"] == os.stat(src).st_mtime
+
+    def update(self, src, out):
+        entry = self._stat(src)
+        entry["output"] = out
+        self.entries[src] = entry
+
+    def save(self):
+        if self.filename == None : return
+        dirname = os.path.dirname(self.filename)
+        if dirname != '' and not os.path.exists(dirname) :
+            os.makedirs(dirname)
+        tmp_fn = self.filename + '.tmp' + str(os.getpid())
+        json.dump(self.entries, open(tmp_fn, 'w'), indent=1)
+        os.rename(tmp_fn, self.filename)
+
+def init_worker():
+    #Forked workers inherit the random state of the parent, which is used to name temporary files
+    np.random.seed()
+
+def run_jobs(function, jobs, num_threads=1):
+    '''
+    Run function(job) for each job, using a process pool if num_threads > 1. Yields the output of each job as
+    soon as it is done, so that the caller can record finished jobs even if a later job fails. Jobs must raise
+    exceptions rather than call exit(), which would leave the pool waiting forever for their result.
+    '''
+    if num_threads > 1 and len(jobs) > 1 :
+        pool = Pool(min(num_threads, len(jobs)), init_worker)
+        try :
+            for out in pool.imap_unordered(function, jobs, chunksize=1) :
+                yield out
+        finally :
+            pool.terminate()
+            pool.join()
+    else :
+        for job in jobs :
+            yield function(job)
+
+def convert_nii(job):
+    f, f_out_mnc, dfloat = job
+    nii2mnc = nii2mnc2Command()
+    nii2mnc.inputs.in_file = f
+    
+    #For t1 and pet files, set data type to float
+    #otherwise int for label images
+    if dfloat :
+        nii2mnc.inputs.dfloat = True
+    else :
+        nii2mnc.inputs.dint = True
+
+    nii2mnc.inputs.out_file=f_out_mnc
+    nii2mnc.run()
+    return f, f_out_mnc
+
+def nii2mnc_batch(opts, clobber=False, manifest_file=None):
+    manifest = Manifest(manifest_file)
+    session_list = opts.sessionList if len(opts.sessionList) > 0 else ['*']
+    all_files = find_files(opts.sourceDir, ["*_T1w.nii*", "*_pet.nii*", "*nii*"] )
+
+    def selected(f) :
+        path = os.path.relpath(f, opts.sourceDir).split(os.sep)
+        if len(path) < 3 or not path[0] in [ 'sub-'+sub for sub in opts.args ] : 
+            return False
+        return True in [ fnmatch.fnmatch(path[1], '*ses-'+ses) for ses in session_list ]
+
+    t1_files = [ f for f in all_files["*_T1w.nii*"] if selected(f) ] 
+    derived_files = [ f for f in all_files["*nii*"] if selected(f) and f not in t1_files and 'anat/' in f ]
+    pet_files = [ f for f in all_files["*_pet.nii*"] if selected(f) ]
+    nii_files = t1_files + derived_files + pet_files
+
+    jobs=[]
+    for f in nii_files :
+        f_out_mnc = re.sub('.gz', '', re.sub( '.nii', '.mnc', f) )
+        if clobber or not manifest.unchanged(f, f_out_mnc) :
+            jobs.append( (f, f_out_mnc, f in t1_files + pet_files) )
+
+    try :
+        for f, f_out_mnc in run_jobs(convert_nii, jobs, opts.num_threads) :
+            manifest.update(f, f_out_mnc)
+    finally :
+        manifest.save()
                     
 
 if __name__ == '__main__' : 
@@ -0,0 +1,109 @@
+import os
+import json
+import numpy as np
+
+"""
+.. module:: pet_header
+    :platform: Unix
+    :synopsis: Module to parse the PET json header once and share the frame times between the stages of APPIAN.
+"""
+
+#Conversion factors from the units of Time:FrameTimes:Units to seconds. Same aliases as minc_json_header.sh
+time_units = {}
+for _unit in ['s', 'sec', 'secs', 'second', 'seconds'] : time_units[_unit] = 1.
+for _unit in ['m', 'min', 'mins', 'minute', 'minutes'] : time_units[_unit] = 60.
+for _unit in ['h', 'hr', 'hrs', 'hour', 'hours'] : time_units[_unit] = 60.*60.
+
+#Header section where the canonical frame times are stored by the initialization workflow
+section = "PETHeader"
+
+_cache = {}
+
+def _to_seconds(values, unit, header_file=''):
+    factor = time_units.get(str(unit).strip().lower())
+    if factor == None :
+        #Same as the previous frame duration calculation, which treated any other unit as seconds
+        print("Warning: unrecognized time units "+str(unit)+" in "+str(header_file)+", assuming seconds")
+        factor = 1.
+    return np.array(values, dtype=float) * factor
+
+def has_frame_times(header_file):
+    '''True if the frame times of <header_file> are numbers (they can be, e.g., "unknown")'''
+    header = json.load(open(header_file, "r"))
+    if section in header :
+        return True
+    try :
+        np.array(header["Time"]["FrameTimes"]["Values"], dtype=float)
+    except (KeyError, ValueError, TypeError) :
+        return False
+    return True
+
+class PETHeader():
+    '''
+    Frame times of a PET scan in canonical units (seconds), stored as numpy arrays.
+
+    The header is parsed once, by the initialization workflow, which stores the canonical frame times in
+    the <PETHeader> section of the json header that is passed between nodes. Downstream nodes use
+    PETHeader.load(), which reads that section (falling back to parsing Time:FrameTimes for older headers)
+    and caches the result by file name and modification time.
+    '''
+    def __init__(self, frame_start, frame_end, halflife=None, header={}):
+        self.frame_start = np.array(frame_start, dtype=float)
+        self.frame_end = np.array(frame_end, dtype=float)
+        self.halflife = halflife
+        self.header = header
+
+    @property
+    def duration(self):
+        return self.frame_end - self.frame_start
+
+    @property
+    def mid(self):
+        return (self.frame_start + self.frame_end) / 2.
+
+    @property
+    def n_frames(self):
+        return self.frame_start.shape[0]
+
+    def window(self, start_time=None, end_time=None):
+        '''Boolean mask of the frames that are within [start_time, end_time] (in seconds)'''
+        mask = np.ones(self.n_frames, dtype=bool)
+        if start_time != None : mask &= self.frame_start >= start_time
+        if end_time != None : mask &= self.frame_end <= end_time
+        return mask
+
+    def to_dict(self):
+        return { "FrameStart":self.frame_start.tolist(), "FrameEnd":self.frame_end.tolist(), "Units":"s", "Halflife":self.halflife }
+
+    @classmethod
+    def from_dict(cls, header, header_file=''):
+        '''Create a PETHeader from a BIDS-style header dictionary'''
+        if section in header :
+            d = header[section]
+            return cls(d["FrameStart"], d["FrameEnd"], d.get("Halflife"), header)
+        try :
+            frame_times = np.array(header["Time"]["FrameTimes"]["Values"], dtype=float).reshape(-1, 2)
+            units = header["Time"]["FrameTimes"]["Units"]
+        except (KeyError, ValueError) :
+            print("Error: Could not find Time:FrameTimes:Values and Units in header "+str(header_file))
+            exit(1)
+        frame_start = _to_seconds(frame_times[:,0], units[0], header_file)
+        frame_end = _to_seconds(frame_times[:,1], units[1], header_file)
+        halflife=None
+        try :
+            halflife = float(header["acquisition"]["radionuclide_halflife"])
+        except (KeyError, ValueError, TypeError) :
+            pass
+        return cls(frame_start, frame_end, halflife, header)
+
+    @classmethod
+    def from_json(cls, header_file):
+        return cls.from_dict(json.load(open(header_file, "r")), header_file)
+
+    @classmethod
+    def load(cls, header_file):
+        '''Return the PETHeader of <header_file>, reading the file only if it has changed since it was last read'''
+        key = (os.path.abspath(header_file), os.stat(header_file).st_mtime)
+        if not key in _cache :
+            _cache[key] = cls.from_json(header_file)
+        return _cache[key]
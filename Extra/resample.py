@@ -1,8 +1,14 @@
 import os, ntpath
 import numpy as np
 import re
-from nipype.interfaces.base import CommandLine, CommandLineInputSpec, BaseInterface
+import h5py
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from pyminc.volumes.factory import volumeFromFile, volumeFromDescription
+import nipype.interfaces.minc as minc
+from nipype.interfaces.base import CommandLine, CommandLineInputSpec, BaseInterface, BaseInterfaceInputSpec
 from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,isdefined)
+from Extra.xfm import read_xfm, voxel_to_world, apply_matrix, spatial_dims, _direction_cosines
 
 class ResampleOutput(TraitedSpec):
 #    out_file = File(exists=True, desc="resampled image")
@@ -165,3 +171,201 @@ class param2xfmInterfaceCommand(BaseInterface):
         #    self.inputs.out_file = self._gen_output(self.inputs.params)
         outputs["out_file"] = self.inputs.out_file
         return outputs
+
+
+#Sampling coordinates computed in this process, indexed by (transformation, source grid, target grid). Each
+#entry holds per-voxel indices and weights, so only the most recently used ones are kept
+_sampling_cache = OrderedDict()
+_sampling_cache_size = 2
+
+def _grid(vol, filename):
+    dims = [ d for d in vol.dimnames if d in spatial_dims ]
+    shape = tuple([ vol.sizes[vol.dimnames.index(d)] for d in dims ])
+    return shape, voxel_to_world(vol, filename)
+
+class TrilinearSampling():
+    '''
+    Trilinear sampling of a source grid at the voxels of a target grid, for a linear transformation from
+    source to target world coordinates. For each target voxel, the flat index of the lower corner of the
+    source cell and the fractional position in the cell are computed once, and can then be applied to any
+    number of images (e.g., the frames of a dynamic PET image) that share the source grid.
+    '''
+    def __init__(self, matrix, source_shape, source_affine, target_shape, target_affine):
+        self.source_shape = source_shape
+        self.target_shape = target_shape
+        target_to_source = np.dot(np.linalg.inv(source_affine), np.dot(np.linalg.inv(matrix), target_affine))
+        strides = np.array([ source_shape[1]*source_shape[2], source_shape[2], 1 ])
+        size = np.array(source_shape).reshape(3,1)
+
+        #Computed one target slice at a time, to limit the memory used for the coordinates
+        n = target_shape[1] * target_shape[2]
+        self.base = np.zeros(target_shape[0] * n, dtype=np.int64)
+        self.fraction = np.zeros((3, target_shape[0] * n), dtype=np.float32)
+        self.valid = np.zeros(target_shape[0] * n, dtype=bool)
+        idx = np.indices((1,) + tuple(target_shape[1:])).reshape(3,-1).astype(float)
+        for k in range(target_shape[0]) :
+            idx[0,:] = k
+            coords = apply_matrix(target_to_source, idx)
+            corner = np.clip(np.floor(coords), 0, np.maximum(size - 2, 0)).astype(np.int64)
+            self.valid[k*n:(k+1)*n] = np.all((coords >= 0) & (coords <= size - 1), axis=0)
+            self.fraction[:, k*n:(k+1)*n] = np.clip(coords - corner, 0, 1)
+            self.base[k*n:(k+1)*n] = np.dot(strides, corner)
+
+        #Offset to the upper corner along each axis (0 for axes with a single voxel)
+        self.offsets = [ strides[i] if source_shape[i] > 1 else 0 for i in range(3) ]
+
+    def apply(self, data):
+        flat = data.reshape(-1)
+        fz, fy, fx = self.fraction
+        oz, oy, ox = self.offsets
+        out = np.zeros(self.base.shape, dtype=np.float32)
+        for dz, wz in [(0, 1-fz), (oz, fz)] :
+            for dy, wy in [(0, 1-fy), (oy, fy)] :
+                for dx, wx in [(0, 1-fx), (ox, fx)] :
+                    out += wz * wy * wx * flat[self.base + dz + dy + dx]
+        out[~self.valid] = 0
+        return out.reshape(self.target_shape)
+
+def nearest_neighbour_resample(data, matrix, source_affine, target_shape, target_affine):
+    '''
+    Nearest neighbour resampling of the 3D array <data> into the target grid, for the linear transformation
+    <matrix> from source to target world coordinates. Voxels outside of the source are set to 0.
+    '''
+    target_to_source = np.dot(np.linalg.inv(source_affine), np.dot(np.linalg.inv(matrix), target_affine))
+    size = np.array(data.shape).reshape(3,1)
+    out = np.zeros(target_shape, dtype=data.dtype)
+    idx = np.indices((1,) + tuple(target_shape[1:])).reshape(3,-1).astype(float)
+    for k in range(target_shape[0]) :
+        idx[0,:] = k
+        coords = np.rint(apply_matrix(target_to_source, idx)).astype(np.int64)
+        valid = np.all((coords >= 0) & (coords < size), axis=0)
+        values = np.zeros(coords.shape[1], dtype=data.dtype)
+        values[valid] = data[coords[0,valid], coords[1,valid], coords[2,valid]]
+        out[k] = values.reshape(target_shape[1:])
+    return out
+
+def get_sampling(matrix, source_shape, source_affine, target_shape, target_affine):
+    key = (matrix.tostring(), source_shape, source_affine.tostring(), target_shape, target_affine.tostring())
+    if key in _sampling_cache :
+        sampling = _sampling_cache.pop(key)
+    else :
+        sampling = TrilinearSampling(matrix, source_shape, source_affine, target_shape, target_affine)
+    _sampling_cache[key] = sampling
+    while len(_sampling_cache) > _sampling_cache_size :
+        _sampling_cache.popitem(last=False)
+    return sampling
+
+def _copy_time_dimension(in_file, out_file):
+    '''Copy the frame times and widths of <in_file> to <out_file>, which may not be regularly sampled'''
+    if not h5py.is_hdf5(in_file) or not h5py.is_hdf5(out_file) :
+        return
+    src = h5py.File(in_file, 'r')
+    dst = h5py.File(out_file, 'r+')
+    for dim in ['time', 'time-width'] :
+        if dim in src['minc-2.0/dimensions'] :
+            if dim in dst['minc-2.0/dimensions'] :
+                del dst['minc-2.0/dimensions/'+dim]
+            src.copy('minc-2.0/dimensions/'+dim, dst['minc-2.0/dimensions'], dim)
+    src.close()
+    dst.close()
+
+class NativeResampleOutput(TraitedSpec):
+    output_file = File(desc="resampled image")
+
+class NativeResampleInput(BaseInterfaceInputSpec):
+    input_file = File(exists=True, mandatory=True, desc="image to resample (3D or 4D)")
+    like = File(exists=True, mandatory=True, desc="image with the sampling of the output image")
+    transformation = File(exists=True, mandatory=True, desc="transformation from input to output image")
+    output_file = File(desc="resampled image")
+    keep_real_range = traits.Bool(usedefault=True, default_value=True, desc="Keep the real range of the input image")
+    tricubic_interpolation = traits.Bool(desc="Use tricubic interpolation (only used with mincresample)")
+    num_threads = traits.Int(usedefault=True, default_value=1, desc="Number of frames resampled in parallel")
+
+class NativeResampleRunning(BaseInterface):
+    '''
+    In-process alternative to minc.Resample for linear transformations. The trilinear sampling coordinates
+    are computed once and applied to every frame, with the frames resampled in parallel. Nonlinear
+    transformations are resampled with mincresample.
+    '''
+    input_spec = NativeResampleInput
+    output_spec = NativeResampleOutput
+    _suffix = "_resampled"
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.output_file) :
+            self.inputs.output_file = self._gen_output(self.inputs.input_file)
+
+        matrix = read_xfm(self.inputs.transformation)
+        if matrix is None :
+            run_resample = minc.Resample()
+            run_resample.inputs.input_file = self.inputs.input_file
+            run_resample.inputs.like = self.inputs.like
+            run_resample.inputs.transformation = self.inputs.transformation
+            run_resample.inputs.output_file = self.inputs.output_file
+            run_resample.inputs.keep_real_range = self.inputs.keep_real_range
+            if isdefined(self.inputs.tricubic_interpolation) :
+                run_resample.inputs.tricubic_interpolation = self.inputs.tricubic_interpolation
+            print(run_resample.cmdline)
+            run_resample.run()
+            return runtime
+
+        like = volumeFromFile(self.inputs.like)
+        target_shape, target_affine = _grid(like, self.inputs.like)
+        target_dims = [ d for d in like.dimnames if d in spatial_dims ]
+        target_starts = [ like.starts[like.dimnames.index(d)] for d in target_dims ]
+        target_steps = [ like.separations[like.dimnames.index(d)] for d in target_dims ]
+        like.closeVolume()
+        #Direction cosines of the output grid, so that images resampled like an oblique image are not mislocated
+        cosines = _direction_cosines(self.inputs.like)
+        dir_cosines = {}
+        for i, d in enumerate(spatial_dims) :
+            dir_cosines[d[0]+'_dir_cosines'] = tuple(cosines.get(d, np.eye(3)[i]))
+
+        vol = volumeFromFile(self.inputs.input_file)
+        source_shape, source_affine = _grid(vol, self.inputs.input_file)
+        data = np.array(vol.data, dtype=np.float32)
+        dimnames = list(vol.dimnames)
+        if 'time' in dimnames :
+            t = dimnames.index('time')
+            time_start, time_step = vol.starts[t], vol.separations[t]
+            data = np.rollaxis(data, t, 0)
+        vol.closeVolume()
+
+        sampling = get_sampling(matrix, source_shape, source_affine, target_shape, target_affine)
+
+        if 'time' in dimnames :
+            pool = ThreadPool(self.inputs.num_threads)
+            frames = pool.map(sampling.apply, [ data[i] for i in range(data.shape[0]) ])
+            pool.close()
+            out_data = np.array(frames)
+            out = volumeFromDescription(self.inputs.output_file, ['time'] + target_dims, [data.shape[0]] + list(target_shape), [time_start] + target_starts, [time_step] + target_steps, volumeType='float', dtype='float', **dir_cosines)
+        else :
+            out_data = sampling.apply(data)
+            out = volumeFromDescription(self.inputs.output_file, target_dims, list(target_shape), target_starts, target_steps, volumeType='float', dtype='float', **dir_cosines)
+        out.data = out_data
+        out.writeFile()
+        out.closeVolume()
+
+        if 'time' in dimnames :
+            _copy_time_dimension(self.inputs.input_file, self.inputs.output_file)
+        return runtime
+
+    def _gen_output(self, basefile):
+        fname = ntpath.basename(basefile)
+        fname_list = os.path.splitext(fname)
+        return os.getcwd() + os.sep + fname_list[0] + self._suffix + fname_list[1]
+
+    def _list_outputs(self):
+        if not isdefined(self.inputs.output_file) :
+            self.inputs.output_file = self._gen_output(self.inputs.input_file)
+        outputs = self.output_spec().get()
+        outputs["output_file"] = self.inputs.output_file
+        return outputs
+
+def resample_interface(opts):
+    '''Interface used to apply transformations to images, chosen with --resample-method'''
+    if opts.resample_method == 'native' :
+        node = NativeResampleRunning()
+        node.inputs.num_threads = opts.num_threads
+        return node
+    return minc.Resample()
@@ -1,5 +1,13 @@
 import os
+import shutil
+import tempfile
 import numpy as np
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from scipy.ndimage.filters import gaussian_filter1d
+from pyminc.volumes.factory import volumeFromFile, volumeLikeFile
+import nipype.interfaces.minc as minc
+from Extra.minc_filemanip import file_md5
 
 from nipype.interfaces.base import CommandLine, CommandLineInputSpec
 from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,isdefined)
@@ -51,3 +59,154 @@ class SmoothCommand(CommandLine):
         if name == "out_file":
             return self._list_outputs()["out_file"]
         return None
+
+
+fwhm_to_sigma = 1. / np.sqrt(8. * np.log(2.))
+spatial_dims = ['xspace', 'yspace', 'zspace']
+
+def _filter_axis(data, sigma, axis, order, pool, num_threads):
+    '''
+    1D Gaussian filter (order=0) or derivative of Gaussian (order=1) of <data> along <axis>. The array is split
+    into chunks along another axis, which are filtered in parallel with <pool>.
+    '''
+    if sigma <= 0 and order == 0 :
+        return data
+    if sigma <= 0 :
+        return np.gradient(data, axis=axis).astype(np.float32)
+    chunk_axis = 0 if axis != 0 else 1
+    n = data.shape[chunk_axis]
+    n_chunks = min(n, num_threads * 4)
+    bounds = np.linspace(0, n, n_chunks + 1).astype(int)
+    def f(k) :
+        index = [slice(None)] * data.ndim
+        index[chunk_axis] = slice(bounds[k], bounds[k+1])
+        return gaussian_filter1d(data[tuple(index)], sigma, axis=axis, order=order, mode='constant', output=np.float32)
+    return np.concatenate(pool.map(f, range(n_chunks)), axis=chunk_axis)
+
+def gaussian_blur(data, fwhm, steps, gradient=False, num_threads=1):
+    '''
+    Separable Gaussian blur of the float32 array <data>, with <fwhm> in mm along each axis (a single value for an
+    isotropic blur) and voxel sizes <steps> in mm (the absolute value of the MINC step of each dimension).
+    Returns the blurred image and, if <gradient> is True, the magnitude of its gradient (in units per mm).
+    '''
+    fwhm = np.array(fwhm, dtype=float) * np.ones(data.ndim)
+    steps = np.abs(np.array(steps, dtype=float))
+    sigma = fwhm * fwhm_to_sigma / steps
+    data = np.asarray(data, dtype=np.float32)
+    pool = ThreadPool(num_threads)
+
+    blurred = data
+    for axis in range(data.ndim) :
+        blurred = _filter_axis(blurred, sigma[axis], axis, 0, pool, num_threads)
+
+    magnitude = None
+    if gradient :
+        magnitude = np.zeros(data.shape, dtype=np.float32)
+        for d in range(data.ndim) :
+            derivative = data
+            for axis in range(data.ndim) :
+                derivative = _filter_axis(derivative, sigma[axis], axis, int(axis == d), pool, num_threads)
+            magnitude += (derivative / steps[d])**2
+        magnitude = np.sqrt(magnitude)
+    pool.close()
+    return blurred, magnitude
+
+def native_blur(in_file, fwhm, output_file_base, gradient=False, num_threads=1):
+    '''
+    In-process equivalent of mincblur: blur the 3D MINC image <in_file> with <fwhm> (mm, scalar or x y z)
+    and write <output_file_base>_blur.mnc and, with <gradient>, <output_file_base>_dxyz.mnc
+    '''
+    vol = volumeFromFile(in_file)
+    fwhm = np.array(fwhm, dtype=float) * np.ones(3)
+    #Voxel sizes and fwhm in the order in which the dimensions are stored
+    dims = [ d for d in vol.dimnames if d in spatial_dims ]
+    steps = [ vol.separations[vol.dimnames.index(d)] for d in dims ]
+    fwhm = [ fwhm[spatial_dims.index(d)] for d in dims ]
+    blurred, magnitude = gaussian_blur(np.array(vol.data, dtype=np.float32), fwhm, steps, gradient, num_threads)
+    vol.closeVolume()
+
+    for suffix, data in [('_blur.mnc', blurred), ('_dxyz.mnc', magnitude)] :
+        if data is None :
+            continue
+        #Written as float, like mincblur, so that the images given to minctracc are not quantized to 8 bits
+        out = volumeLikeFile(in_file, output_file_base + suffix, dtype='float', volumeType='float')
+        out.data = data
+        out.writeFile()
+        out.closeVolume()
+    return output_file_base + '_blur.mnc'
+
+def blur_image(in_file, fwhm, output_file_base, method='mincblur', gradient=False, no_apodize=False, num_threads=1, verbose=1):
+    '''
+    Blur <in_file> with mincblur or with the native engine. Returns <output_file_base>_blur.mnc. The native
+    engine filters in the image domain, so there is no apodization and <no_apodize> only applies to mincblur.
+    '''
+    if method == 'native' :
+        if verbose >= 1 :
+            print('Native blur: '+in_file+' fwhm='+str(fwhm)+' -> '+output_file_base+'_blur.mnc')
+        return native_blur(in_file, fwhm, output_file_base, gradient, num_threads)
+
+    run_smooth = minc.Blur()
+    run_smooth.inputs.input_file=in_file
+    run_smooth.inputs.fwhm=fwhm
+    run_smooth.inputs.output_file_base=output_file_base
+    if gradient :
+        run_smooth.inputs.gradient=True
+    if no_apodize :
+        run_smooth.inputs.no_apodize=True
+    if verbose >= 1 :
+        print(run_smooth.cmdline)
+    run_smooth.run()
+    return output_file_base + '_blur.mnc'
+
+def blur_cache_key(in_files):
+    '''Key for the blurred images of the image defined by <in_files> (e.g., an image and its mask)'''
+    return md5('_'.join([ file_md5(fn) for fn in in_files ])).hexdigest()
+
+def cached_blur(in_file, fwhm, cache_dir, key=None, gradient=False, no_apodize=False, method='mincblur', num_threads=1, verbose=1):
+    '''
+    Blur <in_file> with mincblur (or the native engine, see blur_image) and store the result in <cache_dir>. Cache entries are identified by the 
+    content hash of the input image (or by <key>), the fwhm and the gradient flag, so that the same image 
+    is only blurred once per fwhm, even across different scans and runs of APPIAN. An entry computed with
+    the gradient also contains the blurred image and is reused by requests that do not need the gradient.
+
+    Returns the path to the blurred image (<base>_blur.mnc). The gradient image, if any, is in the same 
+    directory (<base>_dxyz.mnc).
+    '''
+    if key == None :
+        key = blur_cache_key([in_file])
+    base = 'fwhm'+str(fwhm)
+    name = key + '_' + base
+    if no_apodize :
+        name += '_no_apodize'
+    if method == 'native' :
+        name += '_native'
+
+    entries = [ name + '_gradient' ]
+    if not gradient :
+        entries = [ name ] + entries
+
+    for entry in entries :
+        out_dir = cache_dir + os.sep + entry
+        if os.path.exists(out_dir) :
+            if verbose >= 2 :
+                print("Using cached blur: "+out_dir)
+            return out_dir + os.sep + base + '_blur.mnc'
+
+    if not os.path.exists(cache_dir) :
+        try :
+            os.makedirs(cache_dir)
+        except OSError :
+            pass
+
+    #Blur in a temporary directory that is renamed once the outputs are complete, so that
+    #concurrent nodes never read a partially written image
+    out_dir = cache_dir + os.sep + entries[0]
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_'+entries[0])
+    blur_image(in_file, fwhm, tmp_dir + os.sep + base, method, gradient, no_apodize, num_threads, verbose)
+
+    try :
+        os.rename(tmp_dir, out_dir)
+    except OSError :
+        #Another process has already stored the same blurred image
+        shutil.rmtree(tmp_dir)
+    return out_dir + os.sep + base + '_blur.mnc'
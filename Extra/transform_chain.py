@@ -0,0 +1,160 @@
+import os
+import re
+import shutil
+import json
+import ntpath
+import nipype.interfaces.minc as minc
+from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath, BaseInterface, BaseInterfaceInputSpec, isdefined)
+from Extra.xfm import read_xfm, write_xfm, compose_xfm
+from Extra.resample import NativeResampleRunning
+
+"""
+.. module:: transform_chain
+    :platform: Unix
+    :synopsis: Module to compose linear and nonlinear (grid) transformations so that images are only resampled once.
+"""
+
+def read_transform_blocks(filename):
+    '''
+    Return the transformations in the MNI transformation file <filename> as a list of strings, one per
+    "Transform_Type" block. Paths to displacement volumes are made absolute, so that the blocks can be
+    written to a file in another directory.
+    '''
+    dirname = os.path.dirname(os.path.abspath(filename))
+    blocks=[]
+    for line in open(filename, 'r').read().split('\n') :
+        if line.strip().startswith('Transform_Type') :
+            blocks.append('')
+        if blocks == [] :
+            continue
+        match = re.match(r'(\s*Displacement_Volume\s*=\s*)([^;]+);', line)
+        if match != None :
+            volume = match.group(2).strip()
+            if not os.path.isabs(volume) :
+                volume = dirname + os.sep + volume
+            line = match.group(1) + volume + ';'
+        blocks[-1] += line + '\n'
+    return blocks
+
+def grid_files(filename):
+    '''Absolute paths to the displacement volumes referenced by the transformation file <filename>'''
+    out=[]
+    for block in read_transform_blocks(filename) :
+        match = re.search(r'Displacement_Volume\s*=\s*([^;]+);', block)
+        if match != None :
+            out.append(match.group(1).strip())
+    return out
+
+def copy_xfm(in_file, out_file):
+    '''
+    Copy the transformation file <in_file> to <out_file>, together with its displacement volumes, which are
+    named like those written by the MINC tools (<out_file base>_grid_<n>.mnc)
+    '''
+    base = os.path.splitext(out_file)[0]
+    n = 0
+    fp = open(out_file, 'w')
+    fp.write('MNI Transform File\n%'+' copy of '+in_file+'\n\n')
+    for block in read_transform_blocks(in_file) :
+        match = re.search(r'Displacement_Volume\s*=\s*([^;]+);', block)
+        if match != None :
+            grid = base + '_grid_' + str(n) + '.mnc'
+            shutil.copy(match.group(1).strip(), grid)
+            block = block.replace(match.group(0), 'Displacement_Volume = ' + os.path.basename(grid) + ';')
+            n += 1
+        fp.write(block)
+    fp.close()
+    return out_file
+
+class TransformChain():
+    '''
+    Ordered list of transformation files (linear or grid), from the space of the input image to the space
+    of the output image. The chain is only written as a single transformation file when an image has to be
+    resampled, so that each image is interpolated once, however many transformations are applied to it.
+    Linear chains are composed into a single matrix; chains with grid transformations are written as one
+    MNI transformation file containing every transformation, which mincresample applies in a single pass.
+    '''
+    def __init__(self, transforms=[]):
+        self.transforms = list(transforms)
+
+    def append(self, filename):
+        self.transforms.append(filename)
+        return self
+
+    def is_linear(self):
+        return not True in [ read_xfm(fn) is None for fn in self.transforms ]
+
+    def write(self, out_file):
+        if self.is_linear() :
+            write_xfm(out_file, compose_xfm([ read_xfm(fn) for fn in self.transforms ]), ' '+' x '.join(self.transforms))
+            return out_file
+        fp = open(out_file, 'w')
+        fp.write('MNI Transform File\n%'+' '+' x '.join(self.transforms)+'\n\n')
+        for fn in self.transforms :
+            for block in read_transform_blocks(fn) :
+                fp.write(block)
+        fp.close()
+        return out_file
+
+    def save(self, filename):
+        json.dump({"transforms":self.transforms}, open(filename, 'w'))
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        return cls(json.load(open(filename, 'r'))["transforms"])
+
+
+class ApplyTransformChainOutput(TraitedSpec):
+    output_file = File(desc="resampled image")
+    out_file_xfm = File(desc="composed transformation")
+
+class ApplyTransformChainInput(BaseInterfaceInputSpec):
+    input_file = File(exists=True, mandatory=True, desc="image to resample")
+    transformations = InputMultiPath(File(exists=True), mandatory=True, desc="transformations, in the order in which they are applied")
+    like = File(exists=True, mandatory=True, desc="image with the sampling of the output image")
+    output_file = File(desc="resampled image")
+    nearest_neighbour_interpolation = traits.Bool(usedefault=True, default_value=False, desc="Use nearest neighbour interpolation")
+    resample_method = traits.Enum('mincresample', 'native', usedefault=True, desc="Method used to resample the image")
+    num_threads = traits.Int(usedefault=True, default_value=1, desc="Number of threads for native resampling")
+
+class ApplyTransformChainRunning(BaseInterface):
+    '''Compose a chain of transformations and resample the input image once with the composed transformation'''
+    input_spec = ApplyTransformChainInput
+    output_spec = ApplyTransformChainOutput
+    _suffix = "_rsl"
+
+    def _gen_output(self, basefile, suffix):
+        fname = ntpath.basename(basefile)
+        fname_list = os.path.splitext(fname)
+        return os.getcwd() + os.sep + fname_list[0] + suffix + fname_list[1]
+
+    def _gen_xfm(self):
+        return os.getcwd() + os.sep + os.path.splitext(ntpath.basename(self.inputs.input_file))[0] + '_chain.xfm'
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.output_file) :
+            self.inputs.output_file = self._gen_output(self.inputs.input_file, self._suffix)
+        xfm = TransformChain(self.inputs.transformations).write(self._gen_xfm())
+
+        if self.inputs.resample_method == 'native' and not self.inputs.nearest_neighbour_interpolation :
+            run_resample = NativeResampleRunning()
+            run_resample.inputs.num_threads = self.inputs.num_threads
+        else :
+            run_resample = minc.Resample()
+            if self.inputs.nearest_neighbour_interpolation :
+                run_resample.inputs.nearest_neighbour_interpolation = True
+        run_resample.inputs.input_file = self.inputs.input_file
+        run_resample.inputs.output_file = self.inputs.output_file
+        run_resample.inputs.like = self.inputs.like
+        run_resample.inputs.transformation = xfm
+        run_resample.inputs.keep_real_range = True
+        run_resample.run()
+        return runtime
+
+    def _list_outputs(self):
+        if not isdefined(self.inputs.output_file) :
+            self.inputs.output_file = self._gen_output(self.inputs.input_file, self._suffix)
+        outputs = self.output_spec().get()
+        outputs["output_file"] = self.inputs.output_file
+        outputs["out_file_xfm"] = self._gen_xfm()
+        return outputs
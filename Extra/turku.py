@@ -11,6 +11,7 @@ import ntpath
 import os
 import numpy as np
 import pandas as pd
+from Extra.pet_header import PETHeader
 
 global isotope_dict
 isotope_dict={
@@ -193,7 +194,6 @@ class sifCommand(BaseInterface):
         out_file = self.inputs.out_file
 
         print(self.inputs.header)
-        data = json.load( open( self.inputs.header, "rb" ) )
        
         #if data['Time']['frames-time'] == 'unknown':
         #    start = 0
@@ -207,11 +207,9 @@ class sifCommand(BaseInterface):
         #else :
         #    duration=np.array(data['time']['frames-length'], dtype=float    )
 
-        frame_times = data["Time"]["FrameTimes"]["Values"]
-        start=[]
-        duration = data["Time"]["FrameTimes"]["Duration"]
-        for s, e in frame_times :
-            start.append(s)
+        pet_header = PETHeader.load(self.inputs.header)
+        start = pet_header.frame_start
+        duration = pet_header.duration
 
         print("Start -- Duration:", start, duration)
         df=pd.DataFrame(data={ "Start" : start, "Duration" : duration})
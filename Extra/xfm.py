@@ -0,0 +1,158 @@
+import numpy as np
+import h5py
+from pyminc.volumes.factory import volumeFromFile
+from scipy.ndimage.interpolation import map_coordinates
+
+"""
+.. module:: xfm
+    :platform: Unix
+    :synopsis: Module to read and write MNI transformation files (.xfm) and the voxel to world geometry of MINC images.
+"""
+
+spatial_dims = ['xspace', 'yspace', 'zspace']
+
+def read_xfm(filename):
+    '''
+    Read a linear MNI transformation file and return it as a 4x4 numpy array that maps world coordinates
+    (x,y,z) of the source to world coordinates of the target. Returns None if the file contains a
+    nonlinear (grid) transformation, which must be handled by the MINC tools.
+    '''
+    lines = open(filename, 'r').read().split('\n')
+    matrix = None
+    i = 0
+    while i < len(lines) :
+        line = lines[i].strip()
+        if line.startswith('Transform_Type') and not 'Linear' in line :
+            return None
+        if line.startswith('Linear_Transform') :
+            if matrix is not None :
+                #Several linear transformations that must be concatenated. Left to xfmconcat
+                return None
+            values = [ float(v) for v in line.split('=', 1)[1].replace(';', ' ').split() ]
+            i += 1
+            while len(values) < 12 and i < len(lines) :
+                values += [ float(v) for v in lines[i].replace(';', ' ').split() ]
+                i += 1
+            matrix = np.eye(4)
+            matrix[0:3,:] = np.array(values[0:12]).reshape(3,4)
+            continue
+        i += 1
+
+    if matrix is None :
+        print("Error: could not read linear transformation from "+filename)
+        exit(1)
+    return matrix
+
+def write_xfm(filename, matrix, comment=None):
+    '''Write the 4x4 numpy array <matrix> as a linear MNI transformation file'''
+    fp = open(filename, 'w')
+    fp.write('MNI Transform File\n')
+    if comment != None :
+        fp.write('%'+comment+'\n')
+    fp.write('\nTransform_Type = Linear;\nLinear_Transform =\n')
+    for i in range(3) :
+        row = ' '.join([ repr(float(v)) for v in matrix[i,:] ])
+        if i == 2 : row += ';'
+        fp.write(' '+row+'\n')
+    fp.close()
+    return filename
+
+def compose_xfm(matrices):
+    '''
+    Compose a list of linear transformations, in the order in which they are applied (same order as the
+    arguments of xfmconcat)
+    '''
+    out = np.eye(4)
+    for matrix in matrices :
+        out = np.dot(matrix, out)
+    return out
+
+def invert_xfm(matrix):
+    return np.linalg.inv(matrix)
+
+def invert_xfm_file(in_file, out_file):
+    '''Invert the transformation file <in_file> in-process. Returns False if the transformation is not linear'''
+    matrix = read_xfm(in_file)
+    if matrix is None :
+        return False
+    write_xfm(out_file, invert_xfm(matrix), ' inverse of '+in_file)
+    return True
+
+def _direction_cosines(filename):
+    cosines={}
+    if not h5py.is_hdf5(filename) :
+        return cosines
+    f = h5py.File(filename, 'r')
+    dims = f['minc-2.0/dimensions']
+    for view in spatial_dims :
+        if view in dims and 'direction_cosines' in dims[view].attrs :
+            cosines[view] = np.array(dims[view].attrs['direction_cosines'], dtype=float)
+    f.close()
+    return cosines
+
+def voxel_to_world(vol, filename):
+    '''
+    Return the 4x4 numpy array that maps the indices of the spatial dimensions of <vol> (a pyminc volume read
+    from <filename>), in the order in which they are stored, to world coordinates (x,y,z)
+    '''
+    cosines = _direction_cosines(filename)
+    dims = [ d for d in vol.dimnames if d in spatial_dims ]
+    affine = np.eye(4)
+    for j, d in enumerate(dims) :
+        i = vol.dimnames.index(d)
+        cos = cosines.get(d, np.eye(3)[spatial_dims.index(d)])
+        affine[0:3,j] = cos * vol.separations[i]
+        affine[0:3,3] += cos * vol.starts[i]
+    return affine
+
+def read_volume(filename, dtype=np.float32):
+    '''Read a 3D MINC image and return its data, its voxel to world matrix and the pyminc volume'''
+    vol = volumeFromFile(filename)
+    data = np.array(vol.data, dtype=dtype)
+    affine = voxel_to_world(vol, filename)
+    return data, affine, vol
+
+def apply_matrix(matrix, points):
+    '''Apply the 4x4 matrix to an array of points with shape (3, N)'''
+    return np.dot(matrix[0:3,0:3], points) + matrix[0:3,3].reshape(3,1)
+
+def image_center(filename):
+    '''World coordinates of the center of the spatial grid of <filename>'''
+    vol = volumeFromFile(filename)
+    affine = voxel_to_world(vol, filename)
+    shape = [ vol.sizes[vol.dimnames.index(d)] for d in vol.dimnames if d in spatial_dims ]
+    vol.closeVolume()
+    return apply_matrix(affine, (np.array(shape, dtype=float).reshape(3,1) - 1) / 2.)[:,0]
+
+def xfm_delta(matrix_1, matrix_2, center):
+    '''
+    Difference between two linear transformations, as the displacement (in mm) of <center> and the angle
+    (in degrees) of the rotation of matrix_2 * inverse(matrix_1)
+    '''
+    delta = np.dot(matrix_2, np.linalg.inv(matrix_1))
+    translation = np.linalg.norm(apply_matrix(delta, center.reshape(3,1))[:,0] - center)
+    #Rotation part of the linear component, without scales and shears
+    u, sigma, vt = np.linalg.svd(delta[0:3,0:3])
+    rotation = np.dot(u, vt)
+    angle = np.degrees(np.arccos(np.clip((np.trace(rotation) - 1.) / 2., -1., 1.)))
+    return translation, angle
+
+def read_grid(filename):
+    '''Read a displacement volume and return its vectors, with shape (3, ...), and its voxel to world matrix'''
+    vol = volumeFromFile(filename)
+    data = np.rollaxis(np.array(vol.data, dtype=np.float32), vol.dimnames.index('vector_dimension'), 0)
+    affine = voxel_to_world(vol, filename)
+    vol.closeVolume()
+    return data, affine
+
+def grid_displacement_rms(grid_file_1, grid_file_2):
+    '''
+    Root mean square of the difference between two displacement volumes, sampled at the points of the
+    second volume. The volumes can have different lattices (e.g., successive stages of minctracc).
+    '''
+    data_1, affine_1 = read_grid(grid_file_1)
+    data_2, affine_2 = read_grid(grid_file_2)
+    idx = np.indices(data_2.shape[1:]).reshape(3,-1).astype(float)
+    voxels = apply_matrix(np.dot(np.linalg.inv(affine_1), affine_2), idx)
+    diff = data_2.reshape(3,-1) - np.array([ map_coordinates(data_1[i], voxels, order=1, mode='nearest') for i in range(3) ])
+    return np.sqrt(np.mean(np.sum(diff**2, axis=0)))
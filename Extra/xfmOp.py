@@ -8,6 +8,8 @@ from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,is
 from nipype.utils.filemanip import (load_json, save_json, split_filename, fname_presuffix)
 from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,
                                     BaseInterface, OutputMultiPath, BaseInterfaceInputSpec, isdefined)
+from Extra.xfm import invert_xfm_file
+from Extra.transform_chain import TransformChain
 
 class ConcatInput(CommandLineInputSpec):
     in_file = File(position=0, argstr="%s", exists=True, mandatory=True, desc="main input xfm file")
@@ -125,3 +127,60 @@ class InvertCommand(CommandLine):
         if name == "out_file":
             return self._list_outputs()["out_file"]
         return None
+
+
+class ConcatXfmRunning(BaseInterface):
+    '''
+    Concatenate two transformations in-process. Linear transformations are composed into a single matrix,
+    transformations with nonlinear (grid) components are written to a single file that references the
+    displacement volumes of the inputs by absolute path (see Extra.transform_chain), so no grid file is
+    written and out_warp, in_warp and in_warp_2 are not used.
+    '''
+    _suffix = "_concat"
+    input_spec = ConcatInput
+    output_spec = ConcatOutput
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.out_file):
+            self.inputs.out_file = self._gen_filename(self.inputs.in_file)
+        TransformChain([self.inputs.in_file, self.inputs.in_file_2]).write(self.inputs.out_file)
+        return runtime
+
+    def _gen_filename(self, name):
+        split_name = splitext(name)
+        return os.getcwd() + os.sep + basename(split_name[0]) + self._suffix + split_name[1]
+
+    def _list_outputs(self):
+        if not isdefined(self.inputs.out_file):
+            self.inputs.out_file = self._gen_filename(self.inputs.in_file)
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self.inputs.out_file
+        return outputs
+
+class InvertXfmRunning(BaseInterface):
+    '''Invert a linear transformation in-process. Nonlinear transformations are inverted with xfminvert.'''
+    _suffix = "_inv"
+    input_spec = InvertInput
+    output_spec = InvertOutput
+
+    def _run_interface(self, runtime):
+        if not isdefined(self.inputs.out_file):
+            self.inputs.out_file = self._gen_filename(self.inputs.in_file)
+        if not invert_xfm_file(self.inputs.in_file, self.inputs.out_file) :
+            invert = InvertCommand()
+            invert.inputs.in_file = self.inputs.in_file
+            invert.inputs.out_file = self.inputs.out_file
+            print(invert.cmdline)
+            invert.run()
+        return runtime
+
+    def _gen_filename(self, name):
+        split_name = splitext(name)
+        return os.getcwd() + os.sep + basename(split_name[0]) + self._suffix + split_name[1]
+
+    def _list_outputs(self):
+        if not isdefined(self.inputs.out_file):
+            self.inputs.out_file = self._gen_filename(self.inputs.in_file)
+        outputs = self.output_spec().get()
+        outputs["out_file"] = self.inputs.out_file
+        return outputs
@@ -12,6 +12,9 @@ from math import *
 from time import gmtime, strftime
 from glob import glob
 import re
+import stat
+import subprocess
+import h5py
 
 from pyminc.volumes.factory import *
 
@@ -23,7 +26,8 @@ from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,
 from nipype.utils.filemanip import (load_json, save_json, split_filename, fname_presuffix, copyfile)
 from nipype.interfaces.utility import Rename
 from nipype.interfaces.minc import Resample as ResampleCommand
-from Extra.minc_filemanip import update_minchd_json
+from Extra.minc_json_header_batch import read_minc2_header
+from Extra.pet_header import PETHeader, section as pet_header_section
 from Extra.info import  InfoCommand
 from Extra.modifHeader import ModifyHeaderCommand, FixCosinesCommand
 from Extra.reshape import  ReshapeCommand
@@ -106,39 +110,6 @@ def set_isotope_halflife(d, user_halflife=None, target="halflife"):
 
     return d
 
-
-
-def set_frame_duration(d, minc_input=False, json_frame_path=["Time","FrameTimes","Values"], verbose=True):
-    frame_times=[]
-    try :
-        frame_times = d["Time"]["FrameTimes"]["Values"]
-    except KeyError :
-        print("\nError Could not find Time:FrameTimes:Values in header\n")
-        exit(1)
-    FrameLengths=[]
-
-    c0=c1=1 #Time unit conversion variables. Time should be in seconds
-    try :
-        if d["Time"]["FrameTimes"]["Units"][0] == 'm' :
-            c0=60
-        elif d["Time"]["FrameTimes"]["Units"][0] == 'h' :
-            c0=60*60
-        if d["Time"]["FrameTimes"]["Units"][1] == 'm' :
-            c1=60
-        elif d["Time"]["FrameTimes"]["Units"][1] == 'h' :
-            c1=60*60
-    except KeyError :
-        print("\nError Could not find Time:FrameTimes:Units in header\n")
-        exit(1)
-
-    for s, e in frame_times :
-        FrameLengths.append(c1*e - c0*s)
-
-    d["Time"]["FrameTimes"]["Duration"] = FrameLengths
-
-    return d
-
-
 class SplitArgsOutput(TraitedSpec):
     cid = traits.Str(mandatory=True, desc="Condition ID")
     sid = traits.Str(mandatory=True, desc="Subject ID")
@@ -240,46 +211,33 @@ class MincHdrInfoRunning(BaseInterface):
         except OSError:
             pass
 
-        class InfoOptions:
-            def __init__(self, command, variable, attribute, type_):
-                self.command = command
-                self.variable = variable
-                self.attribute = attribute
-                self.type_ = type_
-
-        temp_out_file=os.getcwd()+os.sep+"temp.json"
+        #Read the complete header in a single pass for MINC2 files. pyezminc is only needed for MINC1
+        header = read_minc2_header(self.inputs.in_file)
+        if header == None :
+            header={}
+            try :
+                img = pyezminc.Image(self.inputs.in_file, metadata_only=True)
+                hd = img.get_MINC_header()
+                for key in hd.keys():
+                    header[str(key)]={}
+                    for subkey in hd[key].keys():
+                        header[str(key)][str(subkey)]=hd[key][subkey]
+            except RuntimeError :
+                print("Warning: Could not read header file from", self.inputs.in_file)
 
-        try :
-            img = pyezminc.Image(self.inputs.in_file, metadata_only=True)
-            hd = img.get_MINC_header()
-            for key in hd.keys():
-                self._params[key]={}
-                for subkey in hd[key].keys():
-                    self._params[key][subkey]={}
-                    data_in = hd[key][subkey]
-                    var = str(key)
-                    attr = str(subkey)
-                    #Populate dictionary with some useful image parameters (e.g., world coordinate start values of dimensions)
-                    self._params[key][subkey]=data_in
-                    update_minchd_json(temp_out_file, data_in, var, attr)
-        except RuntimeError :
-            print("Warning: Could not read header file from", self.inputs.in_file)
-
-
-        header = json.load(open(temp_out_file, "r+") )
-
-        minc_input=True
         if not isdefined(self.inputs.json_header) :
             print("Error: could not find json file", self.inputs.json_header)
             exit(1)
 
         json_header = json.load(open(self.inputs.json_header, "r+"))
         header.update(json_header)
-        minc_input=False
 
-        header = set_frame_duration(header, minc_input)
         header = set_isotope_halflife(header, self.inputs.halflife, 'halflife')
 
+        #Store the frame times in canonical units so that downstream nodes do not have to parse them again
+        header.pop(pet_header_section, None)
+        header[pet_header_section] = PETHeader.from_dict(header, self.inputs.json_header).to_dict()
+
         fp=open(self.inputs.out_file, "w+")
         fp.seek(0)
         json.dump(header, fp, sort_keys=True, indent=4)
@@ -318,6 +276,10 @@ class VolCenteringRunning(BaseInterface):
             dname = dname = os.getcwd()
             self.inputs.out_file = dname + os.sep + fname + self._suffix + '.mnc'
 
+        if self._identity_cosines(self.inputs.in_file) :
+            self._center_header_only(self.inputs.in_file, self.inputs.out_file)
+            return runtime
+
         temp_fn="/tmp/tmp_mnc_"+ strftime("%Y%m%d%H%M%S", gmtime())+str(np.random.randint(9999999999))+".mnc"
         shutil.copy(self.inputs.in_file, temp_fn)
         infile = volumeFromFile(self.inputs.in_file)
@@ -353,6 +315,39 @@ class VolCenteringRunning(BaseInterface):
         shutil.copy(fixCosine.inputs.out_file, self.inputs.out_file)
         return runtime
 
+    def _identity_cosines(self, fn):
+        '''
+        Check if <fn> is a MINC2 file with identity direction cosines, in which case there is no need to
+        resample it with FixCosinesCommand and the centering can be done by only editing the header
+        '''
+        if not h5py.is_hdf5(fn) : return False
+        f = h5py.File(fn, 'r')
+        dims = f['minc-2.0/dimensions']
+        identity = True
+        for view, unit in zip(['xspace','yspace','zspace'], np.eye(3)) :
+            if view in dims and 'direction_cosines' in dims[view].attrs :
+                identity = identity and np.allclose(dims[view].attrs['direction_cosines'], unit)
+        f.close()
+        return identity
+
+    def _center_header_only(self, in_file, out_file):
+        #Copy-on-write copy where the file system supports it (e.g., btrfs, xfs), so that only the 
+        #header blocks modified below are written. A hardlink cannot be used because the header of 
+        #the input image would be modified as well
+        if subprocess.call(['cp', '--reflink=auto', in_file, out_file]) != 0 :
+            shutil.copy(in_file, out_file)
+        os.chmod(out_file, os.stat(out_file).st_mode | stat.S_IWUSR)
+
+        #Same header edits as ModifyHeaderCommand and fixIrregular, in a single open of the file
+        f = h5py.File(out_file, 'r+')
+        dims = f['minc-2.0/dimensions']
+        for view in ['xspace','yspace','zspace'] :
+            dims[view].attrs['start'] = np.float64(dims[view].attrs.get('start', 0.))
+        for view in ['xspace','yspace','zspace','time','time-width'] :
+            if view in dims :
+                dims[view].attrs['spacing'] = np.string_('regular__')
+        f.close()
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
         outputs["out_file"] = self.inputs.out_file
@@ -366,6 +361,10 @@ class pet3DVolumeOutput(TraitedSpec):
 class pet3DVolumeInput(BaseInterfaceInputSpec):
     in_file = File(position=0, argstr="%s", mandatory=True, desc="Image")
     out_file = File(argstr="%s", desc="Image after centering")
+    header = File(exists=True, desc="PET json header with frame durations")
+    start_fraction = traits.Float(default_value=0.25, usedefault=True, desc="Fraction of frames to skip at the start of the scan")
+    end_fraction = traits.Float(default_value=1.0, usedefault=True, desc="Fraction of frames after which frames are skipped")
+    weighting = traits.Enum('duration', 'uniform', usedefault=True, desc="Weight frames by their duration or uniformly")
     verbose = traits.Int(argstr="-verbose", usedefault=True, default_value=True, desc="Write messages indicating progress")
 
 class pet3DVolume(BaseInterface):
@@ -379,11 +378,23 @@ class pet3DVolume(BaseInterface):
         dname = os.getcwd()
         return dname+ os.sep+fname_list[0] + _suffix + fname_list[1]
 
+    def _frame_weights(self, nFrames):
+        weights = np.ones(nFrames)
+        if self.inputs.weighting == 'duration' :
+            if not isdefined(self.inputs.header) :
+                print("Warning: no header, frames of PET image will be weighted uniformly")
+                return weights
+            duration = PETHeader.load(self.inputs.header).duration
+            if len(duration) != nFrames :
+                print("Warning: number of frame durations in header does not match the number of frames in PET image, frames will be weighted uniformly")
+                return weights
+            weights = duration
+        return weights
+
     def _run_interface(self, runtime):
         if not isdefined(self.inputs.out_file):
             self.inputs.out_file = self._gen_output(self.inputs.in_file, self._suffix)
         infile = volumeFromFile(self.inputs.in_file)
-        #FIXME : infile = nib.load(self.inputs.in_file)
         try :
             t=infile.dimnames.index("time")
             nFrames = infile.sizes[infile.dimnames.index("time")]
@@ -394,26 +405,30 @@ class pet3DVolume(BaseInterface):
         z=infile.dimnames.index("zspace")
         y=infile.dimnames.index("yspace")
         x=infile.dimnames.index("xspace")
-        rank=0.25
 
         if nFrames > 1 :
             dimnames=[ infile.dimnames[z], infile.dimnames[y],infile.dimnames[x] ]
             sizes=[ infile.sizes[z], infile.sizes[y],infile.sizes[x] ]
             starts=[ infile.starts[z], infile.starts[y],infile.starts[x] ]
             separations=[ infile.separations[z], infile.separations[y],infile.separations[x] ]
+            first=int(floor(nFrames*self.inputs.start_fraction) )
+            last=max(first+1, int(ceil(nFrames*self.inputs.end_fraction)))
+            weights = self._frame_weights(nFrames)
+
+            #Read one frame at a time and accumulate the weighted sum, so that the 4D image is never
+            #loaded in memory
+            volume_sum = np.zeros([ s for i, s in enumerate(infile.sizes) if i != t ], dtype=np.float64)
+            count = list(infile.sizes)
+            count[t] = 1
+            for i in range(first, min(last, nFrames)) :
+                start = [0] * len(infile.sizes)
+                start[t] = i
+                frame = np.array(infile.getHyperslab(start, count), dtype=np.float64)
+                volume_sum += weights[i] * frame.reshape(volume_sum.shape)
+            volume_average = volume_sum / np.sum(weights[first:last])
+            infile.closeVolume()
+
             outfile = volumeFromDescription(self.inputs.out_file, dimnames, sizes, starts, separations)
-            first=int(floor(nFrames*rank) )
-            last=nFrames
-            if t == 0 :
-                volume_subset=infile.data[first:last,:,:,:]
-            elif t == 1:
-                volume_subset=infile.data[:,first:last,:,:]
-            elif t == 2:
-                volume_subset=infile.data[:,:,first:last,:]
-            else:
-                volume_subset=infile.data[:,:,f:,irst:last]
-            volume_average=np.mean(volume_subset, axis=t)
-            #FIXME volume_average.to_file(self.inputs.in_)
             outfile.data=volume_average
             outfile.writeFile()
             outfile.closeVolume()
@@ -445,8 +460,8 @@ def get_workflow(name, infosource, opts):
     Nipype workflow that initializes the PET images by
         1. Centering the PET image: petCenter
         2. Exlcude start and end frames: petExcludeFr
-        3. Average 4D PET image into 3D image: petVolume
-        4. Extract information from header
+        3. Extract information from header: petSettings
+        4. Average 4D PET image into 3D image, weighting frames by their duration: petVolume
 
     :param name: Name of workflow
     :param infosource: Infosource for basic variables like subject id (sid) and condition id (cid)
@@ -471,6 +486,9 @@ def get_workflow(name, infosource, opts):
     node_name="petVolume"
     petVolume = pe.Node(interface=pet3DVolume(), name=node_name)
     petVolume.inputs.verbose = opts.verbose
+    petVolume.inputs.start_fraction = opts.pet_volume_start_fraction
+    petVolume.inputs.end_fraction = opts.pet_volume_end_fraction
+    petVolume.inputs.weighting = opts.pet_volume_weighting
 
     node_name="petSettings"
     petSettings = pe.Node(interface=MincHdrInfoRunning(), name=node_name)
@@ -482,6 +500,7 @@ def get_workflow(name, infosource, opts):
     workflow.connect([(petCenter, petSettings, [('out_file', 'in_file')])])
     workflow.connect(inputnode, 'json_header', petSettings, 'json_header')
     workflow.connect([(petCenter, petVolume, [('out_file', 'in_file')])])
+    workflow.connect(petSettings, 'out_file', petVolume, 'header')
 
 
     workflow.connect(petSettings, 'header', outputnode, 'pet_header_dict')
@@ -24,12 +24,14 @@ if __name__ == "__main__":
     ############################################
     # Create BIDS-style header for MINC inputs #
     ############################################
-    create_minc_headers( opts.sourceDir )
+    #Files that have already been converted are recorded in a manifest and skipped
+    manifest_file = opts.targetDir+os.sep+opts.preproc_dir+os.sep+'preflight_manifest.json'
+    create_minc_headers( opts.sourceDir, num_threads=opts.num_threads, manifest_file=manifest_file )
     
     #######################################
     ### Convert NII to MINC if necessary. # 
     #######################################
-    nii2mnc_batch(opts)	
+    nii2mnc_batch(opts, manifest_file=manifest_file)
    
     #################
     # Launch APPIAN #
@@ -12,7 +12,7 @@ from Extra.mincants import mincRegistration, mincANTSCommand, mincAtroposCommand
 from Extra.conversion import mnc2niiCommand
 from Extra.extra import copyCommand
 import nipype.interfaces.minc as minc
-from Registration.registration import PETtoT1LinRegRunning, nLinRegRunning
+from Registration.registration import PETtoT1LinRegRunning, nLinRegRunning, set_registration_options
 from nipype.interfaces.utility import Rename
 
 def get_workflow(name, opts):
@@ -108,9 +108,10 @@ def get_workflow(name, opts):
             t1_mni_node=mri2template
             tfm_node= mri2template
             tfm_file='composite_transform'
-        elif opts.coreg_method == 'minctracc' :
+        elif opts.coreg_method in ['minctracc', 'native'] :
             mri2template = pe.Node(interface=nLinRegRunning(), name="mri_normalize")
             mri2template.inputs.in_target_file=opts.template
+            set_registration_options(mri2template, opts)
             workflow.connect(inputnode, 't1', mri2template, 'in_source_file')
             t1_mni_file = 'out_file_img'
             t1_mni_node=mri2template
@@ -1,7 +1,5 @@
 import os
-import numpy as np
 import tempfile
-import shutil
 import pickle
 import ntpath
 
@@ -13,19 +11,18 @@ from nipype.utils.filemanip import (load_json, save_json, split_filename, fname_
 #from nipype.interfaces.base import Info
 
 from nipype.interfaces.utility import Rename
-from os.path import splitext
 import nipype.interfaces.minc as minc
 from nipype.interfaces.minc import Calc as CalcCommand
 from nipype.interfaces.minc import Blur as SmoothCommand
 from nipype.interfaces.minc import Resample as ResampleCommand
 from Extra.xfmOp import InvertCommand
-from Extra.morphomat import MorphCommand
 from Extra.info import StatsCommand
 from Extra.resample import param2xfmCommand
 from Extra.obj import *
-from Extra.xfmOp import ConcatCommand, ConcatNLCommand
+from Extra.xfmOp import ConcatCommand, ConcatXfmRunning
+from Extra.labels import prepare_labels
+from Extra.transform_chain import TransformChain
 import Registration.registration as reg
-import pyminc.volumes.factory as pyminc
 
 class LabelsInput(BaseInterfaceInputSpec):
     mniT1 = File(exists=True, desc="T1 image normalized into MNI space")
@@ -72,34 +69,7 @@ class Labels(BaseInterface):
         tmpDir = os.getcwd() + os.sep + 'tmp_label'  #tempfile.mkdtemp()
         os.mkdir(tmpDir)
 
-        out_file_1 =temp_mask = tmpDir+"/mask.mnc"
-        temp_mask_clean = tmpDir+"/mask_clean.mnc"
-        if self.inputs.labels == [] :
-            mask= pyminc.volumeFromFile(self.inputs.label_img)
-            mask_flat=mask.data.flatten()
-            labels=[ str(int(round(i))) for i in np.unique(mask_flat) ]
-            if '0' in labels :  labels.remove('0')
-        else :
-            labels = self.inputs.labels
-        # 1) Select Labels
-        run_calc = minc.Calc() #Extract the desired label from the atlas using minccalc.
-        run_calc.inputs.input_files = self.inputs.label_img #The ANIMAL or CIVET classified atlas
-        run_calc.inputs.output_file = temp_mask  #Output mask with desired label
-        run_calc.inputs.expression = " || ".join([ '(A[0] > ' + str(label) + '-0.1 && A[0] < '+str(label)+'+ 0.1 )' for label in  labels ]) + ' ? A[0] : 0'
-        run_calc.run()
-
-        # 2) Erode
-        if int(self.inputs.erode_times) > 0:
-            run_mincmorph = MorphCommand()
-            run_mincmorph.inputs.in_file = temp_mask
-            run_mincmorph.inputs.out_file = temp_mask_clean
-            run_mincmorph.inputs.successive='E' * self.inputs.erode_times
-            run_mincmorph.run()
-            out_file_1 = temp_mask_clean
-        else :
-            out_file_1 = temp_mask #self.inputs.out_file
-
-        # 3) Co-registration
+        # Co-registration
         if self.inputs.space == "stereo" and self.inputs.label_type == "atlas-template"    :
             if self.inputs.nLinAtlasMNIXfm == '':
                 sourceToModel_xfm = os.getcwd() + os.sep + 'template2mni.xfm'
@@ -107,57 +77,21 @@ class Labels(BaseInterface):
                 run_nlinreg.inputs.in_source_file = self.inputs.label_template
                 run_nlinreg.inputs.in_target_file = self.inputs.mniT1
                 run_nlinreg.inputs.out_file_xfm = sourceToModel_xfm # xfm file for the transformation from template to subject stereotaxic
+                run_nlinreg.inputs.transforms_only = True
+                run_nlinreg.inputs.write_image = False
                 run_nlinreg.run()
 
-                mni2target = minc.XfmConcat()
-                mni2target.inputs.input_file_1 = sourceToModel_xfm
-                mni2target.inputs.input_file_2 = self.inputs.mni2target
-                mni2target.run()
-                xfm = mni2target.inputs.out_file
-                self.inputs.nLinAtlasMNIXfm=mni2target.inputs.output_file
+                #Template -> MNI -> analysis space, written as a single transformation so that the labels are only resampled once
+                xfm = TransformChain([sourceToModel_xfm, self.inputs.mni2target]).write(os.getcwd() + os.sep + 'template2target.xfm')
+                self.inputs.nLinAtlasMNIXfm = xfm
             else :
                 xfm=self.inputs.nLinAtlasMNIXfm
         else :
             xfm = self.inputs.LinXfm
 
-        # 4) Apply transformation
-        like_file = self.inputs.like_file
-        base=splitext(out_file_1)
-        out_file_2=base[0]+self.inputs.analysis_space+base[1]
-
-        run_resample = minc.Resample()
-        run_resample.inputs.input_file = out_file_1 # self.inputs.label_img
-        run_resample.inputs.output_file = out_file_2
-        run_resample.inputs.like = like_file
-        run_resample.inputs.transformation = xfm
-        run_resample.inputs.nearest_neighbour_interpolation = True
-        run_resample.run()
-
-        label = run_resample.inputs.output_file
-
-        #Copy to output
-        shutil.copy(label, self.inputs.out_file)
-
-        # 6) Mask brain for T1 and MNI labels
-        if self.inputs.brain_only :
-            temp_mask = tmpDir+"/mask.mnc"
-            run_calc = minc.Calc() #Extract the desired label from the atlas using minccalc.
-            run_calc.inputs.input_files = [ label, self.inputs.brain_mask]
-            run_calc.inputs.output_file = temp_mask  #Output mask with desired label
-            run_calc.inputs.expression = " A[1] == 1 ? A[0] : 0 "
-            run_calc.clobber = True
-            run_calc.run()
-            shutil.copy(temp_mask,  self.inputs.out_file)
-            label = self.inputs.out_file
-        if self.inputs.ones_only :
-            temp_mask = tmpDir+"/mask.mnc"
-            run_calc = minc.Calc() #Extract the desired label from the atlas using minccalc.
-            run_calc.inputs.input_files = [ label ] #The ANIMAL or CIVET classified atlas
-            run_calc.inputs.output_file = temp_mask  #Output mask with desired label
-            run_calc.inputs.expression = " A[0] > 0.1 ? 1 : 0 "
-            run_calc.clobber = True
-            run_calc.run()
-            shutil.copy(temp_mask, self.inputs.out_file)
+        # 4) Select, erode and resample the labels in the analysis space, then mask and binarize them
+        brain_mask = self.inputs.brain_mask if self.inputs.brain_only else None
+        prepare_labels(self.inputs.label_img, self.inputs.out_file, self.inputs.like_file, xfm, self.inputs.labels, self.inputs.erode_times, self.inputs.ones_only, brain_mask, tmpDir)
 
         return runtime
 
@@ -226,6 +160,73 @@ def get_transforms_for_stage(inputnode, label_space, analysis_space, identity):
 
 
 
+def get_template_normalization(workflow, nodes, source, target, opts):
+    '''
+    Return the node that nonlinearly registers the template <source> to <target>. 
+    
+    The registration does not depend on the subject, so a single node is created for each 
+    (source, target) pair and shared by the stages (pvc, tka, results) that use it. The node stores 
+    its outputs in opts.template_cache_dir so that they are reused by later runs of APPIAN.
+    '''
+    if not (source, target) in nodes.keys() :
+        node = pe.Node(interface=reg.CachedNLinRegRunning(), name="template_normalization_"+str(len(nodes)))
+        node.inputs.in_source_file = source
+        node.inputs.in_target_file = target
+        node.inputs.cache_dir = opts.template_cache_dir
+        reg.set_registration_options(node, opts)
+        #Only the transformation is used by Labels, so neither the stages nor the template are resampled
+        node.inputs.transforms_only = True
+        node.inputs.write_image = False
+        nodes[(source, target)] = node
+    return nodes[(source, target)]
+
+def label_spec(stage, template_pair, opts):
+    '''
+    Canonical specification of the label image of <stage> (results, pvc or tka). Stages with the same
+    specification produce the same label image, so they can share a single Labels node.
+    '''
+    labels = tuple(sorted(set([ '%g' % float(label) for label in getattr(opts, stage+'_labels') ])))
+    template_pair = template_pair if template_pair[0] != None and template_pair[1] != None else None
+    return ( getattr(opts, stage+'_label_type'), getattr(opts, stage+'_label_img'), template_pair, getattr(opts, stage+'_label_space'),
+             labels, int(getattr(opts, stage+'_erode_times')), getattr(opts, stage+'_labels_brain_only'), getattr(opts, stage+'_labels_ones_only') )
+
+def get_labels_node(workflow, label_nodes, template_normalization_nodes, stage, inputnode, like_file, brain_mask_node, tfm_node, tfm_file, template_pair, opts):
+    '''
+    Return the Labels node that creates the label image of <stage> in the analysis space. A node is only created
+    for the first stage with a given label specification (see label_spec) and is reused by the other stages.
+    '''
+    spec = label_spec(stage, template_pair, opts)
+    if spec in label_nodes.keys() :
+        return label_nodes[spec]
+
+    labels = pe.Node(interface=Labels(), name=stage+"Labels")
+    labels.inputs.analysis_space = opts.analysis_space
+    labels.inputs.label_type = getattr(opts, stage+'_label_type')
+    labels.inputs.space = getattr(opts, stage+'_label_space')
+    labels.inputs.erode_times = getattr(opts, stage+'_erode_times')
+    labels.inputs.brain_only = getattr(opts, stage+'_labels_brain_only')
+    labels.inputs.ones_only = getattr(opts, stage+'_labels_ones_only')
+    workflow.connect(inputnode, stage+'_labels', labels, 'labels')
+    workflow.connect(inputnode, stage+'_label_img', labels, 'label_img')
+    if stage == "results" :
+        workflow.connect(inputnode, 'results_label_template', labels, 'label_template')
+    workflow.connect(inputnode, like_file, labels, 'like_file')
+    workflow.connect(brain_mask_node, "output_file", labels, 'brain_mask')
+    workflow.connect(tfm_node, tfm_file, labels, "LinXfm")
+
+    #Setup node for nonlinear alignment of the label template to the stereotaxic template
+    if getattr(opts, stage+'_label_template') != None :
+        template_norm = get_template_normalization(workflow, template_normalization_nodes, template_pair[0], template_pair[1], opts)
+
+        template_analysis_space = pe.Node(ConcatXfmRunning(), name=stage+"_template_analysis_space", run_without_submitting=True)
+        workflow.connect(template_norm, 'out_file_xfm', template_analysis_space, 'in_file' )
+        workflow.connect(tfm_node, tfm_file, template_analysis_space, 'in_file_2' )
+
+        workflow.connect(template_analysis_space, 'out_file', labels, 'nLinAtlasMNIXfm')
+
+    label_nodes[spec] = labels
+    return labels
+
 def get_workflow(name, infosource, opts):
     '''
         Create workflow to produce labeled images.
@@ -245,13 +246,13 @@ def get_workflow(name, infosource, opts):
         :returns: workflow
     '''
     workflow = pe.Workflow(name=name)
-    out_list=["pet_brain_mask", "brain_mask",  "results_label_img_t1", "results_label_img_mni" ]
+    out_list=["pet_brain_mask", "brain_mask",  "results_label_img_t1", "results_label_img_mni", "results_label_img" ]
     in_list=["nativeT1","mniT1","brain_mask_stereo", "brain_mask_t1", "pet_header_json", "pet_volume", "results_labels", "results_label_template","results_label_img", 'LinT1MNIXfm','LinMNIT1Xfm',  "LinPETMNIXfm", "LinMNIPETXfm",'LinT1MNIXfm', "LinT1PETXfm", "LinPETT1Xfm", "surf_left", 'surf_right']
     if not opts.pvc_method == None :
-        out_list += ["pvc_label_img_t1", "pvc_label_img_mni"]
+        out_list += ["pvc_label_img_t1", "pvc_label_img_mni", "pvc_label_img"]
         in_list += ["pvc_labels", "pvc_label_space", "pvc_label_img","pvc_label_template"]
     if not opts.tka_method == None:
-        out_list += ["tka_label_img_t1", "tka_label_img_mni"]
+        out_list += ["tka_label_img_t1", "tka_label_img_mni", "tka_label_img"]
         in_list +=  ["tka_labels", "tka_label_space","tka_label_template","tka_label_img"]
     #Define input node that will receive input from outside of workflow
     inputnode = pe.Node(niu.IdentityInterface(fields=in_list), name='inputnode')
@@ -272,6 +273,9 @@ def get_workflow(name, infosource, opts):
 
     results_tfm_node, results_tfm_file, results_target_file = get_transforms_for_stage(  inputnode, opts.results_label_space, opts.analysis_space, identity_transform)
 
+    #Nonlinear transformations between label templates and the stereotaxic template, shared between stages
+    template_normalization_nodes={}
+
     ###################
     # Brain Mask Node #
     ###################
@@ -317,92 +321,17 @@ def get_workflow(name, infosource, opts):
             workflow.connect(inputnode, "surf_right", surface_right_node, "output_file")
 
 
-    resultsLabels = pe.Node(interface=Labels(), name="resultsLabels")
-    resultsLabels.inputs.analysis_space = opts.analysis_space
-    resultsLabels.inputs.label_type = opts.results_label_type
-    resultsLabels.inputs.space = opts.results_label_space
-    resultsLabels.inputs.erode_times = opts.results_erode_times
-    resultsLabels.inputs.brain_only = opts.results_labels_brain_only
-    resultsLabels.inputs.ones_only = opts.results_labels_ones_only
-    workflow.connect(inputnode, 'results_labels', resultsLabels, 'labels')
-    workflow.connect(inputnode, 'results_label_img', resultsLabels, 'label_img')
-    workflow.connect(inputnode, 'results_label_template', resultsLabels, 'label_template')
-    workflow.connect(inputnode, like_file, resultsLabels, 'like_file')
-    workflow.connect(brain_mask_node,"output_file", resultsLabels, 'brain_mask')
-    workflow.connect(results_tfm_node, results_tfm_file, resultsLabels, "LinXfm")
-    
-    #Setup node for nonlinear alignment of results template to default (icbm152) template
-    if opts.results_label_template != None :
-        results_template_norm = pe.Node(interface=reg.nLinRegRunning(), name="results_template_normalization")
-        results_template_norm.inputs.in_target_file = opts.template
-        results_template_norm.inputs.in_source_file = opts.results_label_template
-        
-        results_template_analysis_space = pe.Node(ConcatNLCommand(), name="results_template_analysis_space")
-        workflow.connect(results_template_norm, 'out_file_xfm', results_template_analysis_space, 'in_file' )
-        workflow.connect(results_template_norm, 'out_file_warp', results_template_analysis_space, 'in_warp' )
-        workflow.connect(results_tfm_node, results_tfm_file, results_template_analysis_space, 'in_file_2' )
-                
-        workflow.connect(results_template_analysis_space, 'out_file', resultsLabels, 'nLinAtlasMNIXfm')
-        workflow.connect(results_template_analysis_space, 'out_warp', resultsLabels, 'warp')
-        workflow.connect(results_template_norm, 'out_file_img', resultsLabels, 'template')
+    #Stages with the same label specification share a single Labels node
+    label_nodes={}
+    results_labels_node = get_labels_node(workflow, label_nodes, template_normalization_nodes, "results", inputnode, like_file, brain_mask_node, results_tfm_node, results_tfm_file, (opts.results_label_template, opts.template), opts)
+    workflow.connect(results_labels_node, 'out_file', outputnode, 'results_label_img')
 
     if not opts.pvc_method == None and not opts.pvc_method == None:
-        pvcLabels = pe.Node(interface=Labels(), name="pvcLabels")
-        pvcLabels.inputs.analysis_space = opts.analysis_space
-        pvcLabels.inputs.label_type = opts.pvc_label_type
-        pvcLabels.inputs.space = opts.pvc_label_space
-        pvcLabels.inputs.erode_times = opts.pvc_erode_times
-        pvcLabels.inputs.brain_only = opts.pvc_labels_brain_only
-        pvcLabels.inputs.ones_only = opts.pvc_labels_ones_only
-        workflow.connect(inputnode, 'pvc_labels', pvcLabels, 'labels')
-        workflow.connect(inputnode, 'pvc_label_img', pvcLabels, 'label_img')
-        workflow.connect(inputnode, like_file, pvcLabels, 'like_file')
-        workflow.connect(brain_mask_node, "output_file", pvcLabels, 'brain_mask')
-        workflow.connect(pvc_tfm_node, pvc_tfm_file, pvcLabels, "LinXfm")
-
-
-        if opts.pvc_label_template != None :
-            pvc_template_norm = pe.Node(interface=reg.nLinRegRunning(), name="pvc_template_normalization")
-            pvc_template_norm.inputs.in_target_file = opts.template
-            pvc_template_norm.inputs.in_source_file = opts.pvc_label_template
-            
-            pvc_template_analysis_space = pe.Node(ConcatNLCommand(), name="pvc_template_analysis_space")
-            workflow.connect(pvc_template_norm, 'out_file_xfm', pvc_template_analysis_space, 'in_file' )
-            workflow.connect(pvc_template_norm, 'out_file_warp', pvc_template_analysis_space, 'in_warp' )
-            workflow.connect(pvc_tfm_node, pvc_tfm_file, pvc_template_analysis_space, 'in_file_2' )
-                    
-            workflow.connect(pvc_template_analysis_space, 'out_file', pvcLabels, 'nLinAtlasMNIXfm')
-            workflow.connect(pvc_template_analysis_space, 'out_warp', pvcLabels, 'warp')
-            workflow.connect(pvc_template_norm, 'out_file_img', pvcLabels, 'template')
-
+        pvc_labels_node = get_labels_node(workflow, label_nodes, template_normalization_nodes, "pvc", inputnode, like_file, brain_mask_node, pvc_tfm_node, pvc_tfm_file, (opts.pvc_label_template, opts.template), opts)
+        workflow.connect(pvc_labels_node, 'out_file', outputnode, 'pvc_label_img')
 
     if not opts.tka_method == None :
-        tkaLabels = pe.Node(interface=Labels(), name="tkaLabels")
-        tkaLabels.inputs.analysis_space = opts.analysis_space
-        tkaLabels.inputs.label_type = opts.tka_label_type
-        tkaLabels.inputs.space = opts.tka_label_space
-        tkaLabels.inputs.erode_times = opts.tka_erode_times
-        tkaLabels.inputs.brain_only = opts.tka_labels_brain_only
-        tkaLabels.inputs.ones_only = opts.tka_labels_ones_only
-        workflow.connect(inputnode, 'tka_labels', tkaLabels, 'labels')
-        workflow.connect(inputnode, 'tka_label_img', tkaLabels, 'label_img')
-        workflow.connect(inputnode, like_file, tkaLabels, 'like_file')
-        workflow.connect(brain_mask_node, "output_file", tkaLabels, 'brain_mask')
-        workflow.connect(tka_tfm_node, tka_tfm_file, tkaLabels, "LinXfm")
-
-
-        if opts.tka_label_template != None :
-            tka_template_norm = pe.Node(interface=reg.nLinRegRunning(), name="tka_template_normalization")
-            tka_template_norm.inputs.in_source_file = opts.template
-            tka_template_norm.inputs.in_target_file = opts.tka_label_template
-            
-            tka_template_analysis_space = pe.Node(ConcatNLCommand(), name="tka_template_analysis_space")
-            workflow.connect(tka_template_norm, 'out_file_xfm', tka_template_analysis_space, 'in_file' )
-            workflow.connect(tka_template_norm, 'out_file_warp', tka_template_analysis_space, 'in_warp' )
-            workflow.connect(tka_tfm_node, tka_tfm_file, tka_template_analysis_space, 'in_file_2' )
-                    
-            workflow.connect(tka_template_analysis_space, 'out_file', tkaLabels, 'nLinAtlasMNIXfm')
-            workflow.connect(tka_template_analysis_space, 'out_warp', tkaLabels, 'warp')
-            workflow.connect(tka_template_norm, 'out_file_img', tkaLabels, 'template')
+        tka_labels_node = get_labels_node(workflow, label_nodes, template_normalization_nodes, "tka", inputnode, like_file, brain_mask_node, tka_tfm_node, tka_tfm_file, (opts.template, opts.tka_label_template), opts)
+        workflow.connect(tka_labels_node, 'out_file', outputnode, 'tka_label_img')
 
     return(workflow)
@@ -2,7 +2,8 @@ from petpvc import petpvc4DCommand
 from pvc_template import *
 
 file_format="NIFTI"
-separate_labels=True
+#Van Cittert deconvolution does not use the labels, so they are not separated into a 4D volume
+separate_labels=False
 
 class pvcCommand(petpvc4DCommand):
     _suffix='VC'
@@ -54,8 +54,11 @@ def get_pvc_workflow(name, infosource, opts):
     fixHeaderNode = pe.Node(interface=FixHeaderLinkCommand(), name="fixHeaderNode")
     fixHeaderNode.inputs.time_only=True
 
+    #separate_labels="compact" : the labels are passed as a label index (.npz) instead of a 4D one-hot volume
+    compact_labels = pvc_module.separate_labels == "compact"
     if pvc_module.separate_labels :
         separate_mask_labelsNode = pe.Node( separate_mask_labelsCommand(), name="separate_mask_labels")
+        separate_mask_labelsNode.inputs.one_hot = not compact_labels
         workflow.connect(inputnode, 'mask_file', separate_mask_labelsNode, 'in_file' )
         mask_source=separate_mask_labelsNode
         mask_file="out_file"
@@ -64,8 +67,11 @@ def get_pvc_workflow(name, infosource, opts):
         convertPET=pe.Node(mnc2niiCommand(), name="convertPET")
         workflow.connect(inputnode, 'in_file', convertPET, 'in_file')
 
-        convertMask=pe.Node(interface=mnc2niiCommand(), name="convertMask")
-        workflow.connect(mask_source, mask_file, convertMask, 'in_file')
+        if not compact_labels :
+            convertMask=pe.Node(interface=mnc2niiCommand(), name="convertMask")
+            workflow.connect(mask_source, mask_file, convertMask, 'in_file')
+            mask_source = convertMask
+            mask_file="out_file"
 
         convertPVC=pe.Node(nii2mnc2Command(), name="convertPVC")
         convertPVC.inputs.truncate_path=True
@@ -73,8 +79,6 @@ def get_pvc_workflow(name, infosource, opts):
 
         pet_source = convertPET
         pet_file = "out_file"
-        mask_source = convertMask
-        mask_file="out_file"
         output_pvc_node = convertPVC
     elif pvc_module.file_format == "MINC"  :
         pet_source = inputnode
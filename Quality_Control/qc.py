@@ -28,10 +28,11 @@ from nipype.interfaces.base import (TraitedSpec, File, traits, InputMultiPath,
 from nipype.utils.filemanip import (load_json, save_json, split_filename, fname_presuffix, copyfile)
 import nipype.interfaces.io as nio
 from Extra.concat import concat_df
+from Extra.labels import label_index
 import matplotlib.pyplot as plt
 import seaborn as sns
 import inspect
-from scipy.ndimage.filters import gaussian_filter
+from Extra.smooth import gaussian_blur
 ######################
 #   Group-level QC   #
 ######################
@@ -154,6 +155,11 @@ import copy
 def pvc_mse(pvc_fn, pve_fn, fwhm):
     pvc = pyminc.volumeFromFile(pvc_fn)
     pve = pyminc.volumeFromFile(pve_fn)
+    #Scanner FWHM (z,y,x) in mm and voxel sizes, in the order in which the spatial dimensions are stored
+    fwhm_dims = dict(zip(['zspace', 'yspace', 'xspace'], np.array(fwhm, dtype=float) * np.ones(3)))
+    dims = [ d for d in pvc.dimnames if d in fwhm_dims ]
+    steps = [ pvc.separations[pvc.dimnames.index(d)] for d in dims ]
+    fwhm = [ fwhm_dims[d] for d in dims ]
     mse = 0 
     if len(pvc.data.shape) > 3 :#if volume has more than 3 dimensions
         t = int(pvc.sizes[0]/2)
@@ -162,13 +168,13 @@ def pvc_mse(pvc_fn, pve_fn, fwhm):
         pvc_frame = pvc.data[t,:,:,:]
 
         n = np.sum(pve.data[t,:,:,:]) # np.prod(pve.data.shape[0:4])
-        pvc_blur = gaussian_filter(pvc_frame,fwhm) 
+        pvc_blur, magnitude = gaussian_blur(pvc_frame, fwhm, steps)
         m = np.sum(np.sqrt((pve_frame - pvc_blur)**2))
         mse += m
         print t, m
     else : #volume has 3 dimensions
         n = np.sum(pve.data) # np.prod(pve.data.shape[0:3])
-        pvc_blur = gaussian_filter(pvc.data,fwhm) 
+        pvc_blur, magnitude = gaussian_blur(pvc.data, fwhm, steps)
         m = np.sum(np.sqrt((pve.data - pvc_blur)**2))
         mse += m
     mse = -mse /  n #np.sum(pve.data)
@@ -192,19 +198,13 @@ def temp_qc(vol0, mask0, vol1, mask1, out_fn):
 def distance(pet_fn, mri_fn, t1_brain_fn, dist_f_list):
     pet = pyminc.volumeFromFile(pet_fn)
     mri = pyminc.volumeFromFile(mri_fn)
-    t1_mask= pyminc.volumeFromFile(t1_brain_fn)
+    t1_mask = label_index(t1_brain_fn)
     #pet_mask= pyminc.volumeFromFile(pet_brain_fn)
 
-
-    pet_data=pet.data.flatten()
-    mri_data=mri.data.flatten()
-    t1_mask_data=t1_mask.data.flatten()
-    #pet_mask_data=pet_mask.data.flatten()
-    
     if not pet.data.shape == mri.data.shape : 
         print("Dimension mismatch between pet and mri:")
-        print(pet_fn, pet_mask.data.shape) 
-        print(mri_fn, t1_mask.data.shape)
+        print(pet_fn, pet.data.shape) 
+        print(mri_fn, mri.data.shape)
         exit(1)
 
     #if not t1_mask_data.shape == pet_mask_data.shape : 
@@ -213,23 +213,18 @@ def distance(pet_fn, mri_fn, t1_brain_fn, dist_f_list):
     #    print(t1_brain_fn, t1_mask.data.shape)
     #    exit(1)
 
-    overlap = t1_mask_data #* pet_mask_data
-    overlap[ overlap >= 1 ] = 1
     #temp_qc(np.array(pet.data), np.array(mri.data), np.array(t1_mask.data+pet_mask.data), pet_mask.data, os.path.basename(pet_fn)+'.png')
     #print(pet_fn)
     #print(mri_fn)
     #print(t1_brain_fn)
     #print(pet_brain_fn)
     
-    n=overlap.shape[0]
-    masked_pet_data = [ pet_data[i] for i in range(n) if int(overlap[i])  == 1 ] 
-    masked_mri_data = [ mri_data[i] for i in range(n) if  int(overlap[i]) == 1 ] 
+    #Voxels of the brain mask, gathered with the label index of the mask instead of a scan of the whole volume
+    masked_pet_data = t1_mask.gather(pet.data)
+    masked_mri_data = t1_mask.gather(mri.data)
     del pet
     del mri
-    del t1_mask
     #del pet_mask
-    del t1_mask_data
-    #del pet_mask_data
     dist_list=[]
     for dist_f in dist_f_list:
         dist_list.append(dist_f(masked_pet_data, masked_mri_data))
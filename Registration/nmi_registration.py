@@ -0,0 +1,348 @@
+import os
+import itertools
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.interpolation import map_coordinates
+from scipy.ndimage.measurements import center_of_mass
+from pyminc.volumes.factory import volumeLikeFile
+from nipype.interfaces.base import (TraitedSpec, File, traits, BaseInterface, BaseInterfaceInputSpec, isdefined)
+from Extra.xfm import read_xfm, write_xfm, read_volume, apply_matrix
+
+"""
+.. module:: nmi_registration
+    :platform: Unix
+    :synopsis: In-process linear registration of PET to T1 by maximization of normalized mutual information.
+"""
+
+fwhm_to_sigma = 1. / np.sqrt(8. * np.log(2.))
+
+#Number of parameters of the transformation, as with the -lsq<n> options of minctracc
+lsq_n_params = { 'lsq6':6, 'lsq7':7, 'lsq9':9, 'lsq12':12 }
+
+#Stages of the multi-resolution registration, same as the <conf> stages of PETtoT1LinRegRunning:
+#(blur fwhm in mm, sampling step in mm, default lsq)
+default_stages = [ (16, 8, 'lsq6'), (8, 4, 'lsq6'), (4, 4, 'lsq7'), (4, 4, 'lsq9'), (2, 2, 'lsq12') ]
+
+#Rotations (degrees) and translations (mm) about/along each axis of the seeds of the multi-start initialization
+default_seed_angles = [-15., 0., 15.]
+default_seed_offsets = [-15., 0., 15.]
+
+def _rotation(rx, ry, rz):
+    rx, ry, rz = np.radians([rx, ry, rz])
+    Rx = np.array([[1,0,0],[0,np.cos(rx),-np.sin(rx)],[0,np.sin(rx),np.cos(rx)]])
+    Ry = np.array([[np.cos(ry),0,np.sin(ry)],[0,1,0],[-np.sin(ry),0,np.cos(ry)]])
+    Rz = np.array([[np.cos(rz),-np.sin(rz),0],[np.sin(rz),np.cos(rz),0],[0,0,1]])
+    return np.dot(Rz, np.dot(Ry, Rx))
+
+def params_to_matrix(p, center):
+    '''
+    Convert the 12 parameters [tx, ty, tz, rx, ry, rz, sx, sy, sz, shx, shy, shz] (translations in mm,
+    rotations in degrees) into a 4x4 matrix. Rotations, scales and shears are applied around <center>.
+    '''
+    shear = np.array([[1, p[9], p[10]], [0, 1, p[11]], [0, 0, 1]])
+    linear = np.dot(_rotation(p[3], p[4], p[5]), np.dot(np.diag(p[6:9]), shear))
+    matrix = np.eye(4)
+    matrix[0:3,0:3] = linear
+    matrix[0:3,3] = center + p[0:3] - np.dot(linear, center)
+    return matrix
+
+def identity_params():
+    return np.array([0.,0.,0., 0.,0.,0., 1.,1.,1., 0.,0.,0.])
+
+def expand_params(x, p, lsq):
+    '''Set the parameters in <p> that are estimated for <lsq> to <x>'''
+    p = np.array(p, dtype=float)
+    if lsq == 'lsq7' :
+        p[0:6] = x[0:6]
+        p[6:9] = x[6]
+    else :
+        p[0:len(x)] = x
+    return p
+
+def reduce_params(p, lsq):
+    '''Parameters of <p> that are estimated for <lsq>'''
+    if lsq == 'lsq7' :
+        return np.concatenate([p[0:6], [np.mean(p[6:9])]])
+    return np.array(p[0:lsq_n_params[lsq]], dtype=float)
+
+def initial_steps(sampling_step, lsq):
+    '''Initial step of the optimizer for each estimated parameter'''
+    steps = [sampling_step]*3 + [sampling_step/2.]*3 + [0.02]*3 + [0.02]*3
+    if lsq == 'lsq7' :
+        return np.array(steps[0:7])
+    return np.array(steps[0:lsq_n_params[lsq]])
+
+def blur(data, fwhm, affine):
+    '''Gaussian blur with <fwhm> in mm for an image with voxel to world matrix <affine>'''
+    steps = np.sqrt(np.sum(affine[0:3,0:3]**2, axis=0))
+    return gaussian_filter(data, fwhm * fwhm_to_sigma / steps, mode='constant')
+
+class NMICost():
+    '''
+    Normalized mutual information (NMI) between a target image and a source image resampled into the
+    target image. The target is sampled once, on a regular grid with a spacing of <sampling_step> mm, and
+    the joint histogram of the samples is computed with numpy.bincount.
+    '''
+    def __init__(self, target, target_affine, source, source_affine, sampling_step, target_mask=None, n_bins=32):
+        self.n_bins = n_bins
+        self.source = source
+        self.source_world_to_voxel = np.linalg.inv(source_affine)
+
+        steps = np.sqrt(np.sum(target_affine[0:3,0:3]**2, axis=0))
+        stride = [ max(1, int(round(sampling_step / s))) for s in steps ]
+        idx = np.mgrid[0:target.shape[0]:stride[0], 0:target.shape[1]:stride[1], 0:target.shape[2]:stride[2]]
+        idx = idx.reshape(3,-1)
+        if target_mask is not None :
+            idx = idx[:, target_mask[idx[0], idx[1], idx[2]] > 0.5 ]
+        self.points = apply_matrix(target_affine, idx.astype(float))
+
+        self.target_bins = self._bins(target[idx[0], idx[1], idx[2]], target)
+        self.source_range = (np.min(source), np.max(source))
+
+    def _bins(self, values, data, value_range=None):
+        if value_range == None :
+            value_range = (np.min(data), np.max(data))
+        scale = (self.n_bins - 1) / max(value_range[1] - value_range[0], 1e-12)
+        return np.clip(((values - value_range[0]) * scale).astype(int), 0, self.n_bins - 1)
+
+    def resample(self, matrix):
+        '''Sample the source image at the target points, for the source to target transformation <matrix>'''
+        world_to_voxel = np.dot(self.source_world_to_voxel, np.linalg.inv(matrix))
+        voxels = apply_matrix(world_to_voxel, self.points)
+        return map_coordinates(self.source, voxels, order=1, mode='constant', cval=np.nan)
+
+    def __call__(self, matrix):
+        values = self.resample(matrix)
+        valid = np.isfinite(values)
+        #Transformations that move the source image out of the target are not valid
+        if np.sum(valid) < 0.1 * valid.shape[0] :
+            return 0.
+        source_bins = self._bins(values[valid], self.source, self.source_range)
+        joint = np.bincount(self.target_bins[valid] * self.n_bins + source_bins, minlength=self.n_bins**2)
+        joint = joint.reshape(self.n_bins, self.n_bins) / float(np.sum(valid))
+        return (_entropy(np.sum(joint, axis=0)) + _entropy(np.sum(joint, axis=1))) / _entropy(joint)
+
+def _entropy(p):
+    p = p[p > 0]
+    return -np.sum(p * np.log(p))
+
+def pattern_search(cost, x0, steps, pool, min_step_fraction=1/16., max_iterations=200):
+    '''
+    Maximize <cost> starting from <x0>. At each iteration, the cost of a step of +/-<steps> along every
+    parameter is evaluated in parallel with <pool>. The best step is taken if it improves the cost,
+    otherwise the steps are halved until they are smaller than <min_step_fraction> of the initial steps.
+    '''
+    x = np.array(x0, dtype=float)
+    steps = np.array(steps, dtype=float)
+    min_steps = steps * min_step_fraction
+    best = cost(x)
+    n_iterations = 0
+    while np.any(steps >= min_steps) and n_iterations < max_iterations :
+        candidates=[]
+        for i in range(x.shape[0]) :
+            for sign in [1., -1.] :
+                c = x.copy()
+                c[i] += sign * steps[i]
+                candidates.append(c)
+        values = pool.map(cost, candidates)
+        j = int(np.argmax(values))
+        if values[j] > best :
+            x = candidates[j]
+            best = values[j]
+        else :
+            steps /= 2.
+        n_iterations += 1
+    return x, best
+
+def _initialize(target, target_affine, source, source_affine, init_matrix=None):
+    '''
+    Return the initial transformation (default: align the centers of mass, as with -est_translations in
+    minctracc) and the point around which rotations, scales and shears are applied
+    '''
+    source_center = apply_matrix(source_affine, np.array(center_of_mass(source), dtype=float).reshape(3,1))[:,0]
+    if init_matrix is None :
+        target_center = apply_matrix(target_affine, np.array(center_of_mass(target), dtype=float).reshape(3,1))[:,0]
+        init_matrix = np.eye(4)
+        init_matrix[0:3,3] = target_center - source_center
+    center = apply_matrix(init_matrix, source_center.reshape(3,1))[:,0]
+    return init_matrix, center
+
+def _apply_masks(target, source, target_mask=None, source_mask=None):
+    if source_mask is not None :
+        source = np.where(source_mask > 0.5, source, 0)
+    if target_mask is not None :
+        target = np.where(target_mask > 0.5, target, 0)
+    return target, source
+
+def seed_params(angles=default_seed_angles, offsets=default_seed_offsets):
+    '''Parameters of the multi-start seeds: every combination of the rotations <angles> and translations <offsets>'''
+    seeds=[]
+    for rotation in itertools.product(angles, repeat=3) :
+        for translation in itertools.product(offsets, repeat=3) :
+            p = identity_params()
+            p[0:3] = translation
+            p[3:6] = rotation
+            seeds.append(p)
+    return seeds
+
+def multi_start(target, target_affine, source, source_affine, target_mask=None, source_mask=None, angles=default_seed_angles, offsets=default_seed_offsets, stage=default_stages[0], n_refine=4, num_threads=1, verbose=1):
+    '''
+    Robust initialization of the registration of <source> to <target>. The NMI of a grid of rigid seeds around
+    the alignment of the centers of mass is evaluated in parallel at the coarsest stage, the <n_refine> best
+    seeds are refined with a rigid (lsq6) search, and the matrix of the best refined seed is returned.
+    '''
+    target, source = _apply_masks(target, source, target_mask, source_mask)
+    fwhm, sampling_step = stage[0], stage[1]
+
+    pool = ThreadPool(num_threads)
+    target_blur, source_blur = pool.map(lambda args : blur(*args), [(target, fwhm, target_affine), (source, fwhm, source_affine)])
+    init_matrix, center = _initialize(target, target_affine, source, source_affine)
+    nmi = NMICost(target_blur, target_affine, source_blur, source_affine, sampling_step, target_mask)
+    cost = lambda p : nmi(np.dot(params_to_matrix(p, center), init_matrix))
+
+    seeds = seed_params(angles, offsets)
+    values = pool.map(cost, seeds)
+    best_p = best = None
+    for j in np.argsort(values)[::-1][0:n_refine] :
+        seed = seeds[j]
+        x, value = pattern_search(lambda x : cost(expand_params(x, seed, 'lsq6')), reduce_params(seed, 'lsq6'), initial_steps(sampling_step, 'lsq6'), pool)
+        if verbose >= 1 :
+            print('Multi-start seed '+' '.join([ '%.1f' % v for v in seed[0:6] ])+': NMI='+str(values[j])+' -> '+str(value))
+        if best is None or value > best :
+            best_p = expand_params(x, seed, 'lsq6')
+            best = value
+    pool.close()
+    return np.dot(params_to_matrix(best_p, center), init_matrix)
+
+def multi_start_xfm(source_file, target_file, out_file, source_mask_file=None, target_mask_file=None, angles=default_seed_angles, offsets=default_seed_offsets, num_threads=1, verbose=1):
+    '''Run the multi-start initialization on MINC files and write the initial transformation to <out_file>'''
+    target, target_affine, target_vol = read_volume(target_file)
+    source, source_affine, source_vol = read_volume(source_file)
+    target_vol.closeVolume()
+    source_vol.closeVolume()
+    target_mask = source_mask = None
+    if target_mask_file != None :
+        target_mask = read_volume(target_mask_file)[0]
+    if source_mask_file != None :
+        source_mask = read_volume(source_mask_file)[0]
+    matrix = multi_start(target, target_affine, source, source_affine, target_mask, source_mask, angles, offsets, num_threads=num_threads, verbose=verbose)
+    return write_xfm(out_file, matrix, ' multi-start initialization of '+source_file+' to '+target_file)
+
+def register(target, target_affine, source, source_affine, init_matrix=None, target_mask=None, source_mask=None, stages=default_stages, lsq=None, num_threads=1, verbose=1):
+    '''
+    Multi-resolution linear registration of <source> to <target>. The Gaussian pyramid of both images is
+    kept in memory. Returns the 4x4 matrix that maps source world coordinates to target world coordinates.
+    '''
+    target, source = _apply_masks(target, source, target_mask, source_mask)
+
+    pool = ThreadPool(num_threads)
+    fwhm_list = sorted(set([ s[0] for s in stages ]))
+    target_pyramid = dict(zip(fwhm_list, pool.map(lambda fwhm : blur(target, fwhm, target_affine), fwhm_list)))
+    source_pyramid = dict(zip(fwhm_list, pool.map(lambda fwhm : blur(source, fwhm, source_affine), fwhm_list)))
+
+    init_matrix, center = _initialize(target, target_affine, source, source_affine, init_matrix)
+
+    p = identity_params()
+    for fwhm, sampling_step, stage_lsq in stages :
+        if lsq != None :
+            stage_lsq = lsq
+        nmi = NMICost(target_pyramid[fwhm], target_affine, source_pyramid[fwhm], source_affine, sampling_step, target_mask)
+        cost = lambda x : nmi(np.dot(params_to_matrix(expand_params(x, p, stage_lsq), center), init_matrix))
+        x, best = pattern_search(cost, reduce_params(p, stage_lsq), initial_steps(sampling_step, stage_lsq), pool)
+        p = expand_params(x, p, stage_lsq)
+        if verbose >= 1 :
+            print('NMI registration: fwhm='+str(fwhm)+' step='+str(sampling_step)+' '+stage_lsq+' NMI='+str(best))
+            print('    parameters: '+' '.join([ '%.4f' % v for v in p ]))
+    pool.close()
+    return np.dot(params_to_matrix(p, center), init_matrix)
+
+def resample_volume(source, source_affine, matrix, shape, target_affine):
+    '''Resample <source> into the grid of the target with trilinear interpolation, one slice at a time'''
+    out = np.zeros(shape, dtype=np.float32)
+    world_to_voxel = np.dot(np.linalg.inv(source_affine), np.linalg.inv(matrix))
+    idx = np.mgrid[0:1, 0:shape[1], 0:shape[2]].reshape(3,-1).astype(float)
+    for k in range(shape[0]) :
+        idx[0,:] = k
+        voxels = apply_matrix(np.dot(world_to_voxel, target_affine), idx)
+        out[k] = map_coordinates(source, voxels, order=1, mode='constant', cval=0.).reshape(shape[1], shape[2])
+    return out
+
+
+class PETtoT1NativeRegOutput(TraitedSpec):
+    out_file_xfm = File(desc="transformation matrix")
+    out_file_xfm_invert = File(desc="inverted transformation matrix")
+    out_file_img = File(desc="resampled image 3d")
+
+class PETtoT1NativeRegInput(BaseInterfaceInputSpec):
+    in_target_file = File(exists=True, mandatory=True, desc="target image")
+    in_source_file = File(exists=True, mandatory=True, desc="source image")
+    in_target_mask = File(exists=True, desc="target mask")
+    in_source_mask = File(exists=True, desc="source mask")
+    init_file_xfm = File(exists=True, desc="initial transformation (default: align centers of mass)")
+    out_file_xfm = File(desc="transformation matrix")
+    out_file_xfm_invert = File(desc="inverted transformation matrix")
+    out_file_img = File(desc="resampled image")
+    lsq = traits.String(desc="Number of parameters to use for transformation")
+    multi_start = traits.Bool(usedefault=True, default_value=False, desc="Initialize with the best of a grid of rigid seeds (when init_file_xfm is not defined)")
+    seed_angles = traits.List(traits.Float, value=default_seed_angles, usedefault=True, desc="Rotations (degrees) of the multi-start seeds about each axis")
+    seed_offsets = traits.List(traits.Float, value=default_seed_offsets, usedefault=True, desc="Translations (mm) of the multi-start seeds along each axis")
+    num_threads = traits.Int(usedefault=True, default_value=1, desc="Number of threads used to evaluate the cost function")
+    verbose = traits.Int(usedefault=True, default_value=1, desc="Write messages indicating progress")
+
+class PETtoT1NativeRegRunning(BaseInterface):
+    '''
+    Alternative to PETtoT1LinRegRunning that runs the registration in-process instead of calling mincblur,
+    minctracc and mincresample at every stage. Same outputs as PETtoT1LinRegRunning.
+    '''
+    input_spec = PETtoT1NativeRegInput
+    output_spec = PETtoT1NativeRegOutput
+    _suffix = "_LinReg"
+
+    def _set_outputs(self):
+        s_base = os.path.basename(os.path.splitext(self.inputs.in_source_file)[0])
+        t_base = os.path.basename(os.path.splitext(self.inputs.in_target_file)[0])
+        if not isdefined(self.inputs.out_file_xfm):
+            self.inputs.out_file_xfm = os.getcwd()+os.sep+s_base+self._suffix+'.xfm'
+        if not isdefined(self.inputs.out_file_xfm_invert):
+            self.inputs.out_file_xfm_invert = os.getcwd()+os.sep+t_base+self._suffix+'.xfm'
+        if not isdefined(self.inputs.out_file_img):
+            self.inputs.out_file_img = os.getcwd()+os.sep+s_base+self._suffix+'.mnc'
+
+    def _run_interface(self, runtime):
+        self._set_outputs()
+        target, target_affine, target_vol = read_volume(self.inputs.in_target_file)
+        source, source_affine, source_vol = read_volume(self.inputs.in_source_file)
+        target_vol.closeVolume()
+        source_vol.closeVolume()
+
+        target_mask = source_mask = init_matrix = lsq = None
+        if isdefined(self.inputs.in_target_mask) :
+            target_mask = read_volume(self.inputs.in_target_mask)[0]
+        if isdefined(self.inputs.in_source_mask) :
+            source_mask = read_volume(self.inputs.in_source_mask)[0]
+        if isdefined(self.inputs.init_file_xfm) :
+            init_matrix = read_xfm(self.inputs.init_file_xfm)
+        elif self.inputs.multi_start :
+            init_matrix = multi_start(target, target_affine, source, source_affine, target_mask, source_mask, self.inputs.seed_angles, self.inputs.seed_offsets, num_threads=self.inputs.num_threads, verbose=self.inputs.verbose)
+        if isdefined(self.inputs.lsq) :
+            lsq = self.inputs.lsq
+
+        matrix = register(target, target_affine, source, source_affine, init_matrix=init_matrix, target_mask=target_mask, source_mask=source_mask, lsq=lsq, num_threads=self.inputs.num_threads, verbose=self.inputs.verbose)
+
+        write_xfm(self.inputs.out_file_xfm, matrix, ' NMI registration of '+self.inputs.in_source_file+' to '+self.inputs.in_target_file)
+        write_xfm(self.inputs.out_file_xfm_invert, np.linalg.inv(matrix))
+
+        out = volumeLikeFile(self.inputs.in_target_file, self.inputs.out_file_img, dtype='float', volumeType='float')
+        out.data = resample_volume(source, source_affine, matrix, target.shape, target_affine)
+        out.writeFile()
+        out.closeVolume()
+        return runtime
+
+    def _list_outputs(self):
+        self._set_outputs()
+        outputs = self.output_spec().get()
+        outputs["out_file_xfm"] = self.inputs.out_file_xfm
+        outputs["out_file_xfm_invert"] = self.inputs.out_file_xfm_invert
+        outputs["out_file_img"] = self.inputs.out_file_img
+        return outputs
@@ -3,6 +3,7 @@
 import os
 import re
 import numpy as np
+from scipy.ndimage.morphology import binary_fill_holes
 
 import tempfile
 import shutil
@@ -22,10 +23,16 @@ import nipype.interfaces.minc as minc
 
 from nipype.interfaces.minc import Calc as CalcCommand
 from Extra.tracc import TraccCommand
+from Extra.calc import CalcRunning
 
 import nipype.interfaces.minc as minc
-from Extra.xfmOp import ConcatCommand
+from Extra.xfmOp import ConcatCommand, ConcatXfmRunning, InvertXfmRunning
+from Extra.xfm import invert_xfm_file, read_xfm, xfm_delta, image_center, grid_displacement_rms
+from Extra.transform_chain import ApplyTransformChainRunning, grid_files, copy_xfm
 from Extra.inormalize import InormalizeCommand
+from Extra.minc_filemanip import file_md5
+from Extra.smooth import cached_blur, blur_cache_key, blur_image
+from Registration.nmi_registration import PETtoT1NativeRegRunning, multi_start_xfm, default_seed_angles, default_seed_offsets
 #from Extra.compression import gzipResampleCommand
 from Extra.modifHeader import FixHeaderCommand, FixHeaderLinkCommand
 
@@ -38,11 +45,45 @@ class PETheadMaskingInput(BaseInterfaceInputSpec):
     out_file = File(desc="Head mask")
     slice_factor = traits.Float(usedefault=True, default_value=0.25, desc="Value (between 0. to 1.) that is multiplied by the maximum of the slices of the PET image. Used to threshold slices. Lower value means larger mask")
     total_factor = traits.Float(usedefault=True, default_value=0.333, desc="Value (between 0. to 1.) that is multiplied by the thresholded means of each slice. ")
+    threshold_method = traits.Enum('slice-mean', 'otsu', 'percentile', usedefault=True, desc="Method used to compute the threshold: slice-mean (slice_factor and total_factor), otsu or percentile")
+    percentile = traits.Float(usedefault=True, default_value=50., desc="Percentile of the non-zero voxels used as threshold with the percentile method")
+    fill_holes = traits.Bool(usedefault=True, default_value=False, desc="Fill the holes of the head mask")
 
     clobber = traits.Bool(usedefault=True, default_value=True, desc="Overwrite output file")
     run = traits.Bool(usedefault=True, default_value=True, desc="Run the commands")
     verbose = traits.Int(usedefault=True, default_value=True, desc="Write messages indicating progress")
 
+def otsu_threshold(values, n_bins=256):
+    '''Threshold that maximizes the between-class variance of <values> (Otsu's method)'''
+    counts, edges = np.histogram(values, bins=n_bins)
+    centers = (edges[:-1] + edges[1:]) / 2.
+    weight_0 = np.cumsum(counts).astype(float)
+    weight_1 = weight_0[-1] - weight_0
+    sum_0 = np.cumsum(counts * centers)
+    mean_0 = sum_0 / np.maximum(weight_0, 1)
+    mean_1 = (sum_0[-1] - sum_0) / np.maximum(weight_1, 1)
+    variance = weight_0 * weight_1 * (mean_0 - mean_1)**2
+    return edges[int(np.argmax(variance)) + 1]
+
+def head_mask_threshold(data, method='slice-mean', slice_factor=0.25, total_factor=0.333, percentile=50.):
+    '''
+    Threshold of the PET head mask. With the slice-mean method, the voxels of each slice (first dimension)
+    above <slice_factor> times the maximum of the slice are averaged, and the threshold is <total_factor>
+    times the mean of the slice means. The otsu and percentile methods use the non-zero voxels of the image.
+    '''
+    if method == 'otsu' :
+        return otsu_threshold(data[data > 0])
+    if method == 'percentile' :
+        return np.percentile(data[data > 0], percentile)
+
+    slice_thresholds = np.amax(data, axis=(1,2)) * slice_factor
+    above = data > slice_thresholds.reshape(-1,1,1)
+    counts = np.sum(above, axis=(1,2))
+    sums = np.sum(np.where(above, data, 0), axis=(1,2))
+    #Slices without voxels above their threshold have no mean
+    slice_mean = sums[counts > 0] / counts[counts > 0]
+    return np.mean(slice_mean) * total_factor
+
 class PETheadMasking(BaseInterface):
     input_spec = PETheadMaskingInput
     output_spec = PETheadMaskingOutput
@@ -53,29 +94,24 @@ class PETheadMasking(BaseInterface):
             base = os.path.basename(self.inputs.in_file)
             split = os.path.splitext(base)
             self.inputs.out_file = os.getcwd() +os.sep + split[0] + self._suffix + split[1]
-            #Load PET 3D volume
+        #Load PET 3D volume
         infile = volumeFromFile(self.inputs.in_file)
-        zmax=infile.sizes[infile.dimnames.index("zspace")]
-        #Get max slice values and multiply by pet_mask_slice_threshold (0.25 by default)
-        slice_thresholds=np.amax(infile.data, axis=(1,2)) * self.inputs.slice_factor
-        #Get mean for all values above slice_max
-        slice_mean_f=lambda t, d, i: float(np.mean(d[i, d[i,:,:] > t[i]]))
-        slice_mean = np.array([ slice_mean_f(slice_thresholds, infile.data, i)  for i in range(zmax) ])
-        #Remove nan from slice_mean
-        slice_mean =slice_mean[ ~ np.isnan(slice_mean) ]
-        #Calculate overall mean from mean of thresholded slices
-        overall_mean = np.mean(slice_mean)
-        #Calcuate threshold
-        threshold = overall_mean * self.inputs.total_factor
-        #Apply threshold and create and write outputfile
-        run_calc = CalcCommand();
-        run_calc.inputs.input_files = self.inputs.in_file
-        run_calc.inputs.output_file = self.inputs.out_file
-        run_calc.inputs.expression = 'A[0] >= '+str(threshold)+' ? 1 : 0'
+        data = np.array(infile.data, dtype=np.float32)
+        infile.closeVolume()
+
+        threshold = head_mask_threshold(data, self.inputs.threshold_method, self.inputs.slice_factor, self.inputs.total_factor, self.inputs.percentile)
         if self.inputs.verbose:
-            print run_calc.cmdline
+            print 'PET head mask threshold ('+self.inputs.threshold_method+'):', threshold
+
+        #Apply threshold and write the mask
+        mask = data >= threshold
+        if self.inputs.fill_holes :
+            mask = binary_fill_holes(mask)
         if self.inputs.run:
-            run_calc.run()
+            out = volumeLikeFile(self.inputs.in_file, self.inputs.out_file)
+            out.data = mask.astype(np.float32)
+            out.writeFile()
+            out.closeVolume()
 
         return runtime
 
@@ -91,6 +127,7 @@ class PETtoT1LinRegOutput(TraitedSpec):
     out_file_xfm = File(desc="transformation matrix")
     out_file_xfm_invert = File(desc="inverted transformation matrix")
     out_file_img = File(desc="resampled image 3d")
+    n_stages = traits.Int(desc="Number of registration stages that were run")
 
 class PETtoT1LinRegInput(BaseInterfaceInputSpec):
     in_target_file = File(position=0, argstr="%s", exists=True, mandatory=True, desc="target image")
@@ -107,11 +144,23 @@ class PETtoT1LinRegInput(BaseInterfaceInputSpec):
     clobber = traits.Bool(position=-5, argstr="-clobber", usedefault=True, default_value=True, desc="Overwrite output file")
     run = traits.Bool(position=-4, argstr="-run", usedefault=True, default_value=True, desc="Run the commands")
     verbose = traits.Int( argstr="-verbose", usedefault=True, default_value=True, desc="Write messages indicating progress")
+    blur_cache_dir = traits.Str(desc="Directory where blurred images are stored (default=<working directory>/blur_cache)")
+    early_exit = traits.Bool(usedefault=True, default_value=False, desc="Stop when the transformation changes less than the tolerances between two stages")
+    tolerance_translation = traits.Float(usedefault=True, default_value=0.5, desc="Tolerance on the change in translation between stages (mm)")
+    tolerance_rotation = traits.Float(usedefault=True, default_value=0.5, desc="Tolerance on the change in rotation between stages (degrees)")
+    transforms_only = traits.Bool(usedefault=True, default_value=False, desc="Only write the transformation of each stage, without resampling the source image")
+    write_image = traits.Bool(usedefault=True, default_value=True, desc="Write the source image resampled with the final transformation (out_file_img)")
+    multi_start = traits.Bool(usedefault=True, default_value=False, desc="Initialize with the best of a grid of rigid seeds (when init_file_xfm is not defined)")
+    seed_angles = traits.List(traits.Float, value=default_seed_angles, usedefault=True, desc="Rotations (degrees) of the multi-start seeds about each axis")
+    seed_offsets = traits.List(traits.Float, value=default_seed_offsets, usedefault=True, desc="Translations (mm) of the multi-start seeds along each axis")
+    num_threads = traits.Int(usedefault=True, default_value=1, desc="Number of threads used to evaluate the seeds and to blur the images")
+    blur_method = traits.Enum('mincblur', 'native', usedefault=True, desc="Method used to blur the images at each stage")
 
 class PETtoT1LinRegRunning(BaseInterface):
     input_spec = PETtoT1LinRegInput
     output_spec = PETtoT1LinRegOutput
     _suffix = "_LinReg"
+    _n_stages = 0
 
 
     def _run_interface(self, runtime):
@@ -135,6 +184,15 @@ class PETtoT1LinRegRunning(BaseInterface):
         if self.inputs.init_file_xfm:
             prev_xfm = self.inputs.init_file_xfm
 
+        blur_cache_dir = os.getcwd() + os.sep + 'blur_cache'
+        if isdefined(self.inputs.blur_cache_dir) :
+            blur_cache_dir = self.inputs.blur_cache_dir
+
+        #Blurred images are cached by the content of the files that define them, not by the content 
+        #of the masked images written in tmpDir, which differ between runs
+        source_key = [self.inputs.in_source_file]
+        target_key = [self.inputs.in_target_file]
+
         source = self.inputs.in_source_file
         target = self.inputs.in_target_file
         s_base = basename(os.path.splitext(source)[0])
@@ -143,8 +201,7 @@ class PETtoT1LinRegRunning(BaseInterface):
         if self.inputs.in_source_mask and self.inputs.in_target_mask:
             if os.path.isfile(self.inputs.in_source_mask):
                 source = tmpDir+"/"+s_base+"_masked.mnc"
-                #run_calc = CalcCommand();
-                run_calc = minc.Calc();
+                run_calc = CalcRunning();
                 #MIC run_calc.inputs.in_file = [self.inputs.in_source_file, self.inputs.in_source_mask]
                 run_calc.inputs.input_files = [self.inputs.in_source_file, self.inputs.in_source_mask]
                 #MIC run_calc.inputs.out_file = source
@@ -154,9 +211,10 @@ class PETtoT1LinRegRunning(BaseInterface):
                 # run_calc.inputs.expression='if(A[1]>0.5){out=A[0];}else{out=A[1];}'
                 run_calc.inputs.expression='A[1] > 0.5 ? A[0] : A[1]'
                 if self.inputs.verbose >= 2:
-                    print run_calc.cmdline
+                    print run_calc.inputs.expression
                 if self.inputs.run:
                     run_calc.run()
+                source_key.append(self.inputs.in_source_mask)
 
 
             if os.path.isfile(self.inputs.in_target_mask):
@@ -168,9 +226,23 @@ class PETtoT1LinRegRunning(BaseInterface):
                 print 'Target Mask:', target
                 run_calc.inputs.expression='A[1] > 0.5 ? A[0] : A[1]'
                 if self.inputs.verbose >= 2:
-                    print run_calc.cmdline
+                    print run_calc.inputs.expression
                 if self.inputs.run:
                     run_calc.run()
+                target_key.append(self.inputs.in_target_mask)
+
+        source_key = blur_cache_key(source_key)
+        target_key = blur_cache_key(target_key)
+
+        multi_started = False
+        if self.inputs.multi_start and not prev_xfm and self.inputs.run :
+            source_mask = target_mask = None
+            if self.inputs.in_source_mask and os.path.isfile(self.inputs.in_source_mask) :
+                source_mask = self.inputs.in_source_mask
+            if self.inputs.in_target_mask and os.path.isfile(self.inputs.in_target_mask) :
+                target_mask = self.inputs.in_target_mask
+            prev_xfm = multi_start_xfm(self.inputs.in_source_file, self.inputs.in_target_file, tmpDir+"/"+s_base+"_multi_start.xfm", source_mask, target_mask, self.inputs.seed_angles, self.inputs.seed_offsets, self.inputs.num_threads, self.inputs.verbose)
+            multi_started = True
 
         class conf:
             def __init__(self, type_, est, blur_fwhm_target, blur_fwhm_source, steps, tolerance, simplex, lsq, blur_gradient):
@@ -209,15 +281,20 @@ class PETtoT1LinRegRunning(BaseInterface):
 
         #conf_list = [ conf0 ] #, conf1, conf2, conf3, conf4 ]
         conf_list = [  conf0, conf1, conf2, conf3, conf4 ]
+        if multi_started :
+            #The translations of the initial transformation must not be re-estimated from the centers of mass
+            conf0.est = ""
+
+        if self.inputs.early_exit :
+            center = image_center(self.inputs.in_source_file)
 
         i=1
         for confi in conf_list:
-            tmp_source=tmpDir+"/"+s_base+"_fwhm"+str(confi.blur_fwhm_source)
-            tmp_source_blur_base=tmpDir+"/"+s_base+"_fwhm"+str(confi.blur_fwhm_source)
-            tmp_source_blur=tmpDir+"/"+s_base+"_fwhm"+str(confi.blur_fwhm_source)+"_"+confi.type_+".mnc"
-            tmp_target=tmpDir+"/"+t_base+"_fwhm"+str(confi.blur_fwhm_target)
-            tmp_target_blur_base=tmpDir+"/"+t_base+"_fwhm"+str(confi.blur_fwhm_target)
-            tmp_target_blur=tmpDir+"/"+t_base+"_fwhm"+str(confi.blur_fwhm_target)+"_"+confi.type_+".mnc"
+            #Blur with the gradient if any stage at the same fwhm needs it, so that each fwhm is only blurred once
+            target_gradient = True in [ c.blur_gradient for c in conf_list if c.blur_fwhm_target == confi.blur_fwhm_target ]
+            source_gradient = True in [ c.blur_gradient for c in conf_list if c.blur_fwhm_source == confi.blur_fwhm_source ]
+            tmp_target_blur = cached_blur(target, confi.blur_fwhm_target, blur_cache_dir, key=target_key, gradient=target_gradient, method=self.inputs.blur_method, num_threads=self.inputs.num_threads, verbose=self.inputs.verbose)
+            tmp_source_blur = cached_blur(source, confi.blur_fwhm_source, blur_cache_dir, key=source_key, gradient=source_gradient, no_apodize=True, method=self.inputs.blur_method, num_threads=self.inputs.num_threads, verbose=self.inputs.verbose)
             tmp_xfm = tmpDir+"/"+t_base+"_conf"+str(i)+".xfm";
             tmp_rspl_vol = tmpDir+"/"+s_base+"_conf"+str(i)+".mnc";
 
@@ -230,30 +307,10 @@ class PETtoT1LinRegRunning(BaseInterface):
             print '       | source : \t\t'+ tmp_source_blur
             print '       | target : \t\t'+ tmp_target_blur
             print '       | xfm : \t\t\t'+ tmp_xfm
-            print '       | out : \t\t\t'+ tmp_rspl_vol
+            if not self.inputs.transforms_only :
+                print '       | out : \t\t\t'+ tmp_rspl_vol
             print '\n'
 
-            run_smooth = minc.Blur();
-            run_smooth.inputs.input_file=target
-            run_smooth.inputs.fwhm=confi.blur_fwhm_target
-            run_smooth.inputs.output_file_base=tmp_target_blur_base
-            if confi.blur_gradient :
-                run_smooth.inputs.gradient=True
-
-            print run_smooth.cmdline
-            run_smooth.run()
-
-            run_smooth = minc.Blur();
-            run_smooth.inputs.input_file=source
-            run_smooth.inputs.fwhm=confi.blur_fwhm_source
-            run_smooth.inputs.output_file_base=tmp_source_blur_base
-            if confi.blur_gradient :
-                run_smooth.inputs.gradient=True
-            run_smooth.inputs.no_apodize=True
-
-            print run_smooth.cmdline
-            run_smooth.run()
-
             run_tracc = TraccCommand();
             run_tracc.inputs.in_source_file=tmp_source_blur
             run_tracc.inputs.in_target_file=tmp_target_blur
@@ -281,15 +338,27 @@ class PETtoT1LinRegRunning(BaseInterface):
             run_resample.inputs.output_file=tmp_rspl_vol
             run_resample.inputs.like=target
             run_resample.inputs.transformation=tmp_xfm
-            if self.inputs.verbose >= 2:
+            if self.inputs.verbose >= 2 and not self.inputs.transforms_only:
                 print run_resample.cmdline
-            if self.inputs.run:
+            if self.inputs.run and not self.inputs.transforms_only:
                 run_resample.run()
 
+            #Only compare two minctracc stages: an initial transformation (init_file_xfm or multi-start) can be
+            #close to the result of the coarsest stage without the finer stages having been run
+            converged = False
+            if self.inputs.early_exit and self.inputs.run and i > 1 :
+                translation, rotation = xfm_delta(read_xfm(prev_xfm), read_xfm(tmp_xfm), center)
+                print '       | change : \t\t%.3f mm, %.3f deg' % (translation, rotation)
+                converged = translation < self.inputs.tolerance_translation and rotation < self.inputs.tolerance_rotation
+
             prev_xfm = tmp_xfm
+            self._n_stages = i
             i += 1
 
             print '\n'
+            if converged :
+                print 'Converged after '+str(self._n_stages)+' of '+str(len(conf_list))+' stages\n'
+                break
 
 
         #No need for this because the final xfm file includes the initial one
@@ -321,12 +390,12 @@ class PETtoT1LinRegRunning(BaseInterface):
             shutil.copy(tmp_xfm, self.inputs.out_file_xfm)
 
         #Invert transformation
-        run_xfmpetinvert = minc.XfmInvert();
-        run_xfmpetinvert.inputs.input_file = self.inputs.out_file_xfm
-        run_xfmpetinvert.inputs.output_file = self.inputs.out_file_xfm_invert
-        if self.inputs.verbose >= 2:
-            print run_xfmpetinvert.cmdline
-        if self.inputs.run:
+        if self.inputs.run and not invert_xfm_file(self.inputs.out_file_xfm, self.inputs.out_file_xfm_invert) :
+            run_xfmpetinvert = minc.XfmInvert();
+            run_xfmpetinvert.inputs.input_file = self.inputs.out_file_xfm
+            run_xfmpetinvert.inputs.output_file = self.inputs.out_file_xfm_invert
+            if self.inputs.verbose >= 2:
+                print run_xfmpetinvert.cmdline
             run_xfmpetinvert.run()
 
 
@@ -344,9 +413,9 @@ class PETtoT1LinRegRunning(BaseInterface):
         print self.inputs.out_file_xfm_invert
         print self.inputs.out_file_img, '\n\n'
 
-        if self.inputs.verbose >= 2:
+        if self.inputs.verbose >= 2 and self.inputs.write_image:
             print run_resample.cmdline
-        if self.inputs.run:
+        if self.inputs.run and self.inputs.write_image:
             run_resample.run()
 
         #shutil.rmtree(tmpDir)
@@ -364,7 +433,9 @@ class PETtoT1LinRegRunning(BaseInterface):
 
         outputs["out_file_xfm"] = self.inputs.out_file_xfm
         outputs["out_file_xfm_invert"] = self.inputs.out_file_xfm_invert
-        outputs["out_file_img"] = self.inputs.out_file_img
+        if self.inputs.write_image :
+            outputs["out_file_img"] = self.inputs.out_file_img
+        outputs["n_stages"] = self._n_stages
 
         return outputs
 
@@ -373,6 +444,7 @@ class nLinRegOutput(TraitedSpec):
     out_file_img = File(exists=True, desc="resampled image")
     out_file_warp = File(exists=True, desc="deformation_field")
     out_file_xfm = File(exists=True, desc="transformation matrix")
+    n_stages = traits.Int(desc="Number of registration stages that were run")
 
 class nLinRegInput(BaseInterfaceInputSpec):
     in_target_file = File(position=0, argstr="%s", exists=True, mandatory=True, desc="target image")
@@ -388,11 +460,18 @@ class nLinRegInput(BaseInterfaceInputSpec):
     clobber = traits.Bool(position=-5, argstr="-clobber", usedefault=True, default_value=True, desc="Overwrite output file")
     run = traits.Bool(position=-4, argstr="-run", usedefault=True, default_value=True, desc="Run the commands")
     verbose = traits.Int(position=-3, argstr="-verbose", usedefault=True, default_value=True, desc="Write messages indicating progress")
+    early_exit = traits.Bool(usedefault=True, default_value=False, desc="Stop when the deformation changes less than the tolerance between two stages")
+    tolerance_displacement = traits.Float(usedefault=True, default_value=0.5, desc="Tolerance on the RMS change in displacement between stages (mm)")
+    transforms_only = traits.Bool(usedefault=True, default_value=False, desc="Only write the transformation of each stage, without resampling the source image")
+    write_image = traits.Bool(usedefault=True, default_value=True, desc="Write the source image resampled with the final transformation (out_file_img)")
+    blur_method = traits.Enum('mincblur', 'native', usedefault=True, desc="Method used to blur the images at each stage")
+    num_threads = traits.Int(usedefault=True, default_value=1, desc="Number of threads used to blur the images")
 
 class nLinRegRunning(BaseInterface):
     input_spec = nLinRegInput
     output_spec = nLinRegOutput
     _suffix = "_NlReg"
+    _n_stages = 0
 
     def _gen_filename(self, f,suffix, ext='.xfm'):
         base = basename(os.path.splitext(re.sub('.gz','',f))[0])
@@ -495,48 +574,37 @@ class nLinRegRunning(BaseInterface):
             print '       | source : \t\t'+ tmp_source_blur
             print '       | target : \t\t'+ tmp_target_blur
             print '       | xfm : \t\t\t'+ tmp_xfm
-            print '       | out : \t\t\t'+ tmp_rspl_vol
+            if not self.inputs.transforms_only :
+                print '       | out : \t\t\t'+ tmp_rspl_vol
             print '\n'
 
             if self.inputs.in_source_mask and self.inputs.in_target_mask:
                 if os.path.isfile(self.inputs.in_source_mask) and not os.path.exists(tmpDir+"/"+s_base+"_masked.mnc"):
                     source = tmpDir+"/"+s_base+"_masked.mnc"
-                    run_calc = minc.Calc();
+                    run_calc = CalcRunning();
                     run_calc.inputs.input_files = [inorm_source, self.inputs.in_source_mask]
                     run_calc.inputs.output_file = source
                     run_calc.inputs.expression='A[1] > 0.5 ? A[0] : A[1]'
                     if self.inputs.verbose >= 2:
-                        print run_calc.cmdline
+                        print run_calc.inputs.expression
                     run_calc.run()
 
                 if os.path.isfile(self.inputs.in_target_mask) and not os.path.exists(tmpDir+"/"+t_base+"_masked.mnc"):
                     target = tmpDir+"/"+t_base+"_masked.mnc"
-                    run_calc.inputs.in_file = [inorm_target, self.inputs.in_target_mask]
-                    run_calc.inputs.out_file = target
+                    run_calc = CalcRunning();
+                    run_calc.inputs.input_files = [inorm_target, self.inputs.in_target_mask]
+                    run_calc.inputs.output_file = target
                     run_calc.inputs.expression='A[1] > 0.5 ? A[0] : A[1]'
                     if self.inputs.verbose >= 2:
-                        print run_calc.cmdline
+                        print run_calc.inputs.expression
                     run_calc.run()
             else:
                 source = inorm_source
                 target = inorm_target
 
 
-            run_smooth = minc.Blur();
-            run_smooth.inputs.input_file=target
-            run_smooth.inputs.fwhm=confi.blur_fwhm
-            run_smooth.inputs.output_file_base=tmp_target_blur_base
-            if self.inputs.verbose >= 2:
-                print run_smooth.cmdline
-            run_smooth.run()
-
-            run_smooth = minc.Blur();
-            run_smooth.inputs.input_file=source
-            run_smooth.inputs.fwhm=confi.blur_fwhm
-            run_smooth.inputs.output_file_base=tmp_source_blur_base
-            if self.inputs.verbose >= 2:
-                print run_smooth.cmdline
-            run_smooth.run()
+            blur_image(target, confi.blur_fwhm, tmp_target_blur_base, self.inputs.blur_method, num_threads=self.inputs.num_threads, verbose=self.inputs.verbose-1)
+            blur_image(source, confi.blur_fwhm, tmp_source_blur_base, self.inputs.blur_method, num_threads=self.inputs.num_threads, verbose=self.inputs.verbose-1)
 
             run_tracc = TraccCommand();
             run_tracc.inputs.in_source_file=tmp_source_blur
@@ -568,10 +636,20 @@ class nLinRegRunning(BaseInterface):
             run_tracc.run()
 
 
+            converged = False
+            if self.inputs.early_exit and i > 1 and i < len(conf_list) :
+                prev_grids = grid_files(prev_xfm)
+                grids = grid_files(run_tracc.inputs.out_file_xfm)
+                if prev_grids != [] and grids != [] :
+                    rms = grid_displacement_rms(prev_grids[-1], grids[-1])
+                    print '       | change : \t\t%.3f mm RMS displacement' % rms
+                    converged = rms < self.inputs.tolerance_displacement
+
             if i == len(conf_list):
                 prev_xfm = self.inputs.out_file_xfm
             else :
                 prev_xfm = tmp_xfm
+            self._n_stages = i
 
             run_resample = minc.Resample();
             run_resample.inputs.keep_real_range=True
@@ -579,11 +657,18 @@ class nLinRegRunning(BaseInterface):
             run_resample.inputs.output_file=tmp_rspl_vol
             run_resample.inputs.like=target
             run_resample.inputs.transformation=run_tracc.inputs.out_file_xfm
-            if self.inputs.verbose >= 2:
-                print run_resample.cmdline
-            run_resample.run()
+            if not self.inputs.transforms_only :
+                if self.inputs.verbose >= 2:
+                    print run_resample.cmdline
+                run_resample.run()
 
             i += 1
+            if converged :
+                #The last stage writes out_file_xfm, so the transformation of this stage must be copied there
+                print 'Converged after '+str(self._n_stages)+' of '+str(len(conf_list))+' stages\n'
+                copy_xfm(prev_xfm, self.inputs.out_file_xfm)
+                prev_xfm = self.inputs.out_file_xfm
+                break
 
         if isdefined(self.inputs.init_file_xfm):
             run_concat = minc.XfmConcat();
@@ -593,16 +678,17 @@ class nLinRegRunning(BaseInterface):
                 print run_concat.cmdline
             run_concat.run()
 
-        print '\n-+- creating '+self.inputs.out_file_img+' using '+self.inputs.out_file_xfm+' -+-\n'
-        run_resample = minc.Resample();
-        run_resample.inputs.keep_real_range=True
-        run_resample.inputs.input_file=self.inputs.in_source_file
-        run_resample.inputs.output_file=self.inputs.out_file_img
-        run_resample.inputs.like=self.inputs.in_target_file
-        run_resample.inputs.transformation=self.inputs.out_file_xfm
-        if self.inputs.verbose >= 2:
-            print run_resample.cmdline
-        run_resample.run()
+        if self.inputs.write_image :
+            print '\n-+- creating '+self.inputs.out_file_img+' using '+self.inputs.out_file_xfm+' -+-\n'
+            run_resample = minc.Resample();
+            run_resample.inputs.keep_real_range=True
+            run_resample.inputs.input_file=self.inputs.in_source_file
+            run_resample.inputs.output_file=self.inputs.out_file_img
+            run_resample.inputs.like=self.inputs.in_target_file
+            run_resample.inputs.transformation=self.inputs.out_file_xfm
+            if self.inputs.verbose >= 2:
+                print run_resample.cmdline
+            run_resample.run()
 
         return runtime
 
@@ -618,15 +704,78 @@ class nLinRegRunning(BaseInterface):
         if not isdefined(self.inputs.out_file_warp):
             self.inputs.out_file_warp = self._gen_filename(self.inputs.out_file_xfm, "", "_grid_0.mnc")
 
-        outputs["out_file_img"] = self.inputs.out_file_img
+        if self.inputs.write_image :
+            outputs["out_file_img"] = self.inputs.out_file_img
         outputs["out_file_xfm"] = self.inputs.out_file_xfm
         outputs["out_file_warp"]= self.inputs.out_file_warp
+        outputs["n_stages"] = self._n_stages
         return outputs
     
     def _parse_inputs(self, skip=None):
          if skip is None:
              skip = []
          return super(nLinRegRunning, self)._parse_inputs(skip=skip)
+class CachedNLinRegInput(nLinRegInput):
+    cache_dir = traits.Str(mandatory=True, desc="Directory where nonlinear transformations are stored")
+
+class CachedNLinRegRunning(nLinRegRunning):
+    '''
+    nLinRegRunning for inputs that do not depend on the subject (e.g., atlas template to stereotaxic template).
+    The outputs are stored in <cache_dir>/<key>, where <key> is computed from the contents of the source and 
+    target images, so that the registration is computed once and reused by every scan and every later run.
+    '''
+    input_spec = CachedNLinRegInput
+
+    def _get_key(self):
+        key = file_md5(self.inputs.in_source_file) + '_' + file_md5(self.inputs.in_target_file)
+        if self.inputs.normalize :
+            key += '_normalize'
+        if self.inputs.early_exit :
+            key += '_tol' + str(self.inputs.tolerance_displacement)
+        if self.inputs.blur_method != 'mincblur' :
+            key += '_' + self.inputs.blur_method
+        if not self.inputs.write_image :
+            key += '_xfm'
+        return key
+
+    def _run_interface(self, runtime):
+        cache_dir = self.inputs.cache_dir + os.sep + self._get_key()
+        base = basename(os.path.splitext(re.sub('.gz','',self.inputs.in_source_file))[0]) + self._suffix
+        self.inputs.out_file_xfm = cache_dir + os.sep + base + '.xfm'
+        self.inputs.out_file_img = cache_dir + os.sep + base + '.mnc'
+        self.inputs.out_file_warp = cache_dir + os.sep + base + '_grid_0.mnc'
+        if os.path.exists(cache_dir) :
+            print("Using cached nonlinear transformation: "+self.inputs.out_file_xfm)
+            return runtime
+
+        if not os.path.exists(self.inputs.cache_dir) :
+            try :
+                os.makedirs(self.inputs.cache_dir)
+            except OSError :
+                pass
+
+        #Run registration in a temporary directory that is renamed once all of the outputs 
+        #have been written, so that concurrent runs never see a partial result. The grid 
+        #file is referenced relative to the .xfm, so both can be moved together.
+        tmp_dir = tempfile.mkdtemp(dir=self.inputs.cache_dir, prefix='.tmp_'+self._get_key())
+        tmp_inputs = ( tmp_dir + os.sep + base + '.xfm', tmp_dir + os.sep + base + '.mnc', tmp_dir + os.sep + base + '_grid_0.mnc' )
+        out_files = ( self.inputs.out_file_xfm, self.inputs.out_file_img, self.inputs.out_file_warp )
+        self.inputs.out_file_xfm, self.inputs.out_file_img, self.inputs.out_file_warp = tmp_inputs
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try :
+            super(CachedNLinRegRunning, self)._run_interface(runtime)
+        finally :
+            os.chdir(cwd)
+        shutil.rmtree(tmp_dir + os.sep + 'tmp_nLinReg')
+        self.inputs.out_file_xfm, self.inputs.out_file_img, self.inputs.out_file_warp = out_files
+        try :
+            os.rename(tmp_dir, cache_dir)
+        except OSError :
+            #Another process has already stored the same transformation
+            shutil.rmtree(tmp_dir)
+        return runtime
+
 """
 .. module:: registration
     :platform: Unix
@@ -635,7 +784,7 @@ class nLinRegRunning(BaseInterface):
 """
 
 
-def misalign_pet(workflow, inputnode, pet2mri ) :
+def misalign_pet(workflow, inputnode, pet2mri, opts ) :
     ###Create rotation xfm files based on transform error
     transformNode = pe.Node(interface=rsl.param2xfmInterfaceCommand(), name='transformNode')
     workflow.connect(inputnode, 'error', transformNode, 'transformation')
@@ -645,26 +794,43 @@ def misalign_pet(workflow, inputnode, pet2mri ) :
     workflow.connect(pet2mri,'out_file_xfm', pet2misalign_xfm, 'in_file')
     workflow.connect(transformNode,'out_file', pet2misalign_xfm, 'in_file_2')
 
-    ###Apply transformation to PET file
-    transform_resampleNode=pe.Node(interface=rsl.ResampleCommand(),name="transform_resampleNode")
-    transform_resampleNode.inputs.use_input_sampling=True;
-    workflow.connect(transformNode, 'out_file', transform_resampleNode, 'transformation')
-    workflow.connect(pet2mri, 'out_file_img', transform_resampleNode, 'in_file')
+    ###Apply PET to T1 and misalignment transformations to the PET file, with a single resampling
+    transform_resampleNode=pe.Node(interface=ApplyTransformChainRunning(),name="transform_resampleNode")
+    transform_resampleNode.inputs.resample_method = opts.resample_method
+    transform_resampleNode.inputs.num_threads = opts.num_threads
+    transform_chain=pe.Node(interface=niu.Merge(2), name="transform_chain")
+    workflow.connect(pet2mri, 'out_file_xfm', transform_chain, 'in1')
+    workflow.connect(transformNode, 'out_file', transform_chain, 'in2')
+    workflow.connect(transform_chain, 'out', transform_resampleNode, 'transformations')
+    workflow.connect(inputnode, 'pet_volume', transform_resampleNode, 'input_file')
+    workflow.connect(inputnode, 'nativeT1nuc', transform_resampleNode, 'like')
 
     ###Rotate brain mask
     transform_brainmaskNode=pe.Node(interface=rsl.ResampleCommand(), name="transform_brainmaskNode" )
     transform_brainmaskNode.inputs.interpolation='nearest_neighbour'
     workflow.connect(pet2misalign_xfm, 'out_file', transform_brainmaskNode, 'transformation')
-    workflow.connect(transform_resampleNode, 'out_file', transform_brainmaskNode, 'model_file')
+    workflow.connect(transform_resampleNode, 'output_file', transform_brainmaskNode, 'model_file')
 
     invert_concat_pet2misalign_xfm=pe.Node(interface=minc.XfmInvert(),name="invert_concat_pet2misalign_xfm")
     workflow.connect(pet2misalign_xfm,'out_file',invert_concat_pet2misalign_xfm,'input_file')
     pet2mri = final_pet2mri = pe.Node(interface=niu.IdentityInterface(fields=["out_file_img", "out_file_xfm", "out_file_xfm_invert"]), name="pet2mri_misaligned")
-    workflow.connect(transform_resampleNode, "out_file", final_pet2mri, "out_file_img")
+    workflow.connect(transform_resampleNode, "output_file", final_pet2mri, "out_file_img")
     workflow.connect(pet2misalign_xfm, "out_file", final_pet2mri, "out_file_xfm")
     workflow.connect(invert_concat_pet2misalign_xfm, "output_file", final_pet2mri, "out_file_xfm_invert")
     t1_brain_mask_img = 'out_file'
 
+def set_registration_options(node, opts):
+    '''Set the convergence tolerances, stage outputs and blur method of a PETtoT1LinRegRunning or nLinRegRunning node from the options'''
+    node.inputs.early_exit = opts.registration_early_exit
+    node.inputs.transforms_only = opts.registration_transforms_only
+    node.inputs.blur_method = opts.blur_method
+    node.inputs.num_threads = opts.num_threads
+    if 'tolerance_displacement' in node.inputs.trait_names() :
+        node.inputs.tolerance_displacement = opts.registration_tolerance_displacement
+    else :
+        node.inputs.tolerance_translation = opts.registration_tolerance_translation
+        node.inputs.tolerance_rotation = opts.registration_tolerance_rotation
+
 def get_workflow(name, infosource, opts):
     '''
         Create workflow to perform PET to T1 co-registration.
@@ -689,37 +855,50 @@ def get_workflow(name, infosource, opts):
     petMasking = pe.Node(interface=PETheadMasking(), name=node_name)
     petMasking.inputs.slice_factor = opts.slice_factor
     petMasking.inputs.total_factor = opts.total_factor
+    petMasking.inputs.threshold_method = opts.pet_head_mask_threshold
+    petMasking.inputs.percentile = opts.pet_head_mask_percentile
+    petMasking.inputs.fill_holes = opts.pet_head_mask_fill_holes
     workflow.connect(inputnode, 'pet_volume', petMasking, 'in_file')
     workflow.connect(inputnode, 'header', petMasking, 'in_json')
 
     node_name="pet2mri"
-    pet2mri = pe.Node(interface=PETtoT1LinRegRunning(), name=node_name)
-    pet2mri.inputs.clobber = True
+    if opts.coreg_method == 'native' :
+        pet2mri = pe.Node(interface=PETtoT1NativeRegRunning(), name=node_name)
+    else :
+        pet2mri = pe.Node(interface=PETtoT1LinRegRunning(), name=node_name)
+        pet2mri.inputs.clobber = True
+        pet2mri.inputs.metric="mi"
+        pet2mri.inputs.blur_cache_dir = opts.blur_cache_dir
+        set_registration_options(pet2mri, opts)
+    pet2mri.inputs.num_threads = opts.num_threads
+    pet2mri.inputs.multi_start = opts.coreg_multi_start
+    pet2mri.inputs.seed_angles = opts.coreg_seed_angles
+    pet2mri.inputs.seed_offsets = opts.coreg_seed_offsets
     pet2mri.inputs.verbose = opts.verbose
     pet2mri.inputs.lsq="lsq6"
-    pet2mri.inputs.metric="mi"
 
     workflow.connect([(inputnode, pet2mri, [('pet_volume', 'in_source_file')]),
                                   (inputnode, pet2mri, [('nativeT1nuc', 'in_target_file')])#,
                                   ])
     
 
-    if opts.test_group_qc : misalign_pet(workflow, inputnode, pet2mri )
+    if opts.test_group_qc : misalign_pet(workflow, inputnode, pet2mri, opts )
 
 
-    PETMNIXfm_node = pe.Node( interface=ConcatCommand(), name="PETMNIXfm_node")
+    #Linear transformations are concatenated and inverted in-process, without submitting a job
+    PETMNIXfm_node = pe.Node( interface=ConcatXfmRunning(), name="PETMNIXfm_node", run_without_submitting=True)
     workflow.connect(pet2mri, "out_file_xfm", PETMNIXfm_node, "in_file")
     workflow.connect(inputnode, "xfmT1MNI", PETMNIXfm_node, "in_file_2")
 
-    MNIPETXfm_node = pe.Node(interface=minc.XfmInvert(), name="MNIPETXfm_node")
-    workflow.connect( PETMNIXfm_node, "out_file", MNIPETXfm_node, 'input_file'  )
+    MNIPETXfm_node = pe.Node(interface=InvertXfmRunning(), name="MNIPETXfm_node", run_without_submitting=True)
+    workflow.connect( PETMNIXfm_node, "out_file", MNIPETXfm_node, 'in_file'  )
 
     workflow.connect(PETMNIXfm_node, 'out_file', outputnode, 'petmni_xfm' )
-    workflow.connect(MNIPETXfm_node, 'output_file', outputnode, 'mnipet_xfm' )
+    workflow.connect(MNIPETXfm_node, 'out_file', outputnode, 'mnipet_xfm' )
 
     #Resample 4d PET image to T1 space
     if opts.analysis_space == 't1':
-        pettot1_4d = pe.Node(interface=minc.Resample(), name='pet_t1_4d')
+        pettot1_4d = pe.Node(interface=rsl.resample_interface(opts), name='pet_t1_4d')
         pettot1_4d.inputs.keep_real_range=True
         workflow.connect(inputnode, 'pet_volume_4d', pettot1_4d, 'input_file')
         workflow.connect(pet2mri, 'out_file_xfm', pettot1_4d, 'transformation')
@@ -729,7 +908,7 @@ def get_workflow(name, infosource, opts):
         workflow.connect(inputnode, 'nativeT1nuc', outputnode, 't1_analysis_space')
     elif opts.analysis_space == "stereo" :
         #Resample 4d PET image to MNI space
-        pettomni_4d = pe.Node(interface=minc.Resample(), name='pet_mni_4d')
+        pettomni_4d = pe.Node(interface=rsl.resample_interface(opts), name='pet_mni_4d')
         pettomni_4d.inputs.keep_real_range=True
         workflow.connect(inputnode, 'pet_volume_4d', pettomni_4d, 'input_file')
         workflow.connect(PETMNIXfm_node, "out_file", pettomni_4d, 'transformation')
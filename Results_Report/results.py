@@ -13,9 +13,11 @@ import nipype.interfaces.io as nio
 import nipype.interfaces.utility as util
 import nipype.interfaces.utility as niu
 
-import json
 from Extra.concat import concat_df
+from Extra.pet_header import PETHeader, has_frame_times
 from Quality_Control.qc import metric_columns
+from Extra.labels import label_index
+from pyminc.volumes.factory import volumeFromFile
 
 results_columns = metric_columns + ['frame']
 """
@@ -72,6 +74,46 @@ def group_level_descriptive_statistics(opts, args):
         workflow.connect(descriptive_statisticsNode, "sub_ses", datasink, 'sub_ses')
         workflow.run()
 
+def label_stats(in_file, mask_file, out_file):
+    '''
+    Descriptive statistics of <in_file> in each label of <mask_file>, written to <out_file> in the format of
+    mincgroupstats (ndim, roi, frame, mean, sd, max, min, vol). The voxels of each label are gathered with the
+    label index of the mask. Returns False if the image and the mask do not share the same grid (dimension names,
+    sizes, starts and steps).
+    '''
+    vol = volumeFromFile(in_file)
+    mask = volumeFromFile(mask_file)
+    spatial = [ i for i, d in enumerate(vol.dimnames) if d != 'time' ]
+    same_grid = [ vol.dimnames[i] for i in spatial ] == list(mask.dimnames) \
+            and [ vol.sizes[i] for i in spatial ] == list(mask.sizes) \
+            and np.allclose([ vol.starts[i] for i in spatial ], mask.starts) \
+            and np.allclose([ vol.separations[i] for i in spatial ], mask.separations)
+    mask.closeVolume()
+    if not same_grid :
+        vol.closeVolume()
+        return False
+
+    data = np.array(vol.data)
+    if 'time' in vol.dimnames :
+        data = np.rollaxis(data, vol.dimnames.index('time'), 0)
+    else :
+        data = data.reshape([1] + list(data.shape))
+    voxel_volume = abs(np.prod([ vol.separations[i] for i in spatial ]))
+    ndim = len(vol.dimnames)
+    vol.closeVolume()
+
+    index = label_index(mask_file)
+
+    data = data.reshape(data.shape[0], -1)
+    rows=[]
+    for label in index.labels :
+        voxels = index.voxels(label)
+        values = data[:, voxels]
+        for frame in range(data.shape[0]) :
+            rows.append([ndim, label, frame, values[frame].mean(), values[frame].std(), values[frame].max(), values[frame].min(), voxels.shape[0] * voxel_volume])
+    pd.DataFrame(rows).to_csv(out_file, header=False, index=False)
+    return True
+
 class resultsInput(TraitedSpec):   
     in_file = traits.File(desc="Input file ")
     mask = traits.File(desc="ROI PET mask ")
@@ -91,6 +133,7 @@ class resultsInput(TraitedSpec):
     acq = traits.Str(desc="Acquisition",usedefault=True,default_value="NA")
     rec = traits.Str(desc="Reconstruction",usedefault=True,default_value="NA")
     node  = traits.Str(mandatory=True, desc="Node name")
+    stats_method = traits.Enum('mincgroupstats', 'native', usedefault=True, desc="Method used to compute the regional statistics")
 
 class resultsOutput(TraitedSpec):
     out_file_3d = traits.File(desc="3D Output file ")
@@ -113,6 +156,10 @@ class resultsCommand( BaseInterface):
         if not isdefined(self.inputs.out_file_4d) and self.inputs.dim == '4':
             self.inputs.out_file_4d=self._gen_output(self.inputs.in_file, '_4d')
 
+        stats_file = os.getcwd()+os.sep+'temp.csv'
+        use_surfaces = isdefined(self.inputs.surf_left) or isdefined(self.inputs.surf_right)
+        native = self.inputs.stats_method == 'native' and not use_surfaces and label_stats(self.inputs.in_file, self.inputs.mask, stats_file)
+
         resultsReport = groupstatsCommand()
         resultsReport.inputs.image = self.inputs.in_file
         resultsReport.inputs.vol_roi = self.inputs.mask
@@ -120,13 +167,15 @@ class resultsCommand( BaseInterface):
             resultsReport.inputs.surf_left_roi = self.inputs.surf_left + ' ' + self.inputs.mask_left
         if  isdefined(self.inputs.surf_right) and isdefined(self.inputs.mask_right) :
             resultsReport.inputs.surf_right_roi = self.inputs.surf_right + ' ' + self.inputs.mask_right
-        resultsReport.inputs.out_file = os.getcwd()+os.sep+'temp.csv'
-        print resultsReport.cmdline
+        resultsReport.inputs.out_file = stats_file
+        if not native :
+            print resultsReport.cmdline
        
         acq_list = [ re.sub('acq-','',f)  for f in self.inputs.in_file.split('_') if 'acq' in f ]
         rec_list = [ re.sub('rec-','',f)  for f in self.inputs.in_file.split('_') if 'rec' in f ]
         
-        resultsReport.run()
+        if not native :
+            resultsReport.run()
         add_csvInfoNode = add_csvInfoCommand()
         add_csvInfoNode.inputs.in_file = resultsReport.inputs.out_file
         add_csvInfoNode.inputs.sub = self.inputs.sub
@@ -372,23 +421,11 @@ class integrate_TACCommand( BaseInterface):
         return out_file 
 
     def _run_interface(self, runtime):
-        header = json.load(open( self.inputs.header ,"rb"))
         df = pd.read_csv( self.inputs.in_file )
-        #if time frames is not a list of numbers, .e.g., "unknown",
-        #then set time frames to 1
-        time_frames = []
-       
-        if time_frames == [] :
-            try :
-                header['Time']['FrameTimes']['Values']
-                time_frames = [ float(s) for s,e in  header['Time']["FrameTimes"]["Values"] ]
-                #for i in range(1, len(time_frames)) :
-                #    time_frames[i] = time_frames[i] + time_frames[i-1]
-                    
-            except ValueError : 
-                time_frames = []
-   
-        if time_frames == [] : time_frames = [1.]
+        #If the frame times are not a list of numbers, e.g., "unknown", then set time frames to 1
+        time_frames = [1.]
+        if has_frame_times(self.inputs.header) :
+            time_frames = PETHeader.load(self.inputs.header).frame_start
         value_cols=['metric','value']
         groups=list(df.columns.values) #["analysis", "sub", "ses", "task","run", "acq", "rec", "roi"]
         groups = [ i for i in groups if not i in value_cols+['frame'] ] 
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nipype.interfaces.minc as minc
+from Extra.morphomat import MorphCommand
+from Extra.labels import prepare_labels
+from Test.benchmark_registration import bytes_written
+
+"""
+.. module:: benchmark_labels
+    :platform: Unix
+    :synopsis: Compare the latency and the amount of data written by the label preparation of Masking.Labels,
+        as a chain of MINC tools (minccalc, mincmorph, mincresample, minccalc) and with the fused in-memory engine.
+"""
+
+def minc_chain(label_img, out_file, like_file, xfm, labels, erode_times, ones_only, brain_mask, tmp_dir):
+    '''Label preparation with one MINC tool per step, each writing a full volume'''
+    selected = tmp_dir + os.sep + 'mask.mnc'
+    run_calc = minc.Calc()
+    run_calc.inputs.input_files = label_img
+    run_calc.inputs.output_file = selected
+    run_calc.inputs.expression = " || ".join([ '(A[0] > ' + str(label) + '-0.1 && A[0] < '+str(label)+'+ 0.1 )' for label in labels ]) + ' ? A[0] : 0'
+    run_calc.run()
+
+    if erode_times > 0 :
+        run_mincmorph = MorphCommand()
+        run_mincmorph.inputs.in_file = selected
+        run_mincmorph.inputs.out_file = tmp_dir + os.sep + 'mask_clean.mnc'
+        run_mincmorph.inputs.successive = 'E' * erode_times
+        run_mincmorph.run()
+        selected = run_mincmorph.inputs.out_file
+
+    run_resample = minc.Resample()
+    run_resample.inputs.input_file = selected
+    run_resample.inputs.output_file = tmp_dir + os.sep + 'mask_rsl.mnc'
+    run_resample.inputs.like = like_file
+    run_resample.inputs.transformation = xfm
+    run_resample.inputs.nearest_neighbour_interpolation = True
+    run_resample.run()
+    label = run_resample.inputs.output_file
+
+    if brain_mask != None :
+        run_calc = minc.Calc()
+        run_calc.inputs.input_files = [ label, brain_mask ]
+        run_calc.inputs.output_file = tmp_dir + os.sep + 'mask_brain.mnc'
+        run_calc.inputs.expression = " A[1] == 1 ? A[0] : 0 "
+        run_calc.run()
+        label = run_calc.inputs.output_file
+    if ones_only :
+        run_calc = minc.Calc()
+        run_calc.inputs.input_files = [ label ]
+        run_calc.inputs.output_file = tmp_dir + os.sep + 'mask_ones.mnc'
+        run_calc.inputs.expression = " A[0] > 0.1 ? 1 : 0 "
+        run_calc.run()
+        label = run_calc.inputs.output_file
+    shutil.copy(label, out_file)
+    return out_file
+
+def fused(label_img, out_file, like_file, xfm, labels, erode_times, ones_only, brain_mask, tmp_dir):
+    return prepare_labels(label_img, out_file, like_file, xfm, labels, erode_times, ones_only, brain_mask, tmp_dir)
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Benchmark the preparation of label images in the analysis space")
+    parser.add_argument("label_img", help="Label image (atlas)")
+    parser.add_argument("like_file", help="Image in the analysis space")
+    parser.add_argument("xfm", help="Transformation from the label image to the analysis space")
+    parser.add_argument("--labels", dest="labels", nargs='+', default=[], help="Labels to select (default=all non-zero labels)")
+    parser.add_argument("--erode-times", dest="erode_times", type=int, default=0, help="Number of erosions")
+    parser.add_argument("--brain-mask", dest="brain_mask", default=None, help="Brain mask in the analysis space")
+    parser.add_argument("--ones-only", dest="ones_only", action='store_true', default=False, help="Binarize the labels")
+    parser.add_argument("--out-dir", dest="out_dir", default=os.getcwd()+os.sep+"benchmark_labels", help="Working directory")
+    parser.add_argument("--repeats", dest="repeats", type=int, default=3, help="Number of runs of each engine")
+    opts = parser.parse_args()
+
+    labels = opts.labels
+    if labels == [] :
+        from Extra.labels import label_values
+        from pyminc.volumes.factory import volumeFromFile
+        vol = volumeFromFile(opts.label_img)
+        labels = [ str(l) for l in label_values(vol.data) ]
+        vol.closeVolume()
+
+    results={}
+    for name, engine in [('minc tools', minc_chain), ('fused', fused)] :
+        times=[]
+        for r in range(opts.repeats) :
+            tmp_dir = os.path.abspath(opts.out_dir) + os.sep + name.replace(' ', '_') + '_' + str(r)
+            if os.path.exists(tmp_dir) :
+                shutil.rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+            start = time.time()
+            engine(opts.label_img, tmp_dir + os.sep + 'labels.mnc', opts.like_file, opts.xfm, labels, opts.erode_times, opts.ones_only, opts.brain_mask, tmp_dir)
+            times.append(time.time() - start)
+            nbytes = bytes_written(tmp_dir)
+        results[name] = (min(times), nbytes)
+
+    print('%-12s %12s %14s' % ('engine', 'time (s)', 'written (MB)'))
+    for name in ['minc tools', 'fused'] :
+        print('%-12s %12.2f %14.2f' % (name, results[name][0], results[name][1] / 1.e6))
+    print('speed-up : %.1fx, %.2f MB less written' % (results['minc tools'][0] / results['fused'][0], (results['minc tools'][1] - results['fused'][1]) / 1.e6))
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Registration.registration import PETtoT1LinRegRunning, nLinRegRunning
+
+"""
+.. module:: benchmark_registration
+    :platform: Unix
+    :synopsis: Compare the wall-clock time and the amount of data written by the minctracc registration
+        interfaces with and without the resampling of the source image at every stage (transforms_only).
+"""
+
+def bytes_written(path):
+    '''Total size of the files written under <path>'''
+    total=0
+    for root, dirs, files in os.walk(path) :
+        for f in files :
+            fn = os.path.join(root, f)
+            if not os.path.islink(fn) :
+                total += os.path.getsize(fn)
+    return total
+
+def run_registration(interface, source, target, out_dir, transforms_only, blur_cache_dir=None):
+    if os.path.exists(out_dir) :
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try :
+        reg = interface()
+        reg.inputs.in_source_file = source
+        reg.inputs.in_target_file = target
+        reg.inputs.transforms_only = transforms_only
+        reg.inputs.verbose = 0
+        if blur_cache_dir != None :
+            reg.inputs.blur_cache_dir = blur_cache_dir
+        start = time.time()
+        reg.run()
+        elapsed = time.time() - start
+    finally :
+        os.chdir(cwd)
+    return elapsed, bytes_written(out_dir)
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Benchmark the minctracc registration stages with and without intermediate resampling")
+    parser.add_argument("source", help="Source image (e.g., 3D PET or T1 image)")
+    parser.add_argument("target", help="Target image (e.g., T1 image or stereotaxic template)")
+    parser.add_argument("--out-dir", dest="out_dir", default=os.getcwd()+os.sep+"benchmark_registration", help="Working directory")
+    parser.add_argument("--nonlinear", dest="nonlinear", action='store_true', default=False, help="Benchmark nLinRegRunning instead of PETtoT1LinRegRunning")
+    parser.add_argument("--repeats", dest="repeats", type=int, default=1, help="Number of runs of each mode")
+    opts = parser.parse_args()
+
+    interface = nLinRegRunning if opts.nonlinear else PETtoT1LinRegRunning
+    source = os.path.abspath(opts.source)
+    target = os.path.abspath(opts.target)
+    blur_cache_dir = None
+    if not opts.nonlinear :
+        #Shared blur cache, so that both modes only differ by the resampling of the stages
+        blur_cache_dir = os.path.abspath(opts.out_dir) + os.sep + 'blur_cache'
+        #Warm up the cache so that the first timed run does not pay for the blurring
+        run_registration(interface, source, target, os.path.abspath(opts.out_dir) + os.sep + 'warm_up', True, blur_cache_dir)
+
+    results={}
+    for transforms_only in [False, True] :
+        times=[]
+        for r in range(opts.repeats) :
+            out_dir = os.path.abspath(opts.out_dir) + os.sep + ('transforms_only' if transforms_only else 'default') + '_' + str(r)
+            elapsed, nbytes = run_registration(interface, source, target, out_dir, transforms_only, blur_cache_dir)
+            times.append(elapsed)
+        results[transforms_only] = (min(times), nbytes)
+
+    print('%-16s %12s %14s' % ('mode', 'time (s)', 'written (MB)'))
+    for transforms_only, label in [(False, 'default'), (True, 'transforms_only')] :
+        elapsed, nbytes = results[transforms_only]
+        print('%-16s %12.2f %14.2f' % (label, elapsed, nbytes / 1.e6))
+    saved_time = results[False][0] - results[True][0]
+    saved_bytes = results[False][1] - results[True][1]
+    print('saved : %.2f s (%.1f%%), %.2f MB' % (saved_time, 100. * saved_time / results[False][0], saved_bytes / 1.e6))
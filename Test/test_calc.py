@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Extra.calc import compile_expression, evaluate_expression, numexpr
+
+"""
+.. module:: test_calc
+    :platform: Unix
+    :synopsis: Unit tests of the translation of minccalc expressions by Extra.calc.
+"""
+
+def evaluate(expression, arrays, use_numexpr=False):
+    code, used = compile_expression(expression)
+    arrays = [ np.array(a, dtype=np.float64) for a in arrays ]
+    return evaluate_expression(code, arrays, use_numexpr)
+
+class TestCalcExpression(unittest.TestCase):
+    def check(self, expression, arrays, expected):
+        modes = [False] + ([True] if numexpr != None else [])
+        for use_numexpr in modes :
+            np.testing.assert_allclose(evaluate(expression, arrays, use_numexpr), expected)
+
+    def test_precedence(self):
+        self.check('A[0] + A[1] * 2', [[1, 2], [3, 4]], [7, 10])
+        self.check('(A[0] + A[1]) * 2', [[1, 2], [3, 4]], [8, 12])
+        self.check('2 * A[0] ^ 2', [[3, -2]], [18, 8])
+        self.check('-A[0]^2', [[2, 3]], [-4, -9])
+        self.check('10 - A[0] - 3', [[4, 1]], [3, 6])
+        self.check('8 / A[0] / 2', [[4, 2]], [1, 2])
+
+    def test_ternary(self):
+        self.check('A[0] > 1 && A[1] < 5 ? 10 : 20', [[2, 2, 0], [3, 6, 3]], [10, 20, 20])
+        #Right associative, like minccalc
+        self.check('A[0] < 1 ? 1 : A[0] < 2 ? 2 : 3', [[0.5, 1.5, 2.5]], [1, 2, 3])
+        self.check('A[0] ? A[1] : 0', [[0, 0.2], [5, 7]], [0, 7])
+
+    def test_logical(self):
+        #&& binds tighter than ||
+        self.check('A[0] || A[1] && A[2]', [[1, 0, 0], [0, 1, 1], [0, 0, 1]], [1, 0, 1])
+        self.check('A[0] > 0.5 && A[0] < 1.5', [[0, 1, 2]], [0, 1, 0])
+        #Any non-zero value is true and logical operators return 1 or 0
+        self.check('A[0] && A[1]', [[3, -2, 0], [0.5, 4, 1]], [1, 1, 0])
+
+    def test_not(self):
+        self.check('!A[0]', [[0, 3, -1]], [1, 0, 0])
+        self.check('!(A[0] > 1) || A[0] == 5', [[0, 2, 5]], [1, 0, 1])
+        self.check('!A[0] + 1', [[0, 2]], [2, 1])
+
+    def test_functions_and_inputs(self):
+        self.check('abs(A[0]) > 1 ? 1 : 0;', [[-2, 0.5]], [1, 0])
+        code, used = compile_expression('A[0] + A[2]')
+        self.assertEqual(used, [0, 2])
+
+if __name__ == "__main__" :
+    unittest.main()
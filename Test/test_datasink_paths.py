@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from workflows import datasink_substitutions, anat_parameterization_dir
+
+"""
+.. module:: test_datasink_paths
+    :platform: Unix
+    :synopsis: Checks that the output paths of the datasink do not depend on the anatomical (sid, ses) iterables.
+"""
+
+#Substitutions of the datasink before the anatomical branch iterated over (sid, ses)
+baseline_substitutions = [('_args_',''), ('run','run-'), ('_cid_', ''), ('sid_', ''), ('sid-','sub-'), ('task','task-'), ('ses','ses-')]
+
+def substitute(path, substitutions):
+    '''Apply plain substitutions in order, as nipype's DataSink does'''
+    for key, val in substitutions :
+        path = path.replace(key, val)
+    return path
+
+class TestDatasinkPaths(unittest.TestCase):
+    sub_valid_args = [ {'sid':'01', 'ses':'baseline'}, {'sid':'01', 'ses':'followup'}, {'sid':'02', 'ses':'baseline'} ]
+    task_valid_args = [ {'sid':'01', 'ses':'baseline', 'task':'rest', 'run':'01', 'cid':0},
+                        {'sid':'01', 'ses':'followup', 'task':'rest', 'run':'01', 'cid':1},
+                        {'sid':'01', 'ses':'followup', 'task':'rest', 'run':'02', 'cid':2},
+                        {'sid':'02', 'ses':'baseline', 'task':'rest', 'run':'01', 'cid':3} ]
+
+    def args_dir(self, args):
+        return '_args_run'+args['run']+'.task'+args['task']+'.ses'+args['ses']+'.sid'+args['sid']+'_cid_'+str(args['cid'])
+
+    def test_multi_session_paths_unchanged(self):
+        substitutions = datasink_substitutions(self.sub_valid_args)
+        for args in self.task_valid_args :
+            for out_dir in [ 'pet_coregistration', 'quantification/sessions' ] :
+                baseline = '/data/out/' + out_dir + '/' + self.args_dir(args) + '/sub-01_pet.mnc'
+                current = '/data/out/' + out_dir + '/' + anat_parameterization_dir(args['sid'], args['ses']) + '/' + self.args_dir(args) + '/sub-01_pet.mnc'
+                self.assertEqual(substitute(current, substitutions), substitute(baseline, baseline_substitutions))
+
+    def test_only_anatomical_directories_removed(self):
+        substitutions = datasink_substitutions(self.sub_valid_args)
+        #Directory of a (sid, ses) pair that is not iterated over is kept
+        path = '/data/out/mri/' + anat_parameterization_dir('03', 'baseline') + '/t1.mnc'
+        self.assertEqual(substitute(path, substitutions), substitute(path, baseline_substitutions))
+        #Session ids that are prefixes of one another are not confused
+        substitutions = datasink_substitutions([{'sid':'01', 'ses':'1'}])
+        path = '/data/out/mri/' + anat_parameterization_dir('01', '10') + '/t1.mnc'
+        self.assertEqual(substitute(path, substitutions), substitute(path, baseline_substitutions))
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Extra.pet_header import PETHeader, section
+
+"""
+.. module:: test_pet_header
+    :platform: Unix
+    :synopsis: Unit tests of the frame times parsed by Extra.pet_header, for headers in seconds and in minutes.
+"""
+
+#The same 4 frames, 0-1, 1-2, 2-5 and 5-10 min
+frames_sec = [[0, 60], [60, 120], [120, 300], [300, 600]]
+frames_min = [[0, 1], [1, 2], [2, 5], [5, 10]]
+
+def bids_header(values, units):
+    return { "Time":{ "FrameTimes":{ "Values":values, "Units":[units, units] } } }
+
+class TestPETHeader(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, header):
+        header_file = os.path.join(self.tmp_dir, name)
+        json.dump(header, open(header_file, "w"))
+        return header_file
+
+    def headers(self):
+        return [ PETHeader.load(self.write("sec.json", bids_header(frames_sec, "s"))),
+                 PETHeader.load(self.write("min.json", bids_header(frames_min, "min"))) ]
+
+    def test_frame_times_in_seconds(self):
+        for pet_header in self.headers() :
+            np.testing.assert_allclose(pet_header.frame_start, [0, 60, 120, 300])
+            np.testing.assert_allclose(pet_header.frame_end, [60, 120, 300, 600])
+            np.testing.assert_allclose(pet_header.duration, [60, 60, 180, 300])
+
+    def test_window(self):
+        #SUVR --start-time and --end-time are in minutes and are converted to seconds
+        start_time, end_time = 1, 5
+        for pet_header in self.headers() :
+            np.testing.assert_array_equal(pet_header.window(start_time * 60., end_time * 60.), [False, True, True, False])
+            np.testing.assert_array_equal(pet_header.window(None, None), [True]*4)
+
+    def test_canonical_section(self):
+        #The section written by the initialization workflow is used as is, whatever Time:FrameTimes contains
+        header = bids_header(frames_min, "min")
+        header[section] = PETHeader.from_dict(bids_header(frames_min, "min")).to_dict()
+        header["Time"]["FrameTimes"]["Units"] = ["s", "s"]
+        pet_header = PETHeader.load(self.write("canonical.json", header))
+        np.testing.assert_allclose(pet_header.frame_end, [60, 120, 300, 600])
+
+if __name__ == "__main__" :
+    unittest.main()
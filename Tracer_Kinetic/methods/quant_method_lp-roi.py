@@ -1,5 +1,5 @@
 from quantification_template import *
-import json 
+from Extra.pet_header import PETHeader
 
 in_file_format="ECAT"
 out_file_format="DFT"
@@ -28,28 +28,17 @@ class quantCommand(quantificationCommand):
     _suffix = "_lp-roi" 
 
     def _parse_inputs(self, skip=None):
-        header = json.load(open(self.inputs.header, "r") )
+        pet_header = PETHeader.load(self.inputs.header)
         if skip is None:
             skip = []
         if not isdefined(self.inputs.out_file):
             self.inputs.out_file = self._gen_output(self.inputs.in_file, self._suffix)
         
+        #Frame times are in seconds, start and end times are in minutes
         if not isdefined(self.inputs.start_time) : 
-            self.inputs.start_time=header['Time']['FrameTimes']['Values'][0][0]
-            if header['Time']['FrameTimes']['Units'][0] == 's' : self.inputs.start_time /= 60.
-            elif header['Time']['FrameTimes']['Units'][0] == 'm' : pass
-            elif header['Time']['FrameTimes']['Units'][0] == 'h' : self.inputs.start_time *= 60.
-            else :
-                print("Error : unrecognized time units in ", self.inputs.header)
-                exit(1)
+            self.inputs.start_time = pet_header.frame_start[0] / 60.
         if not isdefined(self.inputs.end_time) : 
-            self.inputs.end_time=header['Time']['FrameTimes']['Values'][-1][1]
-            if header['Time']['FrameTimes']['Units'][1] == 's' : self.inputs.end_time /= 60.
-            elif header['Time']['FrameTimes']['Units'][1] == 'm' :  pass
-            elif header['Time']['FrameTimes']['Units'][0] == 'h' : self.inputs.end_time *= 60.
-            else :
-                print("Error : unrecognized time units in ", self.inputs.header)
-                exit(1)       
+            self.inputs.end_time = pet_header.frame_end[-1] / 60.
 
         return super(quantCommand, self)._parse_inputs(skip=skip)
 
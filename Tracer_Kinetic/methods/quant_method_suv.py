@@ -2,7 +2,7 @@ from pyminc.volumes.factory import volumeLikeFile, volumeFromFile
 import numpy as np
 from quantification_template import *
 from scipy.integrate import simps
-import json
+from Extra.pet_header import PETHeader
 
 in_file_format="MINC"
 out_file_format="MINC"
@@ -34,7 +34,8 @@ class quantCommand(BaseInterface):
 
 
     def _run_interface(self, runtime):
-        header = json.load(open(self.inputs.header, "r") )
+        pet_header = PETHeader.load(self.inputs.header)
+        header = pet_header.header
         if not isdefined(self.inputs.out_file) : 
             self.inputs.out_file = self._gen_output(self.inputs.in_file, self._suffix)
         
@@ -59,28 +60,8 @@ class quantCommand(BaseInterface):
             dims = pet.getDimensionNames()
             i = dims.index('time')
 
-            if not isdefined(self.inputs.start_time) : 
-                start_time=0
-            else :
-                start_time=self.inputs.start_time
-
-            if not isdefined(self.inputs.end_time) : 
-                end_time=header['Time']['FrameTimes']['Values'][-1][1]
-            else :
-                end_time=self.inputs.end_time
-            
-            #time_frames = time_indices = []
-            #for i in range(vol.shape[i]) :
-            #    s=header['Time']["FrameTimes"]["Values"][i][0]
-            #    e=header['Time']["FrameTimes"]["Values"][i][1]
-            #    print(i)
-            #    if s >= start_time and e <= end_time :
-            #        time_indices.append(i)
-            #        time_frames.append(float(e) - float(s)  )
-            #print(time_indices) 
-            #print(time_frames)
-            time_frames = [ float(s) for s,e in  header['Time']["FrameTimes"]["Values"] ]
-            vol = simps( pet.data, time_frames, axis=i)
+            #Integrate over the start times of the frames, in seconds
+            vol = simps( pet.data, pet_header.frame_start, axis=i)
         vol = vol / ( dose / weight)  
         out.data=vol
         out.writeFile()
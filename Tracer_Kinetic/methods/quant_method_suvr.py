@@ -3,6 +3,7 @@ from pyminc.volumes.factory import volumeLikeFile, volumeFromFile
 import numpy as np
 import json
 from scipy.integrate import simps
+from Extra.pet_header import PETHeader
 ### Required for a quantification node:
 in_file_format="MINC"
 ### Required for a quantification node:
@@ -35,9 +36,7 @@ class quantCommand(BaseInterface):
     _suffix = "_suvr" 
     def _run_interface(self, runtime):
         if not isdefined(self.inputs.out_file) : self.inputs.out_file = self._gen_output(self.inputs.in_file, self._suffix)
-        header = json.load(open(self.inputs.header, "r") )
         pet = volumeFromFile(self.inputs.in_file)
-        reference = volumeFromFile(self.inputs.reference)
         out = volumeLikeFile(self.inputs.reference, self.inputs.out_file )
         ndim = len(pet.data.shape)
         
@@ -47,24 +46,27 @@ class quantCommand(BaseInterface):
             dims = pet.getDimensionNames()
             i = dims.index('time')
 
-            if not isdefined(self.inputs.start_time) : 
-                start_time=0
-            else :
-                start_time=self.inputs.start_time
+            pet_header = PETHeader.load(self.inputs.header)
+            #Start and end times are given in minutes, frame times are in seconds
+            start_time = end_time = None
+            if isdefined(self.inputs.start_time) : start_time = self.inputs.start_time * 60.
+            if isdefined(self.inputs.end_time) : end_time = self.inputs.end_time * 60.
+            frames = pet_header.window(start_time, end_time)
 
-            if not isdefined(self.inputs.end_time) : 
-                end_time=header['Time']['FrameTimes']['Values'][-1][1]
+            time_frames = pet_header.frame_start[frames]
+            if time_frames.shape[0] > 1 :
+                vol = simps( np.compress(frames, pet.data, axis=i), time_frames, axis=i)
             else :
-                end_time=self.inputs.end_time
-
-            try : 
-                time_frames = [ float(s) for s,e in  header['Time']["FrameTimes"]["Values"] if s >= start_time and e <= end_time ]
-            except ValueError :
-                time_frames = [1.]
-            vol = simps( pet.data, time_frames, axis=i)
+                vol = np.compress(frames, pet.data, axis=i).sum(axis=i)
         
-        idx = reference.data > 0
-        ref = np.mean(vol[idx])
+        #Any positive value of the reference mask is in the reference region (it can be fractional, e.g., interpolated)
+        reference = volumeFromFile(self.inputs.reference)
+        idx = np.array(reference.data) > 0
+        reference.closeVolume()
+        if not idx.any() :
+            print("Error: reference region "+self.inputs.reference+" is empty")
+            exit(1)
+        ref = np.mean(np.asarray(vol)[idx])
         print "SUVR Reference = ", ref
         vol = vol / ref
         out.data=vol
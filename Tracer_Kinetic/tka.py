@@ -9,6 +9,8 @@ from Extra.modifHeader import FixHeaderLinkCommand
 from Turku.dft import img2dft_unit_conversion
 from Extra.extra import subject_parameterCommand
 from Extra.turku import imgunitCommand
+from Extra.resample import resample_interface
+from Extra.labels import label_index
 from nipype.interfaces.minc import Calc as CalcCommand
 import nipype.pipeline.engine as pe
 import nipype.interfaces.minc as minc
@@ -38,7 +40,7 @@ class createImgFromROI(BaseInterface) :
 
     def _run_interface(self, runtime) :
         if not isdefined(self.inputs.out_file) : self.inputs.out_file = self._gen_output(self.inputs.in_file)
-        ref = volumeFromFile(self.inputs.like_file)
+        index = label_index(self.inputs.like_file)
         out = volumeLikeFile(self.inputs.like_file, self.inputs.out_file )
         roi=[]
         with open(self.inputs.in_file) as f :
@@ -47,8 +49,10 @@ class createImgFromROI(BaseInterface) :
                     ll=re.split(' |\t', l)
                     roi.append([int(ll[1]), float(ll[3])])
 
+        data = np.zeros(index.shape, dtype=np.float32).reshape(-1)
         for label, value in roi : 
-            out.data[ref.data == label] = value
+            data[index.voxels(label)] = value
+        out.data = data.reshape(index.shape)
         out.writeFile()
         out.closeVolume()
 
@@ -220,7 +224,7 @@ def get_tka_workflow(name, opts):
     workflow.connect(tka_source, 'out_file', outputnode, 'out_file')
    
     if opts.quant_to_stereo and not opts.analysis_space == "stereo" :
-        quant_to_stereo = pe.Node( minc.Resample(), name="quant_stereo"  )
+        quant_to_stereo = pe.Node( resample_interface(opts), name="quant_stereo"  )
         workflow.connect(inputnode, 'tfm_to_stereo', quant_to_stereo, "transformation")
         workflow.connect(inputnode, 'stereo', quant_to_stereo, "like")
         workflow.connect(tka_source, 'out_file', quant_to_stereo, "input_file")
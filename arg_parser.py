@@ -55,6 +55,9 @@ def get_parser():
     # Information #
     ###############
     parser.add_argument("--halflife",dest="halflife",help="Half-life of radio isotope (in seconds).",type=float,default=0)
+    parser.add_argument("--pet-volume-start-fraction",dest="pet_volume_start_fraction",help="Fraction of frames to skip at the start of the scan when averaging the dynamic PET into a 3D volume (default=0.25)",type=float,default=0.25)
+    parser.add_argument("--pet-volume-end-fraction",dest="pet_volume_end_fraction",help="Fraction of frames after which frames are skipped when averaging the dynamic PET into a 3D volume (default=1.0)",type=float,default=1.0)
+    parser.add_argument("--pet-volume-weighting",dest="pet_volume_weighting",help="Weighting of frames when averaging the dynamic PET into a 3D volume: duration, uniform (default=duration)",type=str,default='duration',choices=['duration','uniform'])
           
     #############################
     # MRI Preprocessing Options #
@@ -142,17 +145,33 @@ def get_parser():
     parser.add_argument("--results-label-erosion",dest="results_erode_times",help="Number of times to erode label", type=int,default=0 )
     parser.add_argument("--results-labels-brain-only","--results-label-brain-only",dest="results_labels_brain_only",help="Mask results labels with brain mask",action='store_true',default=False)
     parser.add_argument("--results-labels-ones-only",dest="results_labels_ones_only",help="Flag to signal threshold so that label image is only 1s and 0s",action='store_true',default=False)
+    parser.add_argument("--results-stats-method",dest="results_stats_method",help="Method used to compute the regional statistics of the results report: mincgroupstats or native (label index of the results labels, experimental). Surface results always use mincgroupstats.",type=str,default='mincgroupstats',choices=['native','mincgroupstats'])
+    parser.add_argument("--template-cache-dir",dest="template_cache_dir",help="Directory where the nonlinear transformations from the label templates to the stereotaxic template are stored, so that they can be reused between runs (default=<target>/<preprocdir>/template_normalization)",type=str,default=None)
     
 
     ##########################
     # Coregistration Options #
     ##########################
     #group= OptionGroup(parser,"Coregistation options")
-    parser.add_argument("--coreg-method", dest="coreg_method",type=str,help="Coregistration method: minctracc, ants (default=minctracc)", default="minctracc")
+    parser.add_argument("--coreg-method", dest="coreg_method",type=str,help="Coregistration method: minctracc, ants, native (in-process NMI registration) (default=minctracc)", default="minctracc")
     parser.add_argument("--coregistration-brain-mask",dest="coregistration_brain_mask",help="Target T1 mask for coregistration", action='store_false', default=True)
     parser.add_argument("--second-pass-no-mask",dest="no_mask",help="Do a second pass of coregistration without masks.", action='store_false', default=True)
     parser.add_argument("--slice-factor",dest="slice_factor",help="Value (between 0. to 1.) that is multiplied by the maximum of the slices of the PET image. Used to threshold slices. Lower value means larger mask.", type=float, default=0.25)
+    parser.add_argument("--resample-method",dest="resample_method",help="Method used to resample the 4D PET image and the parametric images: mincresample or native (in-process, frames resampled in parallel with --threads) (default=mincresample)",type=str,default="mincresample",choices=["mincresample","native"])
+    parser.add_argument("--blur-method",dest="blur_method",help="Method used to blur the images at each registration stage: mincblur or native (in-process separable Gaussian filter, multi-threaded with --threads) (default=mincblur)",type=str,default="mincblur",choices=["mincblur","native"])
+    parser.add_argument("--blur-cache-dir",dest="blur_cache_dir",help="Directory where the blurred images used for coregistration are stored, so that they can be reused between scans and runs (default=<target>/<preprocdir>/blur_cache)",type=str,default=None)
+    parser.add_argument("--coreg-multi-start",dest="coreg_multi_start",help="Initialize the PET to T1 coregistration with the seed, from a grid of rotations and translations, that has the highest normalized mutual information at the coarsest blur level. The seeds are evaluated in parallel with --threads",action='store_true',default=False)
+    parser.add_argument("--coreg-seed-angles",dest="coreg_seed_angles",help="Rotations (in degrees) of the multi-start seeds about each axis (default=-15 0 15)",type=float,nargs='+',default=[-15.,0.,15.])
+    parser.add_argument("--coreg-seed-offsets",dest="coreg_seed_offsets",help="Translations (in mm) of the multi-start seeds along each axis (default=-15 0 15)",type=float,nargs='+',default=[-15.,0.,15.])
+    parser.add_argument("--registration-early-exit",dest="registration_early_exit",help="Stop the minctracc coregistration and normalization stages once the transformation changes less than the tolerances between two stages",action='store_true',default=False)
+    parser.add_argument("--registration-tolerance-translation",dest="registration_tolerance_translation",help="Tolerance on the change in translation between linear registration stages, in mm (default=0.5)",type=float,default=0.5)
+    parser.add_argument("--registration-tolerance-rotation",dest="registration_tolerance_rotation",help="Tolerance on the change in rotation between linear registration stages, in degrees (default=0.5)",type=float,default=0.5)
+    parser.add_argument("--registration-tolerance-displacement",dest="registration_tolerance_displacement",help="Tolerance on the RMS change in displacement between nonlinear registration stages, in mm (default=0.5)",type=float,default=0.5)
+    parser.add_argument("--registration-transforms-only",dest="registration_transforms_only",help="Only write the transformation of each minctracc coregistration and normalization stage, without resampling the source image at every stage",action='store_true',default=False)
     parser.add_argument("--total-factor",dest="total_factor",help="Value (between 0. to 1.) that is multiplied by the thresholded means of each slice.",type=float, default=0.333)
+    parser.add_argument("--pet-head-mask-threshold",dest="pet_head_mask_threshold",help="Method used to threshold the PET head mask: slice-mean (uses --slice-factor and --total-factor), otsu or percentile (default=slice-mean)",type=str,default="slice-mean",choices=["slice-mean","otsu","percentile"])
+    parser.add_argument("--pet-head-mask-percentile",dest="pet_head_mask_percentile",help="Percentile of the non-zero PET voxels used as threshold with --pet-head-mask-threshold percentile (default=50)",type=float,default=50.)
+    parser.add_argument("--pet-head-mask-fill-holes",dest="pet_head_mask_fill_holes",help="Fill the holes of the PET head mask",action='store_true',default=False)
     
 
     ###############
@@ -224,6 +243,10 @@ def get_parser():
 def modify_opts(opts) :
     opts.targetDir = os.path.normpath(opts.targetDir)
     opts.sourceDir = os.path.normpath(opts.sourceDir)
+    if opts.template_cache_dir == None :
+        opts.template_cache_dir = opts.targetDir+os.sep+opts.preproc_dir+os.sep+"template_normalization"
+    if opts.blur_cache_dir == None :
+        opts.blur_cache_dir = opts.targetDir+os.sep+opts.preproc_dir+os.sep+"blur_cache"
 
     ############################
     #Automatically set sessions#
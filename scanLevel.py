@@ -1,6 +1,5 @@
 #vim: set tabstop=4 expandtab shgftwidth=4 softtabstop=4 mouse=a autoindent hlsearch
 #vim: filetype plugin indent on
-from glob import glob
 import os
 import sys
 import argparse
@@ -8,6 +7,7 @@ import time
 
 #import Initialization.initialization as init
 from workflows import Workflows
+from Extra.bids_index import BIDSIndex, scan_key
 
 """
 .. module:: scanLevel
@@ -34,65 +34,69 @@ def run_scan_level(opts,args):
 
 
 def gen_args(opts, subjects):
-    session_ids = opts.sessionList 
-    task_ids = opts.taskList 
-    run_ids = opts.runList
+    session_ids = [ str(ses) for ses in opts.sessionList ]
+    task_ids = [ str(task) for task in opts.taskList ]
+    run_ids = [ str(run) for run in opts.runList ]
     acq = opts.acq 
     rec = opts.rec
     
     task_args=[]
     sub_ses_args=[]
-    sub_ses_dict={}
+    scan_files={}
     if len(session_ids) == 0 : session_ids=['']
     if len(task_ids) == 0 : task_ids=['']
     if len(run_ids) == 0 : run_ids=['']
+    img_ext = ['mnc', 'mnc.gz']
+
+    #Walk the source directory once and index the files by BIDS entities.
+    #The index is also used by Workflows to find the input files of the datasources
+    index_file = opts.targetDir+os.sep+opts.preproc_dir+os.sep+'bids_index.json'
+    index = BIDSIndex(opts.sourceDir, index_file, opts.verbose)
+    opts.bids_index = index
 
     for sub in subjects:
         if opts.verbose >= 2: print("Sub:", sub)
-        for ses in session_ids:
-            if opts.verbose >= 2: print("Ses:",ses)
-            for task in task_ids:
-                if opts.verbose >= 2: print("Task:",task)
-                for run in run_ids:
-                    sub_arg='sub-'+sub
-                    ses_arg='ses-'+ses
-                    rec_arg=acq_arg=""
-
-                    pet_fn=mri_fn=""
-                    if  acq == '': acq_arg='acq-'+acq
-                    if  rec == '': rec_arg='rec-'+rec
-                    pet_string=opts.sourceDir+os.sep+ sub_arg + os.sep+ '*'+ ses_arg + os.sep+ 'pet/*_pet.mnc'
-                    pet_string_gz=opts.sourceDir+os.sep+ sub_arg + os.sep+ '*'+ ses_arg + os.sep+ 'pet/*_pet.mnc.gz'
-                    pet_list=glob(pet_string) + glob(pet_string_gz)
-                    arg_list = ['sub-'+sub, 'ses-'+ses]
-                    mri_arg_list = ['sub-'+sub, 'ses-'+ses]
-                    if not task == '': arg_list += ['task-'+task]
-                    if not acq == '': arg_list += ['acq-'+acq]
-                    if not rec == '': arg_list += ['rec-'+rec]
-                    if not run == '': arg_list += ['run-'+run]
-                    if opts.verbose >= 2: print( "Arguments for indentifying images:", arg_list );
-                    if pet_list != []:
-                        pet_fn = unique_file(pet_list, arg_list, opts.verbose )
-                    mri_list=glob(opts.sourceDir+os.sep+ sub_arg + os.sep + '*/anat/*_T1w.mnc' ) + glob(opts.sourceDir+os.sep+ sub_arg + os.sep + '*/anat/*_T1w.mnc.gz' )
-                    if mri_list != []:
-                        mri_fn = unique_file(mri_list, mri_arg_list )
-
-                    if os.path.exists(pet_fn) and os.path.exists(mri_fn):
-                        d={'task':task, 'ses':ses, 'sid':sub, 'run':run} 
-                        sub_ses_dict[sub]=ses
-                        if opts.verbose >= 2 :
-                            print(pet_fn, os.path.exists(pet_fn))
-                            print(mri_fn, os.path.exists(mri_fn))
-                            print('Adding to dict of valid args',d)
-                        task_args.append(d)
-                    else:
-                        if not os.path.exists(pet_fn) and opts.verbose >= 1:
-                            print "Could not find PET for ", sub, ses, task, pet_fn
-                        if not os.path.exists(mri_fn) and opts.verbose >= 1:
-                            print "Could not find T1 for ", sub, ses, task, mri_fn
-
-    for key, val in sub_ses_dict.items() :
-        sub_ses_args.append({"sid":key,"ses":ses})
+        #Group the PET images of the subject by (ses, task, run). If a list of IDs was not 
+        #specified by the user, the corresponding entity is not used to identify the scan.
+        scans={}
+        for record in index.query(sub, 'pet', 'pet', img_ext, acq=acq, rec=rec) :
+            ses, task, run = [ record[key] if ids != [''] else '' for key, ids in (('ses',session_ids), ('task',task_ids), ('run',run_ids)) ]
+            if ses in session_ids and task in task_ids and run in run_ids :
+                scans.setdefault((ses, task, run), []).append(record["path"])
+
+        for ses, task, run in sorted(scans.keys(), key=lambda k : (session_ids.index(k[0]), task_ids.index(k[1]), run_ids.index(k[2]))) :
+            pet_list = scans[(ses, task, run)]
+            if len(pet_list) > 1 :
+                print("Error: PET files are not uniquely specified. Multiple files found for ", sub, ses, task, run)
+                print("You can used --acq and --rec to specify the acquisition and receptor")
+                print(pet_list)
+                exit(1)
+            pet_fn = pet_list[0]
+
+            anat_key = scan_key(sub, ses)
+            if not anat_key in scan_files :
+                scan_files[anat_key] = { "nativeT1" : index.unique(sub, 'anat', 'T1w', img_ext, ses=ses) }
+            mri_fn = scan_files[anat_key]["nativeT1"]
+
+            if mri_fn != '' :
+                d={'task':task, 'ses':ses, 'sid':sub, 'run':run} 
+                scan_files[scan_key(sub, ses, task, run)] = {
+                        "pet":pet_fn, 
+                        "json_header":index.sibling(pet_fn, 'json'), 
+                        "arterial_file":index.sibling(pet_fn, 'dft') 
+                        }
+                if not {"sid":sub, "ses":ses} in sub_ses_args :
+                    sub_ses_args.append({"sid":sub, "ses":ses})
+                if opts.verbose >= 2 :
+                    print(pet_fn)
+                    print(mri_fn)
+                    print('Adding to dict of valid args',d)
+                task_args.append(d)
+            elif opts.verbose >= 1:
+                print "Could not find T1 for ", sub, ses, task, pet_fn
+
+        if scans == {} and opts.verbose >= 1:
+            print "Could not find PET for ", sub
 
     if opts.verbose >= 2:
         print("Scans on which APPIAN will be run")
@@ -100,46 +104,6 @@ def gen_args(opts, subjects):
     
     opts.sub_valid_args = sub_ses_args
     opts.task_valid_args = task_args
+    opts.scan_files = scan_files
 
     return sub_ses_args, task_args
-
-
-def unique_file(files, attributes, verbose=1):
-
-    out_files=[]
-    for f in files :
-        skip=False
-        for a in attributes :
-            if not a in f :
-                if verbose >= 2 : 
-                    print(a, "not in ", f)
-                skip=True
-                break
-        if verbose >= 2 : 
-            if skip :
-                print("Valid file", f)
-            else :
-                print("File missing attribute, skipping:",f)
-
-        if not skip :
-            out_files.append(f)
-
-    if attributes == [] or len(out_files) == 0 : return ''
-
-    #Check if out_files contains gzip compressed and uncompressed versions of the same file
-    #if len(out_files) == 2 :
-    #    if out_files[0] == out_files[1]+'.gz' or out_files[1] == out_files[0]+'.gz':
-    #        #Check if '.gz' is in the path extension for the located file.
-    #        #If so remove the file without .gz in the extension from the list of out_files
-    #        if '.gz' in os.path.splitext(out_files[1])[1] :
-    #            out_files.remove(out_files[0])
-    #        else :
-    #            out_files.remove(out_files[1])
-
-    if len(out_files) > 1 :
-        print("Error: PET files are not uniquely specified. Multiple files found for the attributes ", attributes)
-        print("You can used --acq and --rec to specify the acquisition and receptor")
-        print(out_files)
-        exit(1)
-
-    return( out_files[0] )
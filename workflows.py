@@ -8,6 +8,7 @@ from Extra.conversion import mnc2niiCommand
 import nipype.interfaces.minc as minc
 import Registration.registration as reg
 import Initialization.initialization as init
+from Extra.bids_index import IndexedDataSourceRunning, scan_key, save_scan_files
 import Partial_Volume_Correction.pvc as pvc 
 import Results_Report.results as results
 import Tracer_Kinetic.tka as tka
@@ -20,6 +21,19 @@ import nipype.interfaces.io as nio
 import nipype.interfaces.utility as util
 
 
+def anat_parameterization_dir(sid, ses):
+    '''Name of the directory created by Nipype for the (sid, ses) iterables of <preinfosource_anat>'''
+    return '_ses_'+ses+'_sid_'+sid
+
+def datasink_substitutions(sub_valid_args):
+    '''
+    Substitutions applied by the datasink to the output paths.
+    The directory level created by the anatomical (sid, ses) iterables is removed first, matching
+    each parameterization directory exactly, so that the output paths are the same as when the
+    PET and MRI processing were driven by a single iterable.
+    '''
+    anat_dirs = [ ('/'+anat_parameterization_dir(args['sid'], args['ses'])+'/', '/') for args in sub_valid_args ]
+    return anat_dirs + [('_args_',''), ('run','run-'), ('_cid_', ''), ('sid_', ''), ('sid-','sub-'), ('task','task-'), ('ses','ses-')]
 
 class Workflows:
     def __init__(self, opts) :
@@ -107,7 +121,7 @@ class Workflows:
         if opts.user_brainmask : 
             self.brain_mask_mni_node = self.datasourceAnat
             self.brain_mask_mni_file = 'brain_mask_mni'
-            self.workflow.connect(self.datasource, 'brain_mask_mni', self.mri_preprocess, 'inputnode.brain_mask_mni') 
+            self.workflow.connect(self.datasourceAnat, 'brain_mask_mni', self.mri_preprocess, 'inputnode.brain_mask_mni') 
         else : 
             self.brain_mask_mni_node = self.mri_preprocess
             self.brain_mask_mni_file='outputnode.brain_mask_mni'
@@ -276,7 +290,7 @@ class Workflows:
     def set_pvc(self, opts) :
         self.pvc = pvc.get_pvc_workflow("pvc", self.infosource, opts) 
         self.workflow.connect(self.pet_input_node, self.pet_input_file, self.pvc, "inputnode.in_file") 
-        self.workflow.connect(self.masking, "pvcLabels.out_file", self.pvc, "inputnode.mask_file") 
+        self.workflow.connect(self.masking, "outputnode.pvc_label_img", self.pvc, "inputnode.mask_file") 
         self.workflow.connect(self.init_pet, 'outputnode.pet_header_json', self.pvc, "inputnode.header") 
         #Add the outputs of PVC to list that keeps track of the outputnodes, images, and the number 
         #of dimensions of these images
@@ -299,7 +313,7 @@ class Workflows:
             self.quant_target_img= self.pet_input_file # ##CHANGE
         self.quant=tka.get_tka_workflow("quantification", opts)
         self.workflow.connect(self.init_pet, 'outputnode.pet_header_json', self.quant, "inputnode.header")
-        self.workflow.connect(self.masking, "resultsLabels.out_file", self.quant, "inputnode.mask") 
+        self.workflow.connect(self.masking, "outputnode.results_label_img", self.quant, "inputnode.mask") 
         self.workflow.connect(self.quant_target_wf, self.quant_target_img, self.quant, "inputnode.in_file")
         self.workflow.connect(self.mri_preprocess, "outputnode.brain_mask_mni", self.quant, "inputnode.stereo")
        
@@ -314,7 +328,7 @@ class Workflows:
         if opts.arterial :
             self.workflow.connect(self.datasource, 'arterial_file', self.quant, "inputnode.reference")
         else :     
-            self.workflow.connect(self.masking, 'tkaLabels.out_file', self.quant, "inputnode.reference")
+            self.workflow.connect(self.masking, 'outputnode.tka_label_img', self.quant, "inputnode.reference")
 
         #Add the outputs of TKA (Quuantification) to list that keeps track of the outputnodes, images, 
         # and the number of dimensions of these images       
@@ -367,6 +381,7 @@ class Workflows:
             self.resultsReport.inputs.dim = dim
             self.resultsReport.inputs.node = node.name
             self.resultsReport.inputs.acq = opts.acq
+            self.resultsReport.inputs.stats_method = opts.results_stats_method
             self.workflow.connect(self.infosource, 'sid', self.resultsReport, "sub")
             self.workflow.connect(self.infosource, 'ses', self.resultsReport, "ses")
             self.workflow.connect(self.infosource, 'task', self.resultsReport, "task")
@@ -379,7 +394,7 @@ class Workflows:
                 self.workflow.connect(self.masking, 'surface_right_node.out_file', self.resultsReport, "surf_right")
                 self.workflow.connect(self.datasourceSurf, 'mask_right', self.resultsReport, 'mask_right')   
             else :
-                self.workflow.connect(self.masking, 'resultsLabels.out_file', self.resultsReport, 'mask')
+                self.workflow.connect(self.masking, 'outputnode.results_label_img', self.resultsReport, 'mask')
 
             self.workflow.connect( self.resultsReport, 'out_file_3d', self.datasink, node_name+os.sep+dir_name )
             if int(dim) == 4:
@@ -437,14 +452,30 @@ class Workflows:
     ### Preinfosource ###
     #####################
     def set_preinfosource(self, opts):
-        self.preinfosource = pe.Node(interface=niu.IdentityInterface(fields=['args','ses','results_labels','tka_labels','pvc_labels', 'pvc_erode_times', 'tka_erode_times', 'results_erode_times']), name="preinfosource")
-        self.preinfosource.iterables = ( 'args', opts.task_valid_args )
+        '''
+        The anatomical branch iterates over the (sid, ses) pairs in opts.sub_valid_args, so that the MRI
+        preprocessing runs once per subject and session. <preinfosource> then iterates over the PET scans 
+        (opts.task_valid_args) of the current (sid, ses), using <preinfosource_anat> as its itersource.
+        '''
+        self.preinfosource_anat = pe.Node(interface=niu.IdentityInterface(fields=['sid','ses']), name="preinfosource_anat")
+        self.preinfosource_anat.iterables = [ ('sid', [ args['sid'] for args in opts.sub_valid_args ]), ('ses', [ args['ses'] for args in opts.sub_valid_args ]) ]
+        self.preinfosource_anat.synchronize = True
+
+        task_args_by_sub_ses={}
+        for args in opts.task_valid_args :
+            task_args_by_sub_ses.setdefault( (args['sid'], args['ses']), []).append(args)
+
+        self.preinfosource = pe.Node(interface=niu.IdentityInterface(fields=['args','sid','ses','results_labels','tka_labels','pvc_labels', 'pvc_erode_times', 'tka_erode_times', 'results_erode_times']), name="preinfosource")
+        self.preinfosource.itersource = ('preinfosource_anat', ['sid', 'ses'])
+        self.preinfosource.iterables = ( 'args', task_args_by_sub_ses )
         self.preinfosource.inputs.results_labels = opts.results_labels
         self.preinfosource.inputs.tka_labels = opts.tka_labels
         self.preinfosource.inputs.pvc_labels = opts.pvc_labels 
         self.preinfosource.inputs.results_erode_times = opts.results_erode_times
         self.preinfosource.inputs.tka_erode_times = opts.tka_erode_times
         self.preinfosource.inputs.pvc_erode_times = opts.pvc_erode_times
+        self.workflow.connect(self.preinfosource_anat, 'sid', self.preinfosource, 'sid')
+        self.workflow.connect(self.preinfosource_anat, 'ses', self.preinfosource, 'ses')
 
     ##################
     ### Infosource ###
@@ -499,51 +530,24 @@ class Workflows:
     # PET Datasource #
     ##################
     def set_datasource_pet(self, opts ):
+        '''
+        Input files are looked up in opts.scan_files, which gen_args fills from the BIDS index of the source
+        directory, instead of being globbed by a DataGrabber for every scan. opts.scan_files is written to
+        scan_files_json by set_datasource_anat.
+        '''
         self.base_pet_outputs = [ 'pet', "json_header", "arterial_file" ]
-        self.datasourcePET = pe.Node( interface=nio.DataGrabber(infields=[], outfields=self.base_pet_outputs, raise_on_empty=True, sort_filelist=False), name="datasourcePET")
-        self.datasourcePET.inputs.template = '*'
-        self.datasourcePET.inputs.base_directory = '/' # opts.sourceDir
-        self.datasourcePET.inputs.acq=opts.acq
-        self.datasourcePET.inputs.rec=opts.rec  
-        self.datasourcePET.inputs.field_template = {}
-        self.datasourcePET.inputs.template_args = {}
-
-        pet_str = opts.sourceDir+os.sep+'sub-%s/*ses-%s/pet/sub-%s_ses-%s'
-        pet_list = ['sid', 'ses', 'sid', 'ses']
-        if len(opts.taskList) != 0: 
-            pet_str = pet_str + '*task-%s'
-            pet_list += ['task'] 
-        if len(opts.runList) != 0: 
-            pet_str = pet_str + '*run-%s'
-            pet_list += ['run']
-        if opts.acq != '' :
-            pet_str = pet_str + '*acq-%s'
-            pet_list += ['acq']  
-        if opts.rec != '':
-            pet_str = pet_str + '*rec-%s'
-            pet_list += ['rec']
-
-
-        pet_str = pet_str + '*_pet.'
-
-        img_str = pet_str + opts.img_ext
-        header_str = pet_str + 'json'
-
-        field_template_pet = dict( pet=img_str, json_header=header_str )
-        template_args_pet =  dict( pet=[pet_list], json_header=[pet_list] )
-
+        self.datasourcePET = pe.Node( interface=IndexedDataSourceRunning(), name="datasourcePET")
+        self.datasourcePET.inputs.files_json = self.scan_files_json(opts)
+        #The lookup is cheap and always redone, so that a changed input file of the scan reaches the next nodes
+        self.datasourcePET.overwrite = True
+        self.datasourcePET.inputs.fields = [ 'pet', 'json_header' ]
         if opts.arterial : 
-            field_template_pet["arterial_file"] = pet_str + 'dft' 
-            template_args_pet["arterial_file"] = [pet_list]
-
-        self.datasourcePET.inputs.field_template.update(field_template_pet)
-        self.datasourcePET.inputs.template_args.update(template_args_pet)
+            self.datasourcePET.inputs.fields += [ 'arterial_file' ]
 
         #Create connections bettween infosource and datasourcePET 
         self.workflow.connect([
             (self.infosource,self.datasourcePET, [('sid', 'sid')]),
             (self.infosource,self.datasourcePET, [('ses', 'ses')]),
-            (self.infosource,self.datasourcePET, [('cid', 'cid')]),
             (self.infosource,self.datasourcePET, [('task', 'task')]),
             (self.infosource,self.datasourcePET, [('run', 'run')]),
             ])
@@ -553,15 +557,10 @@ class Workflows:
     # Anat Datasource #
     ###################
     def set_datasource_anat(self, opts) :  
-        ### Use DataGrabber to get key input files
         self.base_anat_outputs  = ['nativeT1', 'xfmT1MNI','brain_mask_mni', "pvc_label_img", "tka_label_img", "results_label_img", "pvc_label_template", "tka_label_template", "results_label_template" ]
-        self.datasourceAnat = pe.Node( interface=nio.DataGrabber(infields=[], outfields=self.base_anat_outputs, raise_on_empty=True, sort_filelist=False), name="datasourceAnat")
-        self.datasourceAnat.inputs.template = '*'
-        self.datasourceAnat.inputs.base_directory = '/' # opts.sourceDir
-        self.datasourceAnat.inputs.field_template={
-                "nativeT1":opts.sourceDir+os.sep+'sub-%s/*ses-%s/anat/sub-%s_ses-%s*_T1w.mnc'
-                }
-        self.datasourceAnat.inputs.template_args = {"nativeT1":[[ 'sid', 'ses', 'sid', 'ses']]}
+        self.datasourceAnat = pe.Node( interface=IndexedDataSourceRunning(), name="datasourceAnat")
+        self.datasourceAnat.inputs.ses_sub_only = True
+        self.datasourceAnat.inputs.fields = [ 'nativeT1' ]
 
         if opts.pvc_label_type != "internal_cls" :
             self.set_label(opts.pvc_label_type ,opts.pvc_label_img,opts.pvc_label_template, 'pvc_label_img', 'pvc_label_template', opts)
@@ -578,78 +577,69 @@ class Workflows:
         if opts.user_brainmask :
             self.set_brain_mask(opts)
         
-        #Create connections bettween infosource and datasourceAnat
+        self.datasourceAnat.inputs.files_json = save_scan_files(opts.scan_files, self.scan_files_json(opts))
+        self.datasourceAnat.overwrite = True
+
+        #datasourceAnat only depends on the anatomical iterables so that the MRI preprocessing is
+        #not repeated for every PET scan of a subject and session
         self.workflow.connect([
-            (self.infosource,self.datasourceAnat, [('sid', 'sid')]),
-            (self.infosource,self.datasourceAnat, [('ses', 'ses')]),
+            (self.preinfosource_anat,self.datasourceAnat, [('sid', 'sid')]),
+            (self.preinfosource_anat,self.datasourceAnat, [('ses', 'ses')]),
             ])
+
+    def scan_files_json(self, opts):
+        return opts.targetDir+os.sep+opts.preproc_dir+os.sep+'scan_files.json'
+
+    def set_anat_file(self, field, find_file, opts):
+        '''
+        Set the file <field> of each (sid, ses) in opts.scan_files to the path returned by find_file(sid, ses)
+        '''
+        for args in opts.sub_valid_args :
+            opts.scan_files[scan_key(args["sid"], args["ses"])][field] = find_file(args["sid"], args["ses"])
+        self.datasourceAnat.inputs.fields = list(set(self.datasourceAnat.inputs.fields + [field]))
+
     #
     # Set Labels for datasourceAnat
     #
     def set_label(self, label_type, img, template, label_img, template_img, opts) :
         '''
-        updates datasourceT1 with the appropriate field_template and template_args to find the desired
-        3D image volume with labels for particular processing stage (pvc, tka/quant, results)
+        updates datasourceAnat with the appropriate file to find the desired 3D image volume with labels 
+        for particular processing stage (pvc, tka/quant, results)
         '''
-        field_template={}
-        template_args={}
+        index = opts.bids_index
         if label_type == 'user_cls' :
-            label_img_template=opts.sourceDir+os.sep+'*sub-%s/*ses-%s/anat/sub-%s_ses-%s'
-            template_args[label_img]=[['sid', 'ses', 'sid', 'ses'] ] 
-            label_img_template +='*'+img+'*.'+opts.img_ext
-            #label_img_template +='*_variant-'+img+'_dtissue.'+opts.img_ext
-            field_template[label_img] = label_img_template
+            find_label = lambda sid, ses : index.unique(sid, 'anat', pattern='sub-'+sid+'_ses-'+ses+'*'+img+'*.'+opts.img_ext)
+            self.set_anat_file(label_img, find_label, opts)
         elif label_type == 'atlas' or label_type == 'atlas-template' :
-            field_template[label_img] = "%s"
-            template_args[label_img] = [[img]]       
+            self.set_anat_file(label_img, lambda sid, ses : img, opts)
             if label_type == 'atlas-template'  :
-                field_template[template_img] = "%s"
-                template_args[template_img] = [[template]]
+                self.set_anat_file(template_img, lambda sid, ses : template, opts)
         else :
             print("Error : label_type not valid", label_type)
             exit(1)
-        self.datasourceAnat.inputs.field_template.update( field_template )
-        self.datasourceAnat.inputs.template_args.update( template_args )
     
     #
     # Set Brain Mask for datasourceAnat
     #
     def set_brain_mask(self, opts) :
-        field_template={}
-        template_args={}
-
-        brain_mask_template = opts.sourceDir+os.sep+'sub-%s/*ses-%s/anat/sub-%s_ses-%s*'
-        template_args["brain_mask_mni"]=[['sid' ,'ses','sid', 'ses']]
-
-        brain_mask_template = brain_mask_template + "_T1w_space-mni"
+        index = opts.bids_index
+        brain_mask_template = "_T1w_space-mni"
 
         if not opts.coregistration_brain_mask : 
             brain_mask_template = brain_mask_template + '_skullmask.*'+opts.img_ext
         else :
             brain_mask_template = brain_mask_template + '_brainmask.*'+opts.img_ext
 
-        field_template["brain_mask_mni"] = brain_mask_template
-        
-
-        self.datasourceAnat.inputs.field_template.update(field_template)
-
-        self.datasourceAnat.inputs.template_args.update(template_args)
+        find_brain_mask = lambda sid, ses : index.unique(sid, 'anat', pattern='sub-'+sid+'_ses-'+ses+'*'+brain_mask_template)
+        self.set_anat_file("brain_mask_mni", find_brain_mask, opts)
 
     #
     # Set transformation files for datasourceAnat
     #
     def set_transform(self, opts):
-        field_template={}
-        template_args={}
-        label_template = opts.sourceDir+os.sep+'sub-%s/*ses-%s/transforms/sub-%s_ses-%s'
-        template_args["xfmT1MNI"] = [['sid', 'ses', 'sid', 'ses' ]]
-
-        label_template = label_template + '*target-MNI_affine.xfm'
-
-        field_template["xfmT1MNI"] = label_template
-
-        self.datasourceAnat.inputs.field_template.update(field_template)
-        self.datasourceAnat.inputs.template_args.update(template_args)
+        index = opts.bids_index
+        find_transform = lambda sid, ses : index.unique(sid, 'transforms', pattern='sub-'+sid+'_ses-'+ses+'*target-MNI_affine.xfm')
+        self.set_anat_file("xfmT1MNI", find_transform, opts)
 
     ###########################
     # Datasource for Surfaces #
@@ -689,7 +679,7 @@ class Workflows:
     def set_datasink(self, opts) :
         self.datasink=pe.Node(interface=nio.DataSink(), name="output")
         self.datasink.inputs.base_directory= opts.targetDir + '/' 
-        self.datasink.inputs.substitutions = [('_args_',''), ('run','run-'), ('_cid_', ''), ('sid_', ''), ('sid-','sub-'), ('task','task-'), ('ses','ses-')]
+        self.datasink.inputs.substitutions = datasink_substitutions(opts.sub_valid_args)
         for i, (node, img, dim, dir_name) in enumerate(zip(self.out_node_list, self.out_img_list, self.out_img_dim, self.datasink_dir_name)):
             if opts.output_format == 'nifti' :
                 convertOutput=pe.Node(mnc2niiCommand(), name="convert_output_"+str(i)+'_'+node.name)